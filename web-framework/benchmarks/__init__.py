@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/8
+'''
+Benchmarks for the framework. Every module can be run from the
+web-framework directory, e.g. 'python -m benchmarks.keep_alive'.
+'''
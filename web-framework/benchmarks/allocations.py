@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/20
+'''
+Counts the objects allocated per request with the free-lists of
+framework.pool disabled and enabled. HTTPProtocol is driven in process
+through a fake transport, so the numbers only cover the server: a
+request per connection, and pipelined requests on a keep-alive
+connection.
+
+Reports the time per request, the Request and buffer objects created per
+request and the generation 0 garbage collections per 10000 requests,
+which run every time allocations of containers outnumber deallocations
+by gc.get_threshold()[0].
+
+    python -m benchmarks.allocations [--requests N] [--depth D]
+'''
+import argparse
+import asyncio
+import gc
+import time
+
+from framework import http_parser
+from framework.application import Router
+from framework.http_server import HTTPServer, HTTPProtocol
+from framework.pool import BUFFERS, POOL_SIZE, REQUESTS
+from benchmarks.keep_alive import hello
+from benchmarks.utils import build_request
+
+
+class FakeTransport(object):
+    '''
+    Just enough of an asyncio transport for HTTPProtocol, drops the
+    responses
+    '''
+
+    def __init__(self, loop, protocol):
+        self.loop = loop
+        self.protocol = protocol
+        self.closed = False
+
+    def get_extra_info(self, name, default=None):
+        return ('127.0.0.1', 0) if name == 'peername' else default
+
+    def write(self, data):
+        pass
+
+    def writelines(self, buffers):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def can_write_eof(self):
+        return True
+
+    def write_eof(self):
+        pass
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.loop.call_soon(self.protocol.connection_lost, None)
+
+
+def connect(server):
+    protocol = HTTPProtocol(server)
+    transport = FakeTransport(server.loop, protocol)
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+async def one_shot(server, requests, depth):
+    data = build_request(headers={'Connection': 'close'})
+    for _ in range(requests):
+        protocol, transport = connect(server)
+        protocol.data_received(data)
+        while not transport.closed:
+            await asyncio.sleep(0)
+    await asyncio.sleep(0)  # connection_lost of the last one
+
+
+async def pipelined(server, requests, depth):
+    data = build_request() * depth
+    protocol, transport = connect(server)
+    for _ in range(requests // depth):
+        protocol.data_received(data)
+        while protocol.requests_served % depth:
+            await asyncio.sleep(0)
+        while protocol._task is not None:
+            await asyncio.sleep(0)
+    transport.close()
+    await asyncio.sleep(0)
+
+
+def measure(client, requests, depth, pool_size):
+    for pool in (REQUESTS, BUFFERS):
+        pool.size = pool_size
+        pool.clear()
+    loop = asyncio.new_event_loop()
+    router = Router()
+    router.add_route('/', hello)
+    server = HTTPServer(router, http_parser, loop,
+                        max_keep_alive_requests=10 ** 9)
+    # warms the pools and the route up
+    loop.run_until_complete(client(server, depth * 10, depth))
+    created = REQUESTS.created, BUFFERS.created
+    gc.collect()
+    collections = gc.get_stats()[0]['collections']
+    started = time.perf_counter()
+    loop.run_until_complete(client(server, requests, depth))
+    elapsed = time.perf_counter() - started
+    collections = gc.get_stats()[0]['collections'] - collections
+    server.timer_wheel.close()
+    loop.close()
+    return (elapsed / requests * 10 ** 6,
+            (REQUESTS.created - created[0]) / requests,
+            (BUFFERS.created - created[1]) / requests,
+            collections * 10000 / requests)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--depth', type=int, default=8,
+                        help='number of pipelined requests per read')
+    args = parser.parse_args()
+
+    print('{0:<30} {1:>10} {2:>10} {3:>10} {4:>12}'.format(
+        '', 'us/request', 'Request', 'buffer', 'gen0 GC/10k'))
+    for name, client in (('one per connection', one_shot), ('pipelined', pipelined)):
+        for pools, size in (('no pools', 0), ('pools', POOL_SIZE)):
+            result = measure(client, args.requests, args.depth, size)
+            print('{0:<30} {1:>10.1f} {2:>10.2f} {3:>10.2f} {4:>12.1f}'.format(
+                '{0}, {1}'.format(name, pools), *result))
+
+
+if __name__ == '__main__':
+    main()
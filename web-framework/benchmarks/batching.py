@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/25
+'''
+Predictions per second and latency of a linear classifier served over
+HTTP, one JSON row per request: predict called per request in the thread
+pool, and concurrent requests micro-batched with Router.add_batched.
+
+The model is naive-classifier's LinearSVM when numpy is installed,
+otherwise a pure Python linear model of the same shape.
+
+    python -m benchmarks.batching [--requests N] [--concurrency C]
+        [--dim D] [--batch B] [--wait MS]
+'''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from framework.application import App, Router
+from framework.batching import json_input, json_output
+from benchmarks.utils import HOST, free_port, server_process, build_request, read_response
+
+CLASSES = 10
+
+try:
+    import numpy as np
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'naive-classifier'))
+    from classifiers import LinearSVM
+except ImportError:
+    np = None
+
+
+class PythonLinearModel(object):
+    '''
+    LinearClassifier.predict without numpy: the class of the highest score
+    of X.dot(W)
+    '''
+
+    def __init__(self, W):
+        self.W = W
+        self.columns = list(zip(*W))
+
+    def predict(self, X):
+        labels = []
+        for row in X:
+            scores = [sum(x * w for x, w in zip(row, column)) for column in self.columns]
+            labels.append(scores.index(max(scores)))
+        return labels
+
+
+def build_model(dim):
+    rng = random.Random(0)
+    W = [[rng.gauss(0, 0.001) for _ in range(CLASSES)] for _ in range(dim)]
+    if np is None:
+        model = PythonLinearModel(W)
+        return lambda rows: model.predict(rows)
+    model = LinearSVM()
+    model.W = np.array(W)
+    return lambda rows: model.predict(np.array(rows)).tolist()
+
+
+def serve(port, dim, batched, batch_size, max_wait):
+    predict = build_model(dim)
+
+    def single(request):
+        return json_output(predict([json_input(request)])[0])
+
+    router = Router()
+    if batched:
+        router.add_batched('/predict', predict, max_batch_size=batch_size, max_wait=max_wait)
+    else:
+        router.add_route('/predict', single, executor='thread', max_queue=10 ** 6)
+    App(router, host=HOST, port=port, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING).start_server()
+
+
+async def client(port, requests, latencies):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    for request in requests:
+        started = time.perf_counter()
+        writer.write(request)
+        code, _, _ = await read_response(reader)
+        assert code == 200, code
+        latencies.append(time.perf_counter() - started)
+    writer.close()
+
+
+async def load(port, requests, concurrency):
+    latencies = []
+    share = len(requests) // concurrency
+    await asyncio.gather(*[client(port, requests[i * share:(i + 1) * share], latencies)
+                           for i in range(concurrency)])
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=4000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--dim', type=int, default=256, help='dimension of the inputs')
+    parser.add_argument('--batch', type=int, default=64, help='max_batch_size')
+    parser.add_argument('--wait', type=float, default=5, help='max_wait in milliseconds')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    requests = [build_request('/predict', method='POST', headers={
+        'Content-Type': 'application/json'}, body=json.dumps(
+        [round(rng.random(), 3) for _ in range(args.dim)]).encode('utf8'))
+        for _ in range(args.requests)]
+    print('model: {0}'.format('LinearSVM' if np is not None else 'pure Python'))
+    for name, batched in (('per request', False), ('micro-batched', True)):
+        port = free_port()
+        with server_process(serve, port, args.dim, batched, args.batch, args.wait / 1000.0):
+            started = time.perf_counter()
+            latencies = asyncio.run(load(port, requests, args.concurrency))
+            elapsed = time.perf_counter() - started
+        print('{0:<14} {1:8.1f} req/s  p50 {2:7.2f}ms  p99 {3:7.2f}ms'.format(
+            name, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/22
+'''
+Requests per second and bytes sent for a large JSON route fetched with
+'Accept-Encoding: gzip': without compression, compressed for every
+request and compressed once for a cached route. Then the latency of a
+trivial route while other clients fetch the large route, compressed on
+the event loop and in the executor.
+
+    python -m benchmarks.compression [--requests N] [--concurrency C] [--size KB]
+'''
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from framework.application import App, Router
+from framework.compression import Compressor
+from framework.http_utils import Response
+from benchmarks.keep_alive import hello
+from benchmarks.utils import (HOST, free_port, server_process,
+                              build_request, read_response, report)
+
+
+def document(size):
+    items = [{'id': i, 'name': 'item {0}'.format(i), 'tags': ['a', 'b', 'c']}
+             for i in range(size * 1024 // 50)]
+    return json.dumps(items)
+
+
+def serve(port, size, compression, cache):
+    body = document(size)
+
+    async def data(request):
+        return Response(body=body, content_type='application/json')
+
+    router = Router()
+    router.add_route('/', hello)
+    router.add_route('/data', data, cache=cache)
+    App(router, host=HOST, port=port, compression=compression,
+        max_keep_alive_requests=10 ** 9, log_level=logging.WARNING).start_server()
+
+
+GZIP_REQUEST = build_request('/data', headers={'Accept-Encoding': 'gzip'})
+
+
+async def client(port, count, sizes):
+    reader, writer = await asyncio.open_connection(HOST, port, limit=2 ** 22)
+    for _ in range(count):
+        writer.write(GZIP_REQUEST)
+        _, _, body = await read_response(reader)
+        sizes.append(len(body))
+    writer.close()
+
+
+async def throughput(port, requests, concurrency):
+    sizes = []
+    await asyncio.gather(*[client(port, requests // concurrency, sizes)
+                           for _ in range(concurrency)])
+    return sizes
+
+
+async def busy_client(port, stop):
+    reader, writer = await asyncio.open_connection(HOST, port, limit=2 ** 22)
+    while not stop.is_set():
+        writer.write(GZIP_REQUEST)
+        await read_response(reader)
+    writer.close()
+
+
+async def latency(port, requests, busy):
+    stop = asyncio.Event()
+    clients = [asyncio.ensure_future(busy_client(port, stop)) for _ in range(busy)]
+    await asyncio.sleep(0.5)
+    request = build_request()
+    reader, writer = await asyncio.open_connection(HOST, port)
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        writer.write(request)
+        await read_response(reader)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    stop.set()
+    await asyncio.gather(*clients)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--size', type=int, default=256,
+                        help='size of the JSON document in KB')
+    args = parser.parse_args()
+
+    for name, compression, cache in (('uncompressed', None, False),
+                                     ('gzip per request', Compressor(), False),
+                                     ('gzip cached', Compressor(), True)):
+        port = free_port()
+        with server_process(serve, port, args.size, compression, cache):
+            started = time.perf_counter()
+            sizes = asyncio.run(throughput(port, args.requests, args.concurrency))
+            report(name, len(sizes), time.perf_counter() - started)
+        print('{0:<24} {1:8.1f} KB per response'.format('', sum(sizes) / len(sizes) / 1024))
+
+    for name, offload_size in (('on loop', float('inf')), ('executor', 0)):
+        port = free_port()
+        compression = Compressor(offload_size=offload_size)
+        with server_process(serve, port, args.size, compression, False):
+            latencies = asyncio.run(latency(port, args.requests // 2, args.concurrency))
+        print('{0:<10} p50 {1:8.2f}ms  p99 {2:8.2f}ms'.format(
+            name, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+if __name__ == '__main__':
+    main()
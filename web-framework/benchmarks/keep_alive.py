@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/8
+'''
+Compares requests per second of one connection per request against
+keep-alive connections, with and without pipelining, for the stream
+based HTTPConnection and the asyncio.Protocol based HTTPProtocol.
+
+    python -m benchmarks.keep_alive [--requests N] [--concurrency C] [--depth D]
+'''
+import argparse
+import asyncio
+import logging
+import time
+
+from framework.application import App, Router
+from benchmarks.utils import (HOST, free_port, server_process,
+                              build_request, read_response, report)
+
+
+async def hello(request):
+    return 'Hello world'
+
+
+def serve(port, keep_alive, use_protocol):
+    router = Router()
+    router.add_route('/', hello)
+    App(router, host=HOST, port=port, keep_alive=keep_alive,
+        use_protocol=use_protocol, log_level=logging.WARNING).start_server()
+
+
+async def one_shot_client(port, count):
+    request = build_request(headers={'Connection': 'close'})
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection(HOST, port)
+        writer.write(request)
+        await read_response(reader)
+        writer.close()
+
+
+async def keep_alive_client(port, count, depth=1):
+    request = build_request()
+    reader, writer = await asyncio.open_connection(HOST, port)
+    done = 0
+    while done < count:
+        batch = min(depth, count - done)
+        writer.write(request * batch)
+        for _ in range(batch):
+            code, headers, _ = await read_response(reader)
+            done += 1
+            if headers.get('connection') == 'close':
+                # the server is allowed to close after any response, the
+                # rest of the batch is sent again on a new connection
+                writer.close()
+                reader, writer = await asyncio.open_connection(HOST, port)
+                break
+    writer.close()
+
+
+def run(name, port, client, requests, concurrency, *args):
+    per_client = requests // concurrency
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    start = time.perf_counter()
+    loop.run_until_complete(asyncio.gather(
+        *[client(port, per_client, *args) for _ in range(concurrency)]))
+    report(name, per_client * concurrency, time.perf_counter() - start)
+    loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=8,
+                        help='number of pipelined requests in flight per connection')
+    args = parser.parse_args()
+
+    for mode, use_protocol in (('streams', False), ('protocol', True)):
+        port = free_port()
+        with server_process(serve, port, False, use_protocol):
+            run(mode + ' one-shot', port, one_shot_client,
+                args.requests, args.concurrency)
+
+        port = free_port()
+        with server_process(serve, port, True, use_protocol):
+            run(mode + ' keep-alive', port, keep_alive_client,
+                args.requests, args.concurrency)
+            run(mode + ' pipelined', port, keep_alive_client,
+                args.requests, args.concurrency, args.depth)
+
+
+if __name__ == '__main__':
+    main()
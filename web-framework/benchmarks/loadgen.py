@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/23
+'''
+asyncio load generator for the benchmark suite: keep-alive connections
+sending requests back to back for a fixed duration, and the CPU time and
+memory of the server processes read from /proc.
+'''
+import asyncio
+import os
+import time
+
+from benchmarks.utils import HOST, read_response
+
+READ_LIMIT = 2 ** 22
+
+
+class LoadResult(object):
+    '''
+    Responses received during a run and their latencies
+    '''
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.codes = {}
+        self.elapsed = 0.0
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    def add(self, code, latency):
+        self.latencies.append(latency)
+        self.codes[code] = self.codes.get(code, 0) + 1
+
+    def percentile(self, percent):
+        '''
+        :param percent: ie. 99.9
+        :return: the latency in seconds that percent of the requests
+            didn't exceed, nearest rank
+        '''
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        rank = max(int(round(percent / 100.0 * len(latencies))) - 1, 0)
+        return latencies[min(rank, len(latencies) - 1)]
+
+    def summary(self):
+        '''
+        :return: a dict of the figures reported for a scenario
+        '''
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'codes': {str(code): count for code, count in sorted(self.codes.items())},
+            'elapsed': round(self.elapsed, 3),
+            'req_per_sec': round(self.requests / self.elapsed, 1) if self.elapsed else 0.0,
+            'latency_ms': {
+                'p50': round(self.percentile(50) * 1000, 3),
+                'p99': round(self.percentile(99) * 1000, 3),
+                'p999': round(self.percentile(99.9) * 1000, 3),
+            },
+        }
+
+
+async def connection(port, requests, deadline, result):
+    '''
+    Sends requests one after the other on a keep-alive connection until
+    deadline, reconnecting when the server closes the connection
+
+    :param requests: a list of request bytes, sent in turn
+    :param deadline: time.perf_counter() value to stop at
+    :param result: the LoadResult to fill
+    '''
+    writer = None
+    index = 0
+    try:
+        while time.perf_counter() < deadline:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(HOST, port, limit=READ_LIMIT)
+            request = requests[index % len(requests)]
+            index += 1
+            started = time.perf_counter()
+            try:
+                writer.write(request)
+                code, headers, _ = await read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                result.errors += 1
+                writer.close()
+                writer = None
+                continue
+            result.add(code, time.perf_counter() - started)
+            if headers.get('connection') == 'close':
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def slow_connection(port, request, stop, interval):
+    '''
+    Sends request one byte every interval seconds, over and over, keeping
+    a connection of the server busy until stop is set
+    '''
+    while not stop.is_set():
+        try:
+            reader, writer = await asyncio.open_connection(HOST, port, limit=READ_LIMIT)
+        except ConnectionError:
+            await asyncio.sleep(interval)
+            continue
+        try:
+            for index in range(len(request)):
+                if stop.is_set():
+                    break
+                writer.write(request[index:index + 1])
+                await asyncio.sleep(interval)
+            else:
+                await read_response(reader)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # ie. the server gave up waiting with a 408
+        finally:
+            writer.close()
+
+
+async def generate(port, requests, connections, duration, slow_clients=0,
+                   slow_interval=0.1):
+    '''
+    :param port: port of the server on localhost
+    :param requests: a list of request bytes, each connection sends them
+        in turn
+    :param connections: number of connections sending requests
+    :param duration: seconds the load lasts
+    :param slow_clients: number of connections trickling a request in
+        meanwhile, which are not measured
+    :param slow_interval: seconds between two bytes of a slow client
+    :return: a LoadResult
+    '''
+    result = LoadResult()
+    stop = asyncio.Event()
+    slow = [asyncio.ensure_future(slow_connection(port, requests[0], stop, slow_interval))
+            for _ in range(slow_clients)]
+    if slow:
+        await asyncio.sleep(slow_interval * 2)
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*[connection(port, requests, deadline, result)
+                           for _ in range(connections)])
+    result.elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*slow)
+    return result
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+def process_tree(pid):
+    '''
+    :return: pid and the pids of its children, the workers of a pre-forked
+        App, or [pid] without /proc
+    '''
+    children = []
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return [pid]
+    for name in names:
+        if not name.isdigit():
+            continue
+        stat = _read_stat(int(name))
+        if stat is not None and int(stat[1]) == pid:
+            children.append(int(name))
+    return [pid] + sorted(children)
+
+
+def cpu_time(pid):
+    '''
+    :return: user plus system CPU seconds used by pid, None without /proc
+    '''
+    stat = _read_stat(pid)
+    if stat is None:
+        return
+    return (int(stat[11]) + int(stat[12])) / float(CLOCK_TICKS)
+
+
+def memory(pid):
+    '''
+    :return: a (current, peak) tuple of the resident set size of pid in
+        MB, None without /proc
+    '''
+    try:
+        with open('/proc/{0}/status'.format(pid)) as status:
+            values = dict(line.split(':', 1) for line in status if ':' in line)
+    except OSError:
+        return
+    return (int(values['VmRSS'].split()[0]) / 1024.0,
+            int(values['VmHWM'].split()[0]) / 1024.0)
+
+
+def _read_stat(pid):
+    # the fields following the command name, which may contain spaces:
+    # state, ppid, ... utime is the 12th and stime the 13th
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as stat:
+            return stat.read().rpartition(')')[2].split()
+    except OSError:
+        return
+
+
+class ProcessSampler(object):
+    '''
+    CPU usage and memory of the processes serving a benchmark, between
+    start and stop
+    '''
+
+    def __init__(self, pid):
+        '''
+        :param pid: pid of the server, its children are its workers
+        '''
+        self.pid = pid
+        self._cpu = {}
+        self._started = None
+
+    def start(self):
+        self._cpu = {pid: cpu_time(pid) for pid in process_tree(self.pid)}
+        self._started = time.perf_counter()
+
+    def stop(self):
+        '''
+        :return: a list of dicts with the pid, the CPU usage in percent of
+            a core and the current and peak RSS in MB of each process doing
+            some work, the supervisor of pre-forked workers doesn't
+        '''
+        elapsed = time.perf_counter() - self._started
+        workers = []
+        for pid in process_tree(self.pid):
+            used, before = cpu_time(pid), self._cpu.get(pid)
+            rss = memory(pid)
+            if used is None or rss is None:
+                continue
+            cpu = (used - (before or 0.0)) / elapsed * 100
+            workers.append({'pid': pid, 'cpu_percent': round(cpu, 1),
+                            'rss_mb': round(rss[0], 1), 'peak_rss_mb': round(rss[1], 1)})
+        if len(workers) > 1:
+            workers = [worker for worker in workers if worker['pid'] != self.pid]
+        return workers
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/16
+'''
+Compares requests per second with the request metrics disabled, the
+default, and enabled, over pipelined keep-alive connections where the
+per request overhead of the server is the most visible.
+
+    python -m benchmarks.metrics [--requests N] [--concurrency C] [--depth D]
+'''
+import argparse
+import logging
+
+from framework.application import App, Router
+from benchmarks.keep_alive import hello, keep_alive_client, run
+from benchmarks.utils import HOST, free_port, server_process
+
+
+def serve(port, metrics_path, use_protocol):
+    router = Router()
+    router.add_route('/', hello)
+    App(router, host=HOST, port=port, use_protocol=use_protocol,
+        metrics_path=metrics_path, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING).start_server()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=8,
+                        help='number of pipelined requests in flight per connection')
+    args = parser.parse_args()
+
+    for mode, use_protocol in (('streams', False), ('protocol', True)):
+        for name, metrics_path in (('disabled', None), ('enabled', '/metrics')):
+            port = free_port()
+            with server_process(serve, port, metrics_path, use_protocol):
+                run('{0} metrics {1}'.format(mode, name), port, keep_alive_client,
+                    args.requests, args.concurrency, args.depth)
+
+
+if __name__ == '__main__':
+    main()
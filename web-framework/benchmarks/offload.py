@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/18
+'''
+Latency of a trivial route while other clients keep a CPU bound route
+busy, with the CPU bound handler run on the event loop, in the thread
+pool and in the process pool.
+
+    python -m benchmarks.offload [--requests N] [--busy C] [--work W]
+'''
+import argparse
+import asyncio
+import logging
+import time
+
+from framework.application import App, Router
+from benchmarks.keep_alive import hello
+from benchmarks.utils import (HOST, free_port, server_process,
+                              build_request, read_response)
+
+
+def work(request, n):
+    return str(sum(i * i for i in range(n)))
+
+
+async def work_on_loop(request, n):
+    return work(request, n)
+
+
+def serve(port, executor):
+    router = Router()
+    router.add_route('/', hello)
+    if executor is None:
+        router.add_route('/work/{n:int}', work_on_loop)
+    else:
+        router.add_route('/work/{n:int}', work, executor=executor,
+                         max_queue=10 ** 6)
+    App(router, host=HOST, port=port, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING).start_server()
+
+
+async def busy_client(port, work, stop):
+    request = build_request('/work/{0}'.format(work))
+    reader, writer = await asyncio.open_connection(HOST, port)
+    while not stop.is_set():
+        writer.write(request)
+        await read_response(reader)
+    writer.close()
+
+
+async def measure(port, requests, busy, work):
+    stop = asyncio.Event()
+    clients = [asyncio.ensure_future(busy_client(port, work, stop))
+               for _ in range(busy)]
+    await asyncio.sleep(0.5)
+    request = build_request()
+    reader, writer = await asyncio.open_connection(HOST, port)
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        writer.write(request)
+        await read_response(reader)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    stop.set()
+    await asyncio.gather(*clients)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--busy', type=int, default=4,
+                        help='number of clients calling the CPU bound route')
+    parser.add_argument('--work', type=int, default=200000,
+                        help='size of the computation of the CPU bound route')
+    args = parser.parse_args()
+
+    for name, executor in (('on loop', None), ('thread', 'thread'),
+                           ('process', 'process')):
+        port = free_port()
+        with server_process(serve, port, executor):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            latencies = loop.run_until_complete(
+                measure(port, args.requests, args.busy, args.work))
+            loop.close()
+        print('{0:<10} p50 {1:8.2f}ms  p99 {2:8.2f}ms'.format(
+            name, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/19
+'''
+Overloads a server whose handler waits 10ms, as for a database, then
+takes a few milliseconds of CPU with many more clients than it can serve, without limits and with
+max_inflight, and reports the successful requests per second, their
+latency and the requests shed with a 503.
+
+    python -m benchmarks.overload [--clients C] [--duration S] [--work W]
+'''
+import argparse
+import asyncio
+import logging
+import time
+
+from framework.application import App, Router
+from benchmarks.utils import (HOST, free_port, server_process,
+                              build_request, read_response)
+
+
+def serve(port, work, server_options):
+    async def busy(request):
+        await asyncio.sleep(0.01)
+        return str(sum(i * i for i in range(work)))
+
+    router = Router()
+    router.add_route('/', busy)
+    App(router, host=HOST, port=port, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING, **server_options).start_server()
+
+
+async def client(port, deadline, timeout, results):
+    request = build_request()
+    connection = None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(HOST, port)
+            reader, writer = connection
+            writer.write(request)
+            code, headers, _ = await asyncio.wait_for(read_response(reader), timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            results['failed'] += 1
+            connection = None
+            continue
+        if code == 200:
+            results['latencies'].append(time.perf_counter() - start)
+        else:
+            results['shed'] += 1
+            # a well behaved client waits before retrying
+            await asyncio.sleep(int(headers.get('retry-after', 1)))
+        if headers.get('connection') == 'close':
+            writer.close()
+            connection = None
+
+
+async def overload(port, clients, duration, timeout):
+    results = {'latencies': [], 'shed': 0, 'failed': 0}
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[client(port, deadline, timeout, results)
+                           for _ in range(clients)])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--timeout', type=float, default=1,
+                        help='seconds a client waits for a response')
+    parser.add_argument('--work', type=int, default=20000,
+                        help='size of the computation of the handler')
+    args = parser.parse_args()
+
+    for name, options in (('no limits', {}),
+                          ('max_inflight=8', {'max_inflight': 8}),
+                          ('max_connections=32', {'max_connections': 32})):
+        port = free_port()
+        with server_process(serve, port, args.work, options):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            results = loop.run_until_complete(
+                overload(port, args.clients, args.duration, args.timeout))
+            loop.close()
+        latencies = sorted(results['latencies']) or [0]
+        print('{0:<20} {1:8.1f} ok/s  p50 {2:7.1f}ms  p99 {3:7.1f}ms  shed {4:6}  failed {5:6}'.format(
+            name, len(results['latencies']) / args.duration,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            results['shed'], results['failed']))
+
+
+if __name__ == '__main__':
+    main()
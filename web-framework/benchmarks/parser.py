@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/10
+'''
+Parses requests fed in fixed size chunks, the way HTTPConnection receives
+them, with the module level parse_into function and with HTTPParser.
+
+    python -m benchmarks.parser [--chunk-size N] [--rounds N]
+'''
+import argparse
+import time
+
+from framework import http_parser
+from framework.http_utils import Request
+from benchmarks.utils import build_request
+
+
+def scenarios():
+    small = build_request('/welcome/igor?lang=en')
+    headers = {'X-Header-{0}'.format(i): 'v' * 200 for i in range(100)}
+    large_headers = build_request('/', headers=headers)
+    body = b'name=' + b'x' * (1024 * 1024)
+    large_body = build_request('/login', method='POST', body=body, headers={
+        'Content-Type': 'application/x-www-form-urlencoded'})
+    return [('small GET', small),
+            ('100 x 200B headers', large_headers),
+            ('1MB form body', large_body)]
+
+
+def chunked(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def parse_with_function(chunks):
+    request, buffer = Request(), bytearray()
+    for chunk in chunks:
+        buffer.extend(chunk)
+        buffer = http_parser.parse_into(request, buffer)
+    assert request.finished
+
+
+def parse_with_parser(chunks):
+    request, buffer, parser = Request(), bytearray(), http_parser.HTTPParser()
+    for chunk in chunks:
+        buffer.extend(chunk)
+        buffer = parser.parse_into(request, buffer)
+    assert request.finished
+
+
+def measure(fn, chunks, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(chunks)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    print('{0:<20} {1:>16} {2:>16}'.format('scenario', 'parse_into us', 'HTTPParser us'))
+    for name, data in scenarios():
+        chunks = chunked(data, args.chunk_size)
+        print('{0:<20} {1:>16.1f} {2:>16.1f}'.format(
+            name,
+            measure(parse_with_function, chunks, args.rounds),
+            measure(parse_with_parser, chunks, args.rounds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/27
+'''
+Compares requests per second without a profiler, with a profiler
+sampling no request, 1% and every request, over pipelined keep-alive
+connections where the per request overhead of the server is the most
+visible.
+
+    python -m benchmarks.profiling [--requests N] [--concurrency C] [--depth D]
+'''
+import argparse
+import logging
+
+from framework.application import App, Router
+from framework.profiling import Profiler
+from benchmarks.keep_alive import hello, keep_alive_client, run
+from benchmarks.utils import HOST, free_port, server_process
+
+
+def serve(port, sample_rate, use_protocol):
+    router = Router()
+    router.add_route('/', hello)
+    profiler = None if sample_rate is None else Profiler(sample_rate)
+    App(router, host=HOST, port=port, use_protocol=use_protocol, profiler=profiler,
+        max_keep_alive_requests=10 ** 9, log_level=logging.WARNING).start_server()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=8,
+                        help='number of pipelined requests in flight per connection')
+    args = parser.parse_args()
+
+    for mode, use_protocol in (('streams', False), ('protocol', True)):
+        for name, sample_rate in (('no profiler', None), ('0% sampled', 0.0),
+                                  ('1% sampled', 0.01), ('100% sampled', 1.0)):
+            port = free_port()
+            with server_process(serve, port, sample_rate, use_protocol):
+                run('{0} {1}'.format(mode, name), port, keep_alive_client,
+                    args.requests, args.concurrency, args.depth)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/26
+'''
+Requests per second and latency through a reverse proxy route to a local
+stand-in upstream server, with the proxy's HTTPClient opening a
+connection per request and reusing pooled keep-alive connections.
+
+    python -m benchmarks.proxy [--duration S] [--connections C] [--size B]
+'''
+import argparse
+import asyncio
+import logging
+
+from framework.application import App, Router
+from framework.client import HTTPClient
+from framework.http_utils import Response
+from benchmarks.loadgen import generate
+from benchmarks.utils import HOST, free_port, server_process, build_request
+
+
+def upstream(port, size):
+    body = b'x' * size
+
+    async def data(request):
+        return Response(body=body, content_type='application/octet-stream')
+
+    router = Router()
+    router.add_route('/data', data)
+    App(router, host=HOST, port=port, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING).start_server()
+
+
+def proxy(port, upstream_port, keep_alive):
+    client = HTTPClient(max_connections=32, keep_alive=keep_alive)
+
+    async def opened(request):
+        return str(client.connections_opened)
+
+    router = Router()
+    router.add_route('/opened', opened)
+    router.add_proxy('/up', 'http://{0}:{1}'.format(HOST, upstream_port), client)
+    App(router, host=HOST, port=port, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING).start_server()
+
+
+async def connections_opened(port):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(build_request('/opened'))
+    await reader.readuntil(b'\r\n\r\n')
+    opened = await reader.read(100)
+    writer.close()
+    return int(opened)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--size', type=int, default=1024, help='bytes of the upstream responses')
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    requests = [build_request('/up/data')]
+    with server_process(upstream, upstream_port, args.size):
+        for name, keep_alive in (('connection per request', False), ('keep-alive pool', True)):
+            port = free_port()
+            with server_process(proxy, port, upstream_port, keep_alive):
+                result = asyncio.run(generate(port, requests, args.connections, args.duration))
+                opened = asyncio.run(connections_opened(port))
+            summary = result.summary()
+            print('{0:<24} {1:8.1f} req/s  p50 {2:7.2f}ms  p99 {3:7.2f}ms  '
+                  'upstream connections {4}  errors {5}'.format(
+                      name, summary['req_per_sec'], summary['latency_ms']['p50'],
+                      summary['latency_ms']['p99'], opened, summary['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/24
+'''
+Replays a traffic log written by framework.recorder.TrafficRecorder as
+fast as possible, keeping how the requests were split across reads.
+
+In process, the chunks of each connection go through HTTPParser.parse_into
+the way a connection feeds them, and each request through
+Router.get_handler: the time spent in each is reported per request.
+
+Over a socket, each connection is replayed on its own connection to a
+server, --port for one already running, otherwise one started with the
+router. Requests per second and the status codes are reported.
+
+    python -m benchmarks.replay LOG [--router module:name] [--repeat N]
+    python -m benchmarks.replay LOG --socket [--router module:name]
+        [--port P] [--concurrency C]
+
+--router names a Router, or a function returning one, ie.
+'myapp.routes:router'. Without it requests are only parsed in process,
+and a server answering every path is started for --socket.
+'''
+import argparse
+import asyncio
+import contextlib
+import importlib
+import logging
+import time
+
+from framework import http_parser
+from framework.application import App, Router
+from framework.exceptions import NotFoundException, ProtocolException
+from framework.http_utils import Request
+from framework.recorder import read_connections
+from benchmarks.utils import HOST, free_port, server_process, read_response
+
+
+def load_router(name):
+    '''
+    :param name: 'module:attribute' naming a Router or a function returning one
+    :return: a Router
+    '''
+    module_name, _, attribute = name.partition(':')
+    router = getattr(importlib.import_module(module_name), attribute or 'router')
+    return router if isinstance(router, Router) else router()
+
+
+async def ok(request, path=''):
+    return 'ok'
+
+
+def catch_all_router():
+    router = Router()
+    router.add_route('/', ok)
+    router.add_route('/{path:path}', ok)
+    return router
+
+
+class ReplayResult(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.bad_requests = 0
+        self.not_found = 0
+        self.parse_time = 0.0
+        self.route_time = 0.0
+
+
+def replay_connection(chunks, router, result, clock=time.perf_counter):
+    '''
+    Feeds the chunks of a connection through a parser and routes the
+    requests they contain, until the end or a request the server would
+    reject with a 400
+    '''
+    parser = http_parser.HTTPParser()
+    request = Request()
+    buffer = bytearray()
+    for chunk in chunks:
+        started = clock()
+        buffer.extend(chunk)
+        try:
+            buffer = parser.parse_into(request, buffer)
+            while request.finished:
+                result.parse_time += clock() - started
+                result.requests += 1
+                if router is not None:
+                    started = clock()
+                    try:
+                        router.get_handler(request.path)
+                    except NotFoundException:
+                        result.not_found += 1
+                    result.route_time += clock() - started
+                started = clock()
+                request = Request()
+                buffer = parser.parse_into(request, buffer)
+        except ProtocolException:
+            result.bad_requests += 1
+            return
+        result.parse_time += clock() - started
+
+
+def replay_in_process(connections, router, repeat):
+    result = ReplayResult()
+    for _ in range(repeat):
+        for chunks in connections:
+            replay_connection(chunks, router, result)
+    return result
+
+
+def serve(port, router_name):
+    router = load_router(router_name) if router_name else catch_all_router()
+    App(router, host=HOST, port=port, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING).start_server()
+
+
+async def replay_socket_connection(port, chunks, expected, codes):
+    reader, writer = await asyncio.open_connection(HOST, port, limit=2 ** 22)
+
+    async def send():
+        for chunk in chunks:
+            writer.write(chunk)
+            await writer.drain()
+
+    sending = asyncio.ensure_future(send())
+    try:
+        for _ in range(expected):
+            code, headers, _ = await read_response(reader)
+            codes[code] = codes.get(code, 0) + 1
+            if headers.get('connection') == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        codes['closed'] = codes.get('closed', 0) + 1
+    finally:
+        sending.cancel()
+        writer.close()
+
+
+async def replay_socket(port, connections, expected, concurrency):
+    codes = {}
+    pending = list(zip(connections, expected))
+    pending.reverse()
+
+    async def worker():
+        while pending:
+            chunks, count = pending.pop()
+            await replay_socket_connection(port, chunks, count, codes)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return codes
+
+
+def count_requests(chunks):
+    result = ReplayResult()
+    replay_connection(chunks, None, result)
+    # a rejected request still gets a response
+    return result.requests + result.bad_requests
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='a log written by TrafficRecorder')
+    parser.add_argument('--router', help="'module:name' of the Router to replay against")
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='times the log is replayed in process')
+    parser.add_argument('--socket', action='store_true',
+                        help='replay over sockets instead of in process')
+    parser.add_argument('--port', type=int, help='port of a running server for --socket')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='connections replayed at once with --socket')
+    args = parser.parse_args()
+
+    connections = read_connections(args.log)
+    print('{0} connections, {1} chunks, {2} bytes'.format(
+        len(connections), sum(map(len, connections)),
+        sum(len(chunk) for chunks in connections for chunk in chunks)))
+
+    if not args.socket:
+        router = load_router(args.router) if args.router else None
+        started = time.perf_counter()
+        result = replay_in_process(connections, router, args.repeat)
+        elapsed = time.perf_counter() - started
+        requests = result.requests or 1
+        print('{0} requests in {1:.2f}s  {2:.1f} req/s'.format(
+            result.requests, elapsed, result.requests / elapsed))
+        print('parse {0:8.2f}us/request  route {1:8.2f}us/request'.format(
+            result.parse_time / requests * 10 ** 6, result.route_time / requests * 10 ** 6))
+        print('rejected {0}  not found {1}'.format(result.bad_requests, result.not_found))
+        return
+
+    expected = [count_requests(chunks) for chunks in connections]
+    if args.port is None:
+        port = free_port()
+        server = server_process(serve, port, args.router)
+    else:
+        port = args.port
+        server = contextlib.nullcontext()
+    with server:
+        started = time.perf_counter()
+        codes = asyncio.run(replay_socket(port, connections, expected, args.concurrency))
+        elapsed = time.perf_counter() - started
+    responses = sum(count for code, count in codes.items() if code != 'closed')
+    print('{0} responses in {1:.2f}s  {2:.1f} req/s'.format(
+        responses, elapsed, responses / elapsed))
+    print('status codes {0}'.format(
+        ', '.join('{0}: {1}'.format(code, count) for code, count in sorted(codes.items(), key=str))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/9
+'''
+Measures Router.get_handler for growing numbers of routes. The time per
+lookup should stay flat whatever the route count is.
+
+    python -m benchmarks.router [--lookups N]
+'''
+import argparse
+import timeit
+
+from framework.application import Router
+from framework.exceptions import NotFoundException
+
+
+async def handler(request, **kwargs):
+    return ''
+
+
+def build_router(count):
+    router = Router()
+    for i in range(count):
+        router.add_route('/static{0}/page'.format(i), handler)
+        router.add_route('/users{0}/{{name}}/posts/{{post_id:int}}'.format(i), handler)
+    return router
+
+
+def lookup(router, path):
+    try:
+        router.get_handler(path)
+    except NotFoundException:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    print('{0:>7} {1:>12} {2:>12} {3:>12}'.format(
+        'routes', 'first us', 'last us', '404 us'))
+    for count in (10, 100, 1000):
+        router = build_router(count)
+        paths = ('/users0/bob/posts/42',
+                 '/users{0}/bob/posts/42'.format(count - 1),
+                 '/missing/bob/posts/42')
+        timings = [timeit.timeit(lambda: lookup(router, path),
+                                 number=args.lookups) / args.lookups * 1e6
+                   for path in paths]
+        print('{0:>7} {1:>12.2f} {2:>12.2f} {3:>12.2f}'.format(count, *timings))
+
+
+if __name__ == '__main__':
+    main()
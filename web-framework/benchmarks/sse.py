@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/29
+'''
+Server CPU time and delivery time of events pushed to many server-sent
+events subscribers: a StreamingResponse per subscriber reading its own
+asyncio.Queue, each event encoded for every subscriber, against the
+Broadcaster encoding it once and writing it to every transport. The
+events are published one per iteration of the event loop, and in bursts
+the Broadcaster joins into one write per subscriber.
+
+    python -m benchmarks.sse [--clients N] [--events E] [--size B]
+'''
+import argparse
+import asyncio
+import logging
+import time
+
+from framework.application import App, Router
+from framework.http_utils import StreamingResponse
+from framework.sse import Broadcaster, encode_event
+from benchmarks.loadgen import cpu_time
+from benchmarks.utils import HOST, free_port, server_process, build_request, read_response
+
+MAX_QUEUE = 10 ** 6
+
+
+class QueueFanout(object):
+    '''
+    An event stream per subscriber, written as a StreamingResponse from a
+    queue of its own
+    '''
+
+    def __init__(self):
+        self.queues = set()
+
+    async def handler(self, request):
+        queue = asyncio.Queue(MAX_QUEUE)
+
+        async def events():
+            self.queues.add(queue)
+            try:
+                while True:
+                    yield await queue.get()
+            finally:
+                self.queues.discard(queue)
+
+        return StreamingResponse(body=events(), content_type='text/event-stream')
+
+    def publish(self, data, event=None, id=None):
+        for queue in self.queues:
+            queue.put_nowait(encode_event(data, event, id))
+
+
+def serve(port, broadcasting):
+    fanout = Broadcaster(heartbeat=3600, max_queue=MAX_QUEUE) if broadcasting else QueueFanout()
+
+    async def publish(request):
+        count = int(request.query_params['count'][0])
+        data = 'x' * int(request.query_params['size'][0])
+        burst = request.query_params['burst'][0] == '1'
+        for i in range(count):
+            fanout.publish(data, event='update', id=i)
+            if not burst:
+                await asyncio.sleep(0)
+        return 'published'
+
+    router = Router()
+    router.add_route('/events', fanout.handler)
+    router.add_route('/publish', publish)
+    App(router, host=HOST, port=port, log_level=logging.WARNING).start_server()
+
+
+async def subscriber(port, events, subscribed, received):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(build_request('/events'))
+    await reader.readuntil(b'\r\n\r\n')
+    subscribed.release()
+    count, tail = 0, b''
+    while count < events:
+        data = await reader.read(65536)
+        if not data:
+            break
+        data = tail + data
+        count += data.count(b'\n\n')
+        tail = data[-1:]
+        if tail == b'\n' and data.endswith(b'\n\n'):
+            tail = b''
+    received.append(count)
+    writer.close()
+
+
+async def run(port, pid, clients, events, size, burst):
+    subscribed = asyncio.Semaphore(0)
+    received = []
+    tasks = [asyncio.ensure_future(subscriber(port, events, subscribed, received))
+             for _ in range(clients)]
+    for _ in range(clients):
+        await subscribed.acquire()
+    cpu = cpu_time(pid)
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(build_request('/publish?count={0}&size={1}&burst={2}'.format(
+        events, size, int(burst))))
+    await read_response(reader)
+    writer.close()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return elapsed, cpu_time(pid) - cpu, sum(received)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--size', type=int, default=100, help='bytes of data per event')
+    args = parser.parse_args()
+
+    for burst in (False, True):
+        for name, broadcasting in (('queue per subscriber', False), ('broadcaster', True)):
+            port = free_port()
+            with server_process(serve, port, broadcasting) as process:
+                elapsed, cpu, delivered = asyncio.run(
+                    run(port, process.pid, args.clients, args.events, args.size, burst))
+            name = '{0} {1}'.format('burst' if burst else 'spread', name)
+            print('{0:<28} {1} events delivered in {2:6.2f}s  server CPU {3:6.2f}s, '
+                  '{4:5.2f}us per event'.format(name, delivered, elapsed, cpu,
+                                                cpu * 10 ** 6 / max(delivered, 1)))
+
+
+if __name__ == '__main__':
+    main()
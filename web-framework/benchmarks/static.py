@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/21
+'''
+Compares downloading a large file from a handler reading it into a
+Response body and from a Router.add_static route sending it with
+loop.sendfile, with one request per connection in parallel. Also reports
+the peak resident memory of the server process, which grows with the file
+size and the concurrency for the handler and stays flat for the static route.
+
+    python -m benchmarks.static [--size MB] [--requests N] [--concurrency C]
+'''
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from framework.application import App, Router
+from framework.http_utils import Response
+from benchmarks.utils import (HOST, free_port, server_process, build_request,
+                              read_response, report)
+
+FILE_NAME = 'download.bin'
+
+
+def serve(port, directory, use_static):
+    router = Router()
+    if use_static:
+        router.add_static('/files', directory)
+    else:
+        async def download(request, name):
+            with open(os.path.join(directory, name), 'rb') as f:
+                return Response(body=f.read(),
+                                content_type='application/octet-stream')
+        router.add_route('/files/{name:path}', download)
+    App(router, host=HOST, port=port, log_level=logging.WARNING).start_server()
+
+
+async def client(port, count, size):
+    request = build_request('/files/' + FILE_NAME)
+    for _ in range(count):
+        reader, writer = await asyncio.open_connection(HOST, port, limit=2 ** 20)
+        writer.write(request)
+        code, _, body = await read_response(reader)
+        assert code == 200 and len(body) == size, (code, len(body))
+        writer.close()
+
+
+async def clients(port, concurrency, count, size):
+    await asyncio.gather(*[client(port, count, size) for _ in range(concurrency)])
+
+
+def peak_memory(pid):
+    '''
+    :return: the peak resident set size of process pid, in MB
+    '''
+    with open('/proc/{0}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=64, help='file size in MB')
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    size = args.size * 1024 * 1024
+    try:
+        with open(os.path.join(directory, FILE_NAME), 'wb') as f:
+            f.write(os.urandom(size))
+        for name, use_static in (('read into body', False), ('static sendfile', True)):
+            port = free_port()
+            with server_process(serve, port, directory, use_static) as process:
+                per_client = args.requests // args.concurrency
+                started = time.perf_counter()
+                asyncio.run(clients(port, args.concurrency, per_client, size))
+                elapsed = time.perf_counter() - started
+                report(name, per_client * args.concurrency, elapsed)
+                print('{0:<24} {1:8.1f} MB/s  server peak RSS {2:.1f} MB'.format(
+                    '', per_client * args.concurrency * args.size / elapsed,
+                    peak_memory(process.pid)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
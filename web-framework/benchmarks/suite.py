@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/23
+'''
+Benchmark suite of the framework, run entirely on localhost. Each
+scenario starts a server, loads it with keep-alive connections for a
+fixed duration and reports requests per second, p50/p99/p999 latency and
+the CPU usage and memory of each worker.
+
+    python -m benchmarks.suite [--scenario NAME ...] [--duration S]
+        [--connections C] [--workers W] [--protocol] [--json PATH]
+        [--baseline PATH] [--save-baseline PATH] [--tolerance T]
+
+--json writes the results as JSON, '-' for stdout. --save-baseline writes
+them for later runs to compare against with --baseline: a scenario whose
+requests per second dropped, or whose p99 latency grew, by more than
+tolerance (10% by default) is reported as a regression and the exit
+status is 1.
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+
+from framework.application import App, Router
+from framework.http_utils import Response
+from benchmarks.loadgen import ProcessSampler, generate
+from benchmarks.utils import HOST, free_port, server_process, build_request
+
+ROUTE_COUNT = 1000
+LARGE_BODY = 1024 * 1024
+WARMUP = 0.5
+TOLERANCE = 0.1
+
+
+async def hello(request):
+    return 'Hello world'
+
+
+async def user_post(request, user_id, slug):
+    return 'user {0} post {1}'.format(user_id, slug)
+
+
+async def login(request):
+    return '{0}:{1}'.format(request.body['name'][0], request.body['password'][0])
+
+
+async def upload(request):
+    return Response(body='{0} bytes'.format(len(request.body_raw)))
+
+
+async def item(request, item_id):
+    return 'item {0}'.format(item_id)
+
+
+def build_router():
+    router = Router()
+    router.add_route('/', hello)
+    router.add_route('/users/{user_id:int}/posts/{slug}', user_post)
+    router.add_route('/login', login)
+    router.add_route('/upload', upload)
+    for i in range(ROUTE_COUNT):
+        router.add_route('/section{0}/page'.format(i), hello)
+        router.add_route('/section{0}/items/{{item_id:int}}'.format(i), item)
+    return router
+
+
+def serve(port, workers, use_protocol):
+    App(build_router(), host=HOST, port=port, workers=workers,
+        use_protocol=use_protocol, log_level=logging.WARNING).start_server()
+
+
+def form_post():
+    body = b'name=igor&password=secret'
+    return build_request('/login', method='POST', body=body, headers={
+        'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+def large_post():
+    return build_request('/upload', method='POST', body=b'x' * LARGE_BODY,
+                         headers={'Content-Type': 'application/octet-stream'})
+
+
+def many_routes():
+    requests = []
+    for i in range(0, ROUTE_COUNT, 7):
+        requests.append(build_request('/section{0}/page'.format(i)))
+        requests.append(build_request('/section{0}/items/{1}'.format(i, i * 3)))
+    return requests
+
+
+# (name, description, function returning the requests each connection
+# sends in turn, number of slow clients)
+SCENARIOS = [
+    ('plain_get', 'GET of a static route', lambda: [build_request('/')], 0),
+    ('path_params', 'GET of a route with an int and a str parameter',
+     lambda: [build_request('/users/{0}/posts/post-{0}'.format(i)) for i in range(100)], 0),
+    ('form_post', 'urlencoded form POST', lambda: [form_post()], 0),
+    ('large_body', '1MB POST body', lambda: [large_post()], 0),
+    ('many_routes', 'GETs spread over {0} routes'.format(ROUTE_COUNT * 2), many_routes, 0),
+    ('slow_clients', 'GET of a static route while 100 clients trickle requests in',
+     lambda: [build_request('/')], 100),
+]
+
+
+def run_scenario(requests, slow_clients, args):
+    port = free_port()
+    with server_process(serve, port, args.workers, args.protocol) as process:
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(generate(port, requests, args.connections, WARMUP))
+            sampler = ProcessSampler(process.pid)
+            sampler.start()
+            result = loop.run_until_complete(generate(
+                port, requests, args.connections, args.duration, slow_clients))
+            workers = sampler.stop()
+        finally:
+            loop.close()
+    summary = result.summary()
+    summary['workers'] = workers
+    return summary
+
+
+def compare(results, baseline, tolerance):
+    '''
+    :return: a list of (scenario, message, regressed) tuples for the
+        scenarios found in both
+    '''
+    comparisons = []
+    for name, current in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        throughput = _change(before['req_per_sec'], current['req_per_sec'])
+        p99 = _change(before['latency_ms']['p99'], current['latency_ms']['p99'])
+        regressed = throughput < -tolerance or p99 > tolerance
+        comparisons.append((name, 'req/s {0:+.1%}  p99 {1:+.1%}'.format(throughput, p99),
+                            regressed))
+    return comparisons
+
+
+def _change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) / float(before)
+
+
+def environment(args):
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'duration': args.duration,
+        'connections': args.connections,
+        'workers': args.workers,
+        'protocol': args.protocol,
+    }
+
+
+def print_result(name, summary, out):
+    latency = summary['latency_ms']
+    print('{0:<14} {1:>10.1f} req/s  p50 {2:7.2f}ms  p99 {3:7.2f}ms  p999 {4:7.2f}ms  '
+          'errors {5}'.format(name, summary['req_per_sec'], latency['p50'],
+                              latency['p99'], latency['p999'], summary['errors']),
+          file=out)
+    for worker in summary['workers']:
+        print('{0:<14} pid {1:<8} cpu {2:6.1f}%  rss {3:7.1f}MB  peak {4:7.1f}MB'.format(
+            '', worker['pid'], worker['cpu_percent'], worker['rss_mb'],
+            worker['peak_rss_mb']), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=[s[0] for s in SCENARIOS],
+                        help='scenario to run, can be repeated, all by default')
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help='seconds each scenario lasts')
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--protocol', action='store_true',
+                        help='serve with use_protocol=True')
+    parser.add_argument('--json', metavar='PATH', help="write the results as JSON, '-' for stdout")
+    parser.add_argument('--baseline', metavar='PATH', help='JSON results to compare against')
+    parser.add_argument('--save-baseline', metavar='PATH', help='write the results as a baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    log = sys.stderr if args.json == '-' else sys.stdout
+    results = {'environment': environment(args), 'scenarios': {}}
+    for name, description, requests, slow_clients in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        summary = run_scenario(requests(), slow_clients, args)
+        summary['description'] = description
+        results['scenarios'][name] = summary
+        print_result(name, summary, log)
+
+    for path in (args.json, args.save_baseline):
+        if path == '-':
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            print()
+        elif path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = 0
+        print('compared to {0} ({1})'.format(
+            args.baseline, baseline.get('environment', {}).get('date')), file=log)
+        for name, message, regressed in compare(results, baseline, args.tolerance):
+            regressions += regressed
+            print('{0:<14} {1}{2}'.format(name, message, '  REGRESSION' if regressed else ''),
+                  file=log)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/28
+'''
+Compares requests per second of a server listening on a Unix domain
+socket against TCP loopback, for a connection per request, keep-alive
+and pipelined keep-alive connections, with streams and HTTPProtocol.
+
+    python -m benchmarks.unix_socket [--requests N] [--concurrency C] [--depth D]
+'''
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import tempfile
+import time
+
+from framework.application import App, Router
+from benchmarks.keep_alive import hello
+from benchmarks.utils import (HOST, free_port, server_process,
+                              build_request, read_response, report)
+
+
+def serve(address, use_protocol):
+    router = Router()
+    router.add_route('/', hello)
+    if isinstance(address, str):
+        options = {'port': None, 'unix_path': address}
+    else:
+        options = {'host': HOST, 'port': address}
+    App(router, use_protocol=use_protocol, max_keep_alive_requests=10 ** 9,
+        log_level=logging.WARNING, **options).start_server()
+
+
+def connector(address):
+    '''
+    :return: a function opening a connection to address, a port or a path
+    '''
+    if isinstance(address, str):
+        return functools.partial(asyncio.open_unix_connection, address)
+    return functools.partial(asyncio.open_connection, HOST, address)
+
+
+async def one_shot_client(connect, count):
+    request = build_request(headers={'Connection': 'close'})
+    for _ in range(count):
+        reader, writer = await connect()
+        writer.write(request)
+        await read_response(reader)
+        writer.close()
+
+
+async def keep_alive_client(connect, count, depth=1):
+    request = build_request()
+    reader, writer = await connect()
+    done = 0
+    while done < count:
+        batch = min(depth, count - done)
+        writer.write(request * batch)
+        for _ in range(batch):
+            await read_response(reader)
+            done += 1
+    writer.close()
+
+
+def run(name, address, client, requests, concurrency, *args):
+    per_client = requests // concurrency
+    connect = connector(address)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    start = time.perf_counter()
+    loop.run_until_complete(asyncio.gather(
+        *[client(connect, per_client, *args) for _ in range(concurrency)]))
+    report(name, per_client * concurrency, time.perf_counter() - start)
+    loop.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=8,
+                        help='number of pipelined requests in flight per connection')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'server.sock')
+        for mode, use_protocol in (('streams', False), ('protocol', True)):
+            for transport, address in (('tcp', free_port()), ('unix', path)):
+                name = '{0} {1}'.format(mode, transport)
+                with server_process(serve, address, use_protocol):
+                    run(name + ' one-shot', address, one_shot_client,
+                        args.requests, args.concurrency)
+                    run(name + ' keep-alive', address, keep_alive_client,
+                        args.requests, args.concurrency)
+                    run(name + ' pipelined', address, keep_alive_client,
+                        args.requests, args.concurrency, args.depth)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/8
+'''
+Helpers shared by the benchmark scripts: running a server in a child
+process and talking raw HTTP/1.1 to it.
+'''
+import asyncio
+import contextlib
+import multiprocessing
+import socket
+import time
+
+HOST = '127.0.0.1'
+
+
+def free_port(host=HOST):
+    '''
+    :return: a TCP port nobody is listening on right now
+    '''
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, host=HOST, timeout=10):
+    '''
+    :param port: a TCP port, or the path of a Unix domain socket
+    '''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if isinstance(port, str):
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.settimeout(1)
+                    sock.connect(port)
+            else:
+                socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Server on {0}:{1} did not start'.format(host, port))
+
+
+def _bootstrap(target, port, *args):
+    # a forked child must not reuse the event loop of its parent
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    target(port, *args)
+
+
+@contextlib.contextmanager
+def server_process(target, port, *args):
+    '''
+    Runs target(port, *args) in a child process for the duration of the
+    with block. target is expected to block serving on port, a TCP port
+    or the path of a Unix domain socket.
+    '''
+    # not a daemon, a daemon process can't start the process pool
+    process = multiprocessing.Process(target=_bootstrap,
+                                      args=(target, port) + args)
+    process.start()
+    try:
+        wait_for_port(port)
+        yield process
+    finally:
+        process.terminate()
+        process.join()
+
+
+def build_request(path='/', method='GET', body=b'', headers=None):
+    '''
+    :return: the bytes of an HTTP/1.1 request
+    '''
+    lines = ['{0} {1} HTTP/1.1'.format(method, path), 'Host: ' + HOST]
+    headers = dict(headers or {})
+    if body:
+        headers.setdefault('Content-Length', len(body))
+    lines.extend('{0}: {1}'.format(k, v) for k, v in headers.items())
+    return '\r\n'.join(lines).encode('utf8') + b'\r\n\r\n' + body
+
+
+async def read_response(reader):
+    '''
+    Reads one response off an asyncio.StreamReader
+
+    :return: a tuple of status code, dict of lower-cased headers and body
+        bytes, a chunked body is decoded
+    '''
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    code = int(lines[0].split(' ')[1])
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding') == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+            if not size:
+                return code, headers, b''.join(chunks)
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return code, headers, body
+
+
+def report(name, requests, elapsed):
+    print('{0:<24} {1:>8} requests in {2:6.2f}s  {3:>10.1f} req/s'.format(
+        name, requests, elapsed, requests / elapsed))
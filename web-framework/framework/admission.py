@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/19
+'''
+Per client rate limiting for HTTPServer
+'''
+import collections
+import time
+
+MAX_CLIENTS = 65536
+
+
+class TokenBuckets(object):
+    '''
+    One token bucket per client: a client may send 'burst' requests at
+    once, then 'rate' requests per second.
+
+    Buckets are (tokens, timestamp) tuples in an OrderedDict kept in order
+    of last use. A bucket left alone for burst / rate seconds is full again,
+    the same as no bucket at all, so it is dropped. When there are more
+    than max_clients buckets the least recently used are dropped too.
+    '''
+
+    def __init__(self, rate, burst=None, max_clients=MAX_CLIENTS, clock=time.monotonic):
+        '''
+        :param rate: requests per second allowed to each client
+        :param burst: size of the buckets, defaults to rate
+        :param max_clients: number of buckets kept at most
+        :param clock: function returning the current time in seconds
+        '''
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.max_clients = max_clients
+        self.clock = clock
+        self._buckets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, client):
+        '''
+        Takes a token from the bucket of client
+
+        :param client: a hashable identifying the client, ie. its IP
+        :return: 0 when a token was taken, otherwise the seconds until the
+            next token
+        '''
+        now = self.clock()
+        bucket = self._buckets.pop(client, None)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[client] = (tokens, now)
+        self._expire(now)
+        return wait
+
+    def _expire(self, now):
+        refill = self.burst / self.rate
+        buckets = self._buckets
+        while buckets:
+            client, (tokens, stamp) = next(iter(buckets.items()))
+            if now - stamp < refill and len(buckets) <= self.max_clients:
+                return
+            del buckets[client]
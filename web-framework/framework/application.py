@@ -2,12 +2,27 @@
 # Project : web-framework
 # Created by igor on 16/9/24
 import asyncio
+import functools
 import logging
+import multiprocessing
+import os
 import re
+import signal
+import socket
+import stat
+import time
 
-from framework.exceptions import DiyFrameworkException, NotFoundException, DuplicateRoute
+from framework.exceptions import (DiyFrameworkException, NotFoundException,
+                                  DuplicateRoute, InvalidRoute)
 from framework import http_parser
+from framework.batching import MicroBatcher
+from framework.client import ReverseProxy
+from framework.cache import CachePolicy, ResponseCache
 from framework.http_server import HTTPServer
+from framework.metrics import Metrics
+from framework.offload import Executors, Offload, MAX_QUEUE
+from framework.profiling import Profiler
+from framework.static import StaticFiles
 
 logger = logging.getLogger(__name__)
 basic_logger_config = {
@@ -18,10 +33,25 @@ basic_logger_config = {
 
 logging.basicConfig(**basic_logger_config)
 
+DRAIN_TIMEOUT = 10
+COUNTER_INTERVAL = 1
+BACKLOG = 100
+
 
 class App(object):
     '''
     Contains the configuration needed to handle HTTP requests.
+
+    With workers > 1 the process becomes a supervisor that forks that many
+    worker processes. Each worker runs its own event loop and binds its own
+    socket to the same port through SO_REUSEPORT, so the kernel spreads
+    connections over them. Crashed workers are restarted, SIGTERM/SIGINT are
+    forwarded to the workers so they drain gracefully.
+
+    Besides host:port, or instead of it when port is None, the App can
+    listen on a Unix domain socket and on sockets inherited from its
+    parent, all served by the same loop. These sockets are opened before
+    forking and shared by the workers, which accept from them in turn.
     '''
 
     def __init__(self,
@@ -29,24 +59,72 @@ class App(object):
                  host='127.0.0.1',
                  port='8080',
                  log_level=logging.INFO,
-                 http_parser=http_parser):
+                 http_parser=http_parser,
+                 workers=1,
+                 drain_timeout=DRAIN_TIMEOUT,
+                 use_protocol=False,
+                 metrics_path=None,
+                 profile_path=None,
+                 unix_path=None,
+                 fds=(),
+                 **server_options):
         '''
 
         :param router:a collection of routes that implement the 'get_handler' interface
         :param host: a string that represents and ipv4 address associated
             with the interface that will listen for incoming connections
-        :param port: an int that represents the port on which to listen to
+        :param port: an int that represents the port on which to listen to,
+            None to not listen on TCP
         :param log_level: logging level
-        :param http_parser: an object that implement 'parse_into' interface.
+        :param http_parser: an object that exposes 'HTTPParser', a factory of
+            objects implementing the 'parse_into' interface.
             Responsible for parsing bytes into Requests object
+        :param workers: number of worker processes, 1 serves from this process
+        :param drain_timeout: seconds in-flight requests get to finish on SIGTERM
+        :param use_protocol: serve connections with HTTPProtocol on
+            loop.create_server instead of asyncio.start_server streams
+        :param metrics_path: when set, request metrics are collected and
+            served on this route in the Prometheus text format
+        :param profile_path: when set, a sample of the requests is profiled,
+            by the Profiler given as the 'profiler' server option or one
+            with the default sample rate, and the profiles are served on
+            this route. Keep it away from the public.
+        :param unix_path: path of a Unix domain socket to listen on, a
+            stale socket file left there is replaced. The file is removed
+            when the server stops.
+        :param fds: file descriptors of listening stream sockets opened by
+            the parent process or a supervisor, ie. systemd's from 3
+        :param server_options: passed to HTTPServer, ie. keep_alive,
+            keep_alive_timeout or max_keep_alive_requests
         '''
         self.router = router
         self.http_parser = http_parser
         self.host = host
         self.port = port
+        self.unix_path = unix_path
+        self.fds = list(fds)
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.use_protocol = use_protocol
+        self.server_options = server_options
+        self.metrics = server_options.get('metrics')
+        if metrics_path is not None:
+            if self.metrics is None:
+                self.metrics = server_options['metrics'] = Metrics()
+            router.add_route(metrics_path, self.metrics.handler)
+        self.profiler = server_options.get('profiler')
+        if profile_path is not None:
+            if self.profiler is None:
+                self.profiler = server_options['profiler'] = Profiler()
+            router.add_route(profile_path, self.profiler.handler)
         self._server = None
-        self._connection_handler = None
+        self._sockets = []
+        self._listeners = []
         self._loop = None
+        self._worker_pids = {}
+        self._request_counts = None
+        self._retired_requests = 0
+        self._stopping = False
 
         logger.setLevel(log_level)
 
@@ -55,38 +133,214 @@ class App(object):
         Starts listening asynchronously for TCP connection on a sockets and
         passes each connection to the HTTPServer.handle_connection method
         '''
-        if not self._server:
-            self._loop = asyncio.get_event_loop()
-            self._server = HTTPServer(self.router, self.http_parser, self._loop)
-            self._connection_handler = asyncio.start_server(
-                self._server.handle_connection,
-                host=self.host,
-                port=self.port,
-                reuse_address=True,
-                reuse_port=True,
-                loop=self._loop)
-
-            logger.info("Starting server on {0}:{1}".format(
-                self.host, self.port))
-            self._loop.run_until_complete(self._connection_handler)
+        if self._server or self._worker_pids:
+            logger.info('Server already started - {0}'.format(self))
+            return
+        self._sockets = self._open_sockets()
+        try:
+            if self.workers > 1:
+                self._supervise()
+            else:
+                self._serve()
+        finally:
+            self._remove_unix_socket()
+
+    def _serve(self, worker=None):
+        '''
+        Runs the event loop of this process until it is interrupted or
+        drained after a SIGTERM
+
+        :param worker: index of the worker process, None when not pre-forked
+        '''
+        self._loop = asyncio.get_event_loop()
+        self._server = HTTPServer(self.router, self.http_parser, self._loop,
+                                  **self.server_options)
+        logger.info("Starting server on {0}{1}".format(
+            self.addresses(), '' if worker is None else ' (worker {0})'.format(worker)))
+        self._listeners = [self._loop.run_until_complete(listener)
+                           for listener in self._start_listeners()]
+        self._loop.add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.ensure_future(self.shutdown()))
+        if self.profiler is not None:
+            self._loop.add_signal_handler(signal.SIGUSR2, self._dump_profiles)
+        if worker is not None:
+            self._publish_request_count(worker)
+
+        try:
+            self._loop.run_forever()
+        except KeyboardInterrupt:
+            logger.info('Got signal, killing server')
+        except DiyFrameworkException as e:
+            logger.error('Critical framework failure:')
+            logger.error(e.__traceback__)
+        finally:
+            if worker is not None:
+                self._request_counts[worker] = self._server.requests_served
+            executors = getattr(self.router, 'executors', None)
+            if executors is not None:
+                executors.shutdown()
+            recorder = self.server_options.get('recorder')
+            if recorder is not None:
+                recorder.close()
+            self._loop.close()
+
+    async def shutdown(self):
+        '''
+        Stops accepting connections, lets the in-flight requests finish
+        within drain_timeout and stops the loop
+        '''
+        logger.info('Draining connections')
+        for listener in self._listeners:
+            listener.close()
+        await self._server.drain(self.drain_timeout)
+        self._loop.stop()
 
+    def _open_sockets(self):
+        '''
+        Opens the listening sockets shared by the workers: a Unix domain
+        socket can't be bound by each worker like a SO_REUSEPORT port
+        :return: a list of sockets
+        '''
+        sockets = [socket.socket(fileno=fd) for fd in self.fds]
+        if self.unix_path is not None:
             try:
-                self._loop.run_forever()
-            except KeyboardInterrupt:
-                logger.info('Got signal, killing server')
-            except DiyFrameworkException as e:
-                logger.error('Critical framework failure:')
-                logger.error(e.__traceback__)
-            finally:
-                self._loop.close()
+                if stat.S_ISSOCK(os.stat(self.unix_path).st_mode):
+                    os.remove(self.unix_path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.unix_path)
+            sock.listen(BACKLOG)
+            sockets.append(sock)
+        if not sockets and self.port is None:
+            raise DiyFrameworkException('Nothing to listen on, set a port, a unix_path or fds')
+        return sockets
+
+    def _start_listeners(self):
+        '''
+        :return: the coroutines starting to serve every listening address
+        '''
+        server = self._server
+        if self.use_protocol:
+            tcp = functools.partial(self._loop.create_server, server.protocol_factory)
+            unix = functools.partial(self._loop.create_unix_server, server.protocol_factory)
         else:
-            logger.info('Server already started - {0}'.format(self))
+            tcp = functools.partial(asyncio.start_server, server.handle_connection)
+            unix = functools.partial(asyncio.start_unix_server, server.handle_connection)
+        listeners = []
+        if self.port is not None:
+            listeners.append(tcp(host=self.host, port=self.port,
+                                 reuse_address=True, reuse_port=True))
+        for sock in self._sockets:
+            listeners.append((unix if sock.family == socket.AF_UNIX else tcp)(sock=sock))
+        return listeners
+
+    def _remove_unix_socket(self):
+        # the workers leave with os._exit, only the process that bound it gets here
+        if self.unix_path is not None:
+            try:
+                os.remove(self.unix_path)
+            except FileNotFoundError:
+                pass
+
+    def addresses(self):
+        '''
+        :return: the addresses listened on, ie. '127.0.0.1:8080, unix:/run/app.sock, fd 3'
+        '''
+        addresses = []
+        if self.port is not None:
+            addresses.append('{0}:{1}'.format(self.host, self.port))
+        addresses.extend('fd {0}'.format(fd) for fd in self.fds)
+        if self.unix_path is not None:
+            addresses.append('unix:{0}'.format(self.unix_path))
+        return ', '.join(addresses)
+
+    def _dump_profiles(self):
+        for path in self.profiler.dump():
+            logger.info('Profile written to {0}'.format(path))
+
+    def _publish_request_count(self, worker):
+        self._request_counts[worker] = self._server.requests_served
+        self._loop.call_later(COUNTER_INTERVAL, self._publish_request_count, worker)
+
+    def _supervise(self):
+        '''
+        Forks the workers and restarts those that die until a SIGTERM or
+        SIGINT is received, which is forwarded to the workers.
+        '''
+        self._request_counts = multiprocessing.Array('Q', self.workers, lock=False)
+        signal.signal(signal.SIGTERM, self._stop_workers)
+        signal.signal(signal.SIGINT, self._stop_workers)
+        if self.profiler is not None:
+            signal.signal(signal.SIGUSR2, self._forward_signal)
+        for worker in range(self.workers):
+            self._spawn_worker(worker)
+
+        while self._worker_pids:
+            pid, status = os.wait()
+            worker, started = self._worker_pids.pop(pid)
+            if self._stopping:
+                continue
+            logger.error('Worker {0} (pid {1}) died with status {2}, restarting'.format(
+                worker, pid, status))
+            self._retired_requests += self._request_counts[worker]
+            self._request_counts[worker] = 0
+            if time.time() - started < 1:
+                time.sleep(1)  # don't spin on a worker that crashes at startup
+            self._spawn_worker(worker)
+        logger.info('All workers stopped, {0} requests served'.format(
+            self.requests_served()))
+
+    def _spawn_worker(self, worker):
+        pid = os.fork()
+        if pid:
+            self._worker_pids[pid] = (worker, time.time())
+            return
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Ctrl-C reaches the whole process group, the supervisor forwards it
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self._worker_pids = {}
+            self._serve(worker)
+            status = 0
+        except Exception:
+            logger.exception('Worker {0} failed'.format(worker))
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def _forward_signal(self, signum, frame):
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _stop_workers(self, signum, frame):
+        if not self._stopping:
+            logger.info('Got signal, stopping workers')
+        self._stopping = True
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def requests_served(self):
+        '''
+        :return: the number of requests served by this process, or by all
+            the workers, past and present, of a supervisor
+        '''
+        if self._request_counts is not None:
+            return self._retired_requests + sum(self._request_counts)
+        return self._server.requests_served if self._server else 0
 
     def __repr__(self):
         cls = self.__class__
-        if self._connection_handler:
-            return '{0} - Listening on: {1}:{2}'.format(
-                cls, self.host, self.port)
+        if self._listeners or self._worker_pids:
+            return '{0} - Listening on: {1}'.format(cls, self.addresses())
         else:
             return '{0} - Not started'.format(cls)
 
@@ -97,41 +351,291 @@ class HandleWrapper(object):
     argument and route defined parameters as kwargs
     '''
 
-    def __init__(self, handler, path_params):
+    __slots__ = ('handler', 'path_params', 'cache', 'cache_policy', 'stream_body',
+                 'max_body_size', 'route', 'offload', 'executors')
+
+    def __init__(self, handler, path_params, cache=None, cache_policy=None,
+                 stream_body=False, max_body_size=None, route=None,
+                 offload=None, executors=None):
+        '''
+        :param cache: a ResponseCache used when cache_policy is set
+        :param cache_policy: the CachePolicy of the route, if it is cached
+        :param stream_body: whether the handler reads the body from
+            request.body_stream as it arrives
+        :param max_body_size: body size limit of the route, None for the
+            server's limit
+        :param route: the route that matched, labels the request metrics
+        :param offload: the Offload running a synchronous handler in an
+            executor, None for an async handler
+        :param executors: the Executors used by offload
+        '''
         self.handler = handler
         self.path_params = path_params
-        self.request = None
+        self.cache = cache
+        self.cache_policy = cache_policy
+        self.stream_body = stream_body
+        self.max_body_size = max_body_size
+        self.route = route
+        self.offload = offload
+        self.executors = executors
 
     async def handle(self, request):
-        return await self.handler(request, **self.path_params)
+        if self.cache_policy is None or request.method != 'GET':
+            return await self.call(request)
+        return await self.cache.fetch(
+            self.cache_policy.key(request),
+            lambda: self.call(request),
+            self.cache_policy.ttl)
+
+    def call(self, request):
+        '''
+        :return: an awaitable of the result of the handler
+        '''
+        if self.offload is None:
+            return self.handler(request, **self.path_params)
+        return self.offload.call(self.executors, self.handler, request,
+                                 self.path_params)
+
+
+class RouteSegment(object):
+    '''
+    A dynamic path segment, ie. '{name}', '{id:int}' or 'page-{number:int}'.
+    The segment is matched with a regular expression and every captured
+    parameter is converted according to its type.
+    '''
+
+    def __init__(self, spec, converters):
+        '''
+        :param spec: the segment of the route as written by the user
+        :param converters: a dict of type name:(regexp string, function)
+        '''
+        self.spec = spec
+        self.converters = {}
+        self.greedy = False
+
+        def named_groups(matchobj):
+            name, type_name = matchobj.group(1), matchobj.group(2) or 'str'
+            if type_name not in converters:
+                raise InvalidRoute(
+                    'Unknown type "{0}" for parameter "{1}"'.format(type_name, name))
+            regexp, self.converters[name] = converters[type_name]
+            self.greedy = self.greedy or type_name == 'path'
+            return '(?P<{0}>{1})'.format(name, regexp)
+
+        parts = re.split(r'({[a-zA-Z0-9_-]+(?::[a-zA-Z0-9_]+)?})', spec)
+        re_str = ''.join(
+            re.sub(r'{([a-zA-Z0-9_-]+)(?::([a-zA-Z0-9_]+))?}', named_groups, part)
+            if i % 2 else re.escape(part)
+            for i, part in enumerate(parts))
+        self.regexp = re.compile(re_str)
+
+    def match(self, segment):
+        '''
+        :param segment: a part of a URL path
+        :return: a dict of param:value pairs or None if segment doesn't match
+        '''
+        match = self.regexp.fullmatch(segment)
+        if match is None:
+            return
+        try:
+            return {name: self.converters[name](value)
+                    for name, value in match.groupdict().items()}
+        except ValueError:
+            return
+
+
+class RouteNode(object):
+    '''
+    A node of the routing tree. Static children are kept in a dict keyed by
+    path segment, dynamic children are tried in the order they were added.
+    '''
+
+    def __init__(self):
+        self.static = {}
+        self.dynamic = []
+        self.handler = None
+        self.cache_policy = None
+        self.stream_body = False
+        self.max_body_size = None
+        self.route = None
+        self.offload = None
+        # HandleWrapper shared by the requests, when the route has no
+        # path parameters
+        self.wrapper = None
+
+    def get_dynamic(self, spec):
+        for segment, child in self.dynamic:
+            if segment.spec == spec:
+                return child
 
 
 class Router(object):
     '''
     Container used to add and match a group of routes.
+
+    Routes are stored in a tree with one level per path segment, so
+    finding a handler costs a dict lookup per segment and doesn't grow
+    with the number of routes. Static segments take precedence over
+    dynamic ones.
     '''
 
-    def __init__(self):
+    converters = {
+        'str': (r'[a-zA-Z0-9_-]+', str),
+        'int': (r'[0-9]+', int),
+        'path': (r'.*', str),
+    }
+
+    def __init__(self, cache=None, executors=None):
+        '''
+        :param cache: the ResponseCache shared by the cached routes, one with
+            the default limits is created for the first cached route if None
+        :param executors: the Executors running the synchronous handlers, one
+            with the default pool sizes is created if None
+        '''
+        # compiled regexp of every route:handler, as in the first versions
         self.routes = {}
+        self.cache = cache
+        self.executors = executors or Executors()
+        self._root = RouteNode()
+        # (compiled regexp, RouteNode) of the routes added with regexp=True
+        self._regexp_routes = []
 
     def add_routes(self, routes):
         for route, fn in routes.items():
             self.add_route(route, fn)
 
-    def add_route(self, path, handler):
+    def add_route(self, path, handler, cache=None, stream_body=False,
+                  max_body_size=None, executor=None, concurrency=None,
+                  max_queue=MAX_QUEUE, regexp=False):
         '''
         Creates a path:function pair for later retrieval by path.The
-        path is turned into a regular expression.
+        path is split into segments and inserted in the routing tree.
+        '{name}' captures a parameter, '{name:int}' captures and
+        converts it, '{name:path}' captures the rest of the path.
 
         :param path: A string that matches a URL path
         :param handler: An async function that accepts a request and
             return a string or Response object.
+        :param cache: a CachePolicy to cache the responses to GET requests,
+            True for the default policy
+        :param stream_body: when True the body isn't buffered, the handler
+            reads it from request.body_stream, a RequestBody
+        :param max_body_size: requests with a larger body are answered with
+            a 413 before it is read, overrides HTTPServer.max_body_size
+        :param executor: 'thread' when handler is a blocking function run
+            in the thread pool, 'process' when it is a CPU bound function
+            run in the process pool with a snapshot of the request
+        :param concurrency: calls of an executor handler running at once,
+            defaults to the size of its pool
+        :param max_queue: calls of an executor handler waiting for their
+            turn, the following requests get a 503
+        :param regexp: when True, path is a regular expression matched
+            against the whole URL path, where '{name}' captures a
+            parameter, as routes were before the tree. Such routes are
+            tried one after the other when no route of the tree matches.
+            Otherwise the text outside the parameters is matched literally.
         '''
-        compiled_route = self.__class__.build_route_regexp(path)
-        if compiled_route not in self.routes:
-            self.routes[compiled_route] = handler
+        if executor is not None and stream_body:
+            raise InvalidRoute('A handler run in an executor can not stream the body')
+        if regexp:
+            compiled_route = self.__class__.build_route_regexp(path)
+            if compiled_route in self.routes:
+                raise DuplicateRoute
+            node = RouteNode()
+            self._regexp_routes.append((compiled_route, node))
         else:
-            raise DuplicateRoute
+            node, compiled_route = self._insert(path)
+            if compiled_route in self.routes:
+                raise DuplicateRoute
+        node.handler = handler
+        node.stream_body = stream_body
+        node.max_body_size = max_body_size
+        node.route = path
+        node.wrapper = None
+        if executor is not None:
+            node.offload = Offload(executor, concurrency, max_queue)
+        if cache:
+            node.cache_policy = CachePolicy() if cache is True else cache
+            if self.cache is None:
+                self.cache = ResponseCache()
+        self.routes[compiled_route] = handler
+
+    def _insert(self, path):
+        '''
+        Adds the segments of path to the tree
+        :return: the node of the route and a compiled regexp matching the
+            same URL paths
+        '''
+        node = self._root
+        parts = []
+        segments = self.__class__.split_path(path)
+        for index, spec in enumerate(segments):
+            if '{' not in spec:
+                node = node.static.setdefault(spec, RouteNode())
+                parts.append(re.escape(spec))
+                continue
+            segment = RouteSegment(spec, self.converters)
+            if segment.greedy and index != len(segments) - 1:
+                raise InvalidRoute('A path parameter must be the last segment')
+            parts.append(segment.regexp.pattern)
+            child = node.get_dynamic(spec)
+            if child is None:
+                child = RouteNode()
+                node.dynamic.append((segment, child))
+            node = child
+        return node, re.compile('^{0}$'.format('/'.join(parts)))
+
+    def add_static(self, prefix, directory, **options):
+        '''
+        Serves the files under directory at prefix, ie.
+        add_static('/static', 'public') serves public/css/site.css at
+        /static/css/site.css
+
+        :param prefix: URL path the files are served under
+        :param directory: path of the directory served
+        :param options: passed to StaticFiles: max_files, check_interval,
+            max_age and index
+        :return: the StaticFiles handling the route
+        '''
+        static = StaticFiles(directory, **options)
+        self.add_route(prefix.rstrip('/') + '/{path:path}', static.handler)
+        return static
+
+    def add_batched(self, path, predict, **options):
+        '''
+        Adds a route whose concurrent requests are answered in batches,
+        with one call of predict(inputs) per batch in an executor, ie.
+        add_batched('/predict', lambda rows: model.predict(np.array(rows)).tolist())
+
+        :param path: A string that matches a URL path
+        :param predict: a function taking a list of inputs, the decoded
+            requests, and returning as many results
+        :param options: passed to MicroBatcher: max_batch_size, max_wait,
+            executor, concurrency, max_queue, decode and encode
+        :return: the MicroBatcher handling the route
+        '''
+        batcher = MicroBatcher(predict, self.executors, **options)
+        self.add_route(path, batcher.handler)
+        return batcher
+
+    def add_proxy(self, prefix, upstream, client=None):
+        '''
+        Forwards the requests under prefix to an upstream server and
+        streams its responses back, ie. add_proxy('/api', 'http://127.0.0.1:8001')
+        forwards /api/users/1 to http://127.0.0.1:8001/users/1
+
+        :param prefix: URL path of the requests forwarded
+        :param upstream: URL the rest of the path is appended to
+        :param client: the framework.client.HTTPClient sending the requests,
+            one with the default limits if None. Upstream failures get a 502
+            and timeouts a 504.
+        :return: the ReverseProxy handling the route
+        '''
+        proxy = ReverseProxy(upstream, client)
+        prefix = prefix.rstrip('/')
+        self.add_route(prefix or '/', proxy.handler)
+        self.add_route(prefix + '/{path:path}', proxy.handler)
+        return proxy
 
     def get_handler(self, path):
         '''
@@ -141,14 +645,66 @@ class Router(object):
         :return: an function that accepts a request and returns a string or
             Response object
         '''
-        logging.debug("Getting handler for: {0}".format(path))
-        for route, handler in self.routes.items():
-            path_params = self.__class__.match_path(route, path)
-            if path_params is not None:
-                logger.debug('Got handler for: {0}'.format(path))
-                wrapped_handler = HandleWrapper(handler, path_params)
-                return wrapped_handler
-        raise NotFoundException()
+        path_params = {}
+        node = self._match(self._root, self.__class__.split_path(path),
+                           0, path_params)
+        if node is None:
+            for route, candidate in self._regexp_routes:
+                params = self.__class__.match_path(route, path)
+                if params is not None:
+                    node, path_params = candidate, params
+                    break
+            else:
+                raise NotFoundException()
+        if path_params:
+            return self._wrap(node, path_params)
+        if node.wrapper is None:
+            node.wrapper = self._wrap(node, path_params)
+        return node.wrapper
+
+    def _wrap(self, node, path_params):
+        return HandleWrapper(node.handler, path_params,
+                             self.cache, node.cache_policy,
+                             node.stream_body, node.max_body_size,
+                             node.route, node.offload, self.executors)
+
+    def _match(self, node, segments, index, path_params):
+        '''
+        Walks down the tree from node, backtracking into dynamic children
+        when a static branch leads nowhere.
+
+        :return: the node holding the handler or None, path_params is
+            filled in place
+        '''
+        if index == len(segments):
+            return node if node.handler is not None else None
+        child = node.static.get(segments[index])
+        if child is not None:
+            found = self._match(child, segments, index + 1, path_params)
+            if found is not None:
+                return found
+        for segment, child in node.dynamic:
+            if segment.greedy:
+                params = segment.match('/'.join(segments[index:]))
+                if params is not None and child.handler is not None:
+                    path_params.update(params)
+                    return child
+                continue
+            params = segment.match(segments[index])
+            if params is None:
+                continue
+            found = self._match(child, segments, index + 1, path_params)
+            if found is not None:
+                path_params.update(params)
+                return found
+
+    @classmethod
+    def split_path(cls, path):
+        '''
+        :param path: a URL path or a route
+        :return: a list of the segments between slashes
+        '''
+        return path.split('/')
 
     @classmethod
     def build_route_regexp(cls, regexp_str):
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/25
+'''
+Micro-batching of the calls of a route: Router.add_batched(path, predict)
+adds a route whose concurrent requests are collected into batches, each
+run with a single call of predict in an executor.
+
+Vectorized functions, ie. a model's predict over a matrix of inputs, cost
+little more for a batch of rows than for one, and a batch pays for one
+executor round trip instead of one per request.
+'''
+import asyncio
+import collections
+import json
+
+from framework.exceptions import ServiceUnavailableException
+from framework.http_utils import Response
+from framework.offload import THREAD, PROCESS, RETRY_AFTER
+
+MAX_BATCH_SIZE = 64
+MAX_WAIT = 0.005
+MAX_QUEUE = 1024
+
+
+def json_input(request):
+    '''
+    Default decoder of a batched route: the JSON body of the request
+    :return: the decoded input
+    :raise ValueError: when the body isn't JSON
+    '''
+    if not request.body_raw:
+        raise ValueError('Missing body')
+    return json.loads(request.body_raw.decode('utf-8'))
+
+
+def json_output(result):
+    '''
+    Default encoder of a batched route
+    :return: a Response with result as JSON
+    '''
+    return Response(body=json.dumps(result), content_type='application/json')
+
+
+class MicroBatcher(object):
+    '''
+    Collects the inputs submitted concurrently into batches of up to
+    max_batch_size inputs, and calls predict(inputs) once per batch in an
+    executor, predict returning one result per input, in order.
+
+    A batch starts when it is full, or when its first input has waited
+    max_wait seconds. While 'concurrency' batches are running the inputs
+    keep queuing, so under load batches fill up by themselves; beyond
+    max_queue waiting inputs requests are rejected with a 503.
+    '''
+
+    def __init__(self, predict, executors, max_batch_size=MAX_BATCH_SIZE,
+                 max_wait=MAX_WAIT, executor=THREAD, concurrency=1,
+                 max_queue=MAX_QUEUE, decode=json_input, encode=json_output,
+                 retry_after=RETRY_AFTER):
+        '''
+        :param predict: a function taking a list of inputs and returning a
+            sequence of as many results, a module level function for a
+            process pool
+        :param executors: the Executors holding the pool predict runs in
+        :param max_batch_size: inputs in a batch
+        :param max_wait: seconds the first input of a batch waits for
+            others, ie. 0.005 for 5ms
+        :param executor: THREAD, fine for functions releasing the GIL like
+            numpy's, or PROCESS
+        :param concurrency: batches running at once
+        :param max_queue: inputs waiting for a batch
+        :param decode: function turning a request into an input, raising
+            ValueError for a 400
+        :param encode: function turning a result into a string or Response
+        :param retry_after: seconds a rejected client is told to wait
+        '''
+        if executor not in (THREAD, PROCESS):
+            raise ValueError('Unknown executor: {0}'.format(executor))
+        self.predict = predict
+        self.executors = executors
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.decode = decode
+        self.encode = encode
+        self.retry_after = retry_after
+        self.running = 0
+        self.batches = 0
+        self.inputs = 0
+        self._pending = collections.deque()  # (input, future, time submitted)
+        self._timer = None
+
+    @property
+    def queued(self):
+        return len(self._pending)
+
+    async def handler(self, request, **path_params):
+        '''
+        The handler of the route: decodes the request, waits for the
+        result of its input and encodes it
+        '''
+        try:
+            value = self.decode(request)
+        except ValueError as e:
+            return Response(code=400, body=str(e) or Response.reason_phrases[400],
+                            content_type='text/plain')
+        return self.encode(await self.submit(value))
+
+    async def submit(self, value):
+        '''
+        :param value: an input for predict
+        :return: its result, once its batch ran
+        :raise ServiceUnavailableException: when max_queue inputs are
+            already waiting
+        '''
+        if len(self._pending) >= self.max_queue:
+            raise ServiceUnavailableException(retry_after=self.retry_after)
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((value, future, loop.time()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.running >= self.concurrency:
+            return  # started again when a running batch is over
+        batch = []
+        while self._pending and len(batch) < self.max_batch_size:
+            value, future, _ = self._pending.popleft()
+            if not future.done():  # not cancelled by a timed out request
+                batch.append((value, future))
+        if batch:
+            self.running += 1
+            asyncio.ensure_future(self._run(batch))
+        self._schedule()
+
+    def _schedule(self):
+        '''
+        Starts the next batch if it is full or waited long enough, else
+        arms the timer of its first input
+        '''
+        if not self._pending or self._timer is not None or self.running >= self.concurrency:
+            return
+        loop = asyncio.get_event_loop()
+        deadline = self._pending[0][2] + self.max_wait
+        if len(self._pending) >= self.max_batch_size or deadline <= loop.time():
+            self._flush()
+        else:
+            self._timer = loop.call_at(deadline, self._flush)
+
+    async def _run(self, batch):
+        loop = asyncio.get_event_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executors.get(self.executor), self.predict, [value for value, _ in batch])
+            if len(results) != len(batch):
+                raise ValueError('predict returned {0} results for {1} inputs'.format(
+                    len(results), len(batch)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.running -= 1
+            self.batches += 1
+            self.inputs += len(batch)
+            self._schedule()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/12
+'''
+Server side cache of serialized responses for GET routes whose handler is a
+pure function of the path, some query params and some headers.
+
+A route opts in with a CachePolicy, which selects the parts of the request
+that make up the cache key. Responses are stored frozen, so a hit is written
+to the client without running the handler or serializing anything.
+'''
+import asyncio
+import collections
+import time
+
+from framework.http_utils import FileResponse, StreamingResponse, as_response
+
+MAX_BYTES = 64 * 1024 * 1024
+TTL = 60
+
+
+class CachePolicy(object):
+    '''
+    Describes how the responses of a route are cached
+    '''
+
+    def __init__(self, ttl=None, query_params=(), headers=()):
+        '''
+        :param ttl: seconds a response stays fresh, defaults to the cache's ttl
+        :param query_params: names of the query params that are part of the key,
+            the other ones are ignored
+        :param headers: names of the request headers that are part of the key,
+            ie. 'Accept-Language'
+        '''
+        self.ttl = ttl
+        self.query_params = tuple(query_params)
+        self.headers = tuple(headers)
+
+    def key(self, request):
+        '''
+        :param request: a finished Request
+        :return: a hashable key identifying the response to request
+        '''
+        return (request.method, request.path,
+                tuple(tuple(request.query_params.get(name, ()))
+                      for name in self.query_params),
+                tuple(request.get_header(name) for name in self.headers))
+
+
+class CacheEntry(object):
+
+    def __init__(self, response, expires):
+        self.response = response
+        self.expires = expires
+        self.size = sum(len(buffer) for buffer in response._build_response())
+
+
+class ResponseCache(object):
+    '''
+    LRU cache of frozen responses bounded by their size in bytes, with a
+    time to live per entry. Concurrent misses on the same key are coalesced:
+    the handler runs once and every waiting request gets its response.
+    '''
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL, clock=time.monotonic):
+        '''
+        :param max_bytes: budget for the serialized responses kept in memory
+        :param ttl: default number of seconds a response stays fresh
+        :param clock: function returning the current time in seconds
+        '''
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._pending = {}
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''
+        :return: the fresh FrozenResponse stored for key or None
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        if entry.expires <= self.clock():
+            self._remove(key)
+            return
+        self._entries.move_to_end(key)
+        return entry.response
+
+    def set(self, key, response, ttl=None):
+        '''
+        Stores response under key, evicting the least recently used
+        entries to stay within max_bytes
+
+        :param response: a Response, it is frozen before being stored
+        :param ttl: seconds the response stays fresh, defaults to self.ttl
+        :return: the stored FrozenResponse
+        '''
+        response = response.freeze()
+        entry = CacheEntry(response, self.clock() + (self.ttl if ttl is None else ttl))
+        if key in self._entries:
+            self._remove(key)
+        if entry.size > self.max_bytes:
+            return response
+        self._entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+        return response
+
+    def invalidate(self, path=None):
+        '''
+        Drops the responses stored for path, whatever their query params and
+        headers, or every response when path is None. Responses being built
+        while this is called are not stored.
+        '''
+        self._generation += 1
+        if path is None:
+            self._entries.clear()
+            self.size = 0
+            return
+        for key in [key for key in self._entries if key[1] == path]:
+            self._remove(key)
+
+    async def fetch(self, key, create, ttl=None):
+        '''
+        Returns the response stored for key. On a miss, awaits create() to
+        build it and stores it if its status code is 200. Requests missing
+        the same key meanwhile wait for the same result. Streaming and file
+        responses are neither stored nor shared. When create() fails or is
+        cancelled, ie. by the handler timeout of its request, the waiting
+        requests start over instead of sharing the error.
+
+        :param create: a function returning an awaitable of a Response or string
+        :return: a Response
+        '''
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            try:
+                response = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise  # this request is cancelled
+                return await self.fetch(key, create, ttl)
+            if response is not None:
+                return response
+            return as_response(await create())
+
+        self.misses += 1
+        generation = self._generation
+        future = self._pending[key] = asyncio.get_event_loop().create_future()
+        try:
+            response = as_response(await create())
+            if isinstance(response, (StreamingResponse, FileResponse)):
+                # a stream or a file is sent once, the waiters build their own
+                future.set_result(None)
+                return response
+            if response.code == 200 and generation == self._generation:
+                response = self.set(key, response, ttl)
+            future.set_result(response)
+            return response
+        except BaseException:
+            # the failure or the cancellation belongs to this request only
+            future.cancel()
+            raise
+        finally:
+            del self._pending[key]
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key).size
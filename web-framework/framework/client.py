@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/26
+'''
+Async HTTP/1.1 client for handlers calling upstream services, and the
+reverse proxy route built on it, see Router.add_proxy.
+
+HTTPClient keeps a pool of keep-alive connections per host and port.
+A connection carries one request at a time: requests beyond
+max_connections wait in line for the next free connection instead of
+being pipelined, as a pipelined request lost with its connection can't
+safely be sent again. Responses are parsed with
+http_parser.ResponseParser, their body is read as it arrives.
+'''
+import asyncio
+import collections
+import time
+from urllib import parse
+
+from framework.exceptions import (BadRequestException, ClientException,
+                                  ClientTimeoutException)
+from framework.http_parser import (ResponseParser, CRLF, MAX_HEADER_SIZE,
+                                   get_content_length)
+from framework.http_utils import Headers, Response, EmptyResponse, StreamingResponse
+
+MAX_CONNECTIONS = 10
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+IDLE_TIMEOUT = 15
+READ_SIZE = 64 * 1024
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+# headers about one connection only, not forwarded by the proxy
+HOP_BY_HOP = frozenset(('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                        'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade',
+                        'content-length'))
+
+
+class ClientResponse(object):
+    '''
+    A response of an upstream server. Its headers are read, its body is
+    read by iterating over it, 'async for data in response', or at once
+    with read(). The connection goes back to the pool once the body is
+    read, close() closes it when the body is left unread.
+    '''
+
+    __slots__ = ('method', 'version', 'code', 'reason', 'headers', 'finished',
+                 'body', 'body_raw', '_connection', '_client', '_remaining',
+                 '_chunked', '_until_close')
+
+    def __init__(self, method):
+        self.method = method
+        self.version = None
+        self.code = None
+        self.reason = ''
+        self.headers = Headers()
+        self.finished = False
+        self.body = None
+        self.body_raw = None
+        self._connection = None
+        self._client = None
+        self._remaining = 0
+        self._chunked = False
+        self._until_close = False
+
+    def _frame(self):
+        '''
+        Works out how the body is delimited from the status and headers
+        '''
+        if self.method == 'HEAD' or self.code in (204, 304) or self.code < 200:
+            return
+        encoding = self.headers.get('transfer-encoding', '').lower()
+        if encoding:
+            if not encoding.endswith('chunked'):
+                self._until_close = True
+            else:
+                self._chunked = True
+                self._remaining = None
+            return
+        try:
+            length = get_content_length(self.headers)
+        except BadRequestException as e:
+            raise ClientException(str(e))
+        if length is None:
+            self._until_close = True
+            return
+        self._remaining = length
+
+    @property
+    def has_body(self):
+        return self._until_close or self._chunked or bool(self._remaining)
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == '1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def __aiter__(self):
+        return self.iter_body()
+
+    async def iter_body(self):
+        '''
+        :return: an async iterator of the bytes of the body as they arrive
+        '''
+        try:
+            while self._connection is not None:
+                data = await self._read_some()
+                if data:
+                    yield data
+        except BaseException:
+            await self.close()
+            raise
+
+    async def read(self):
+        '''
+        :return: the bytes of the whole body, also kept in body_raw
+        '''
+        parts = [data async for data in self]
+        self.body_raw = self.body = b''.join(parts)
+        return self.body_raw
+
+    async def _read_some(self):
+        connection = self._connection
+        if self._until_close:
+            data = await connection.read_some(None, self._client.read_timeout)
+            if not data:
+                self._release(reusable=False)
+            return data
+        if self._chunked and not self._remaining:
+            if self._remaining == 0:
+                await connection.read_line(self._client.read_timeout)  # CRLF after a chunk
+            self._remaining = await self._read_chunk_size()
+            if self._remaining == 0:
+                await self._read_trailers()
+                self._release(reusable=self.keep_alive)
+                return b''
+        data = await connection.read_some(self._remaining, self._client.read_timeout)
+        if not data:
+            self._release(reusable=False)
+            raise ClientException('Connection closed before the end of the body')
+        self._remaining -= len(data)
+        if not self._remaining and not self._chunked:
+            self._release(reusable=self.keep_alive)
+        return data
+
+    async def _read_chunk_size(self):
+        line = await self._connection.read_line(self._client.read_timeout)
+        try:
+            return int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise ClientException('Invalid chunk size')
+
+    async def _read_trailers(self):
+        while await self._connection.read_line(self._client.read_timeout):
+            pass
+
+    def _release(self, reusable):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            self._client.release(connection, reusable)
+
+    async def close(self):
+        '''
+        Closes the connection if the body wasn't read to the end
+        '''
+        self._release(reusable=False)
+
+
+class ClientConnection(object):
+    '''
+    A connection to an upstream server and the bytes read from it that
+    were not consumed yet
+    '''
+
+    __slots__ = ('key', 'reader', 'writer', 'buffer', 'parser', 'idle_since', 'requests')
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+        self.parser = ResponseParser()
+        self.idle_since = None
+        self.requests = 0
+
+    @property
+    def usable(self):
+        '''
+        Whether an idle connection can take a request, the server didn't
+        close it and it has nothing unexpected to read
+        '''
+        return (not self.buffer and not self.reader.at_eof()
+                and not self.writer.is_closing())
+
+    async def _read(self, timeout):
+        '''
+        :return: False at the end of the stream
+        '''
+        try:
+            data = await asyncio.wait_for(self.reader.read(READ_SIZE), timeout)
+        except asyncio.TimeoutError:
+            raise ClientTimeoutException()
+        self.buffer.extend(data)
+        return bool(data)
+
+    async def read_head(self, response, timeout):
+        '''
+        Reads the status line and headers into response
+        :return: False when the connection was closed before any byte
+        '''
+        while True:
+            try:
+                self.buffer = self.parser.parse_into(response, self.buffer)
+            except BadRequestException as e:
+                raise ClientException(str(e))
+            if response.finished:
+                return True
+            if not await self._read(timeout):
+                if self.buffer:
+                    raise ClientException('Connection closed in the response headers')
+                return False
+
+    async def read_line(self, timeout):
+        while True:
+            end = self.buffer.find(CRLF)
+            if end >= 0:
+                line = bytes(self.buffer[:end])
+                del self.buffer[:end + len(CRLF)]
+                return line
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise ClientException('Invalid chunked body')
+            if not await self._read(timeout):
+                raise ClientException('Connection closed in a chunked body')
+
+    async def read_some(self, limit, timeout):
+        '''
+        :param limit: most bytes returned, None for no limit
+        :return: the bytes available, b'' at the end of the stream
+        '''
+        if not self.buffer and not await self._read(timeout):
+            return b''
+        if limit is None or len(self.buffer) <= limit:
+            data, self.buffer = bytes(self.buffer), bytearray()
+        else:
+            data = bytes(self.buffer[:limit])
+            del self.buffer[:limit]
+        return data
+
+    def close(self):
+        self.writer.close()
+
+
+class HostPool(object):
+    '''
+    The connections to one host and port: idle ones, most recently used
+    first, and the requests waiting for one
+    '''
+
+    __slots__ = ('max_connections', 'count', 'idle', 'waiters')
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.count = 0
+        self.idle = collections.deque()
+        self.waiters = collections.deque()
+
+
+class HTTPClient(object):
+    '''
+    Async HTTP/1.1 client with keep-alive connections pooled per host,
+    ie. in a handler:
+
+        response = await client.request('GET', 'http://127.0.0.1:8001/users/1')
+        return response.body
+
+    One client is meant to be shared by the handlers of a process.
+    '''
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, idle_timeout=IDLE_TIMEOUT, keep_alive=True,
+                 clock=time.monotonic):
+        '''
+        :param max_connections: connections open at once to a host, more
+            requests wait for one to be free
+        :param connect_timeout: seconds to get a connection, waiting for a
+            free one included
+        :param read_timeout: seconds without receiving anything from the
+            server before a request fails
+        :param idle_timeout: seconds an idle connection is kept, servers
+            close them after their own keep-alive timeout
+        :param keep_alive: False to open a connection per request
+        :param clock: function returning the current time in seconds
+        '''
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.keep_alive = keep_alive
+        self.clock = clock
+        self.connections_opened = 0
+        self._pools = {}
+
+    async def request(self, method, url, headers=None, body=b''):
+        '''
+        :param method: 'GET', 'POST'...
+        :param url: an absolute http or https URL
+        :param headers: a dict, Headers or iterable of (name, value) pairs
+        :param body: bytes sent as the body
+        :return: a ClientResponse whose body was read into body
+        :raise ClientException: when the request fails, ClientTimeoutException
+            when it times out
+        '''
+        response = await self.stream(method, url, headers, body)
+        await response.read()
+        return response
+
+    async def get(self, url, headers=None):
+        return await self.request('GET', url, headers)
+
+    async def post(self, url, body, headers=None):
+        return await self.request('POST', url, headers, body)
+
+    async def stream(self, method, url, headers=None, body=b''):
+        '''
+        Same as request but returns once the headers are received, the
+        body has to be read, or the response closed, by the caller
+        '''
+        scheme, host, port, target = split_url(url)
+        data = build_request(method, target, host, port, scheme, headers, body, self.keep_alive)
+        key = (scheme, host, port)
+        while True:
+            connection, reused = await self._acquire(key)
+            response = ClientResponse(method)
+            try:
+                connection.writer.write(data)
+                if await connection.read_head(response, self.read_timeout):
+                    break
+                error = ClientException('Connection closed by the server')
+            except ConnectionError as e:
+                error = ClientException(str(e) or type(e).__name__)
+            except BaseException:
+                self.release(connection, False)
+                raise
+            self.release(connection, False)
+            # the server may close an idle connection as the request is sent
+            if not reused or method not in IDEMPOTENT_METHODS:
+                raise error
+        connection.requests += 1
+        response._connection = connection
+        response._client = self
+        try:
+            response._frame()
+        except BaseException:
+            await response.close()
+            raise
+        if not response.has_body:
+            response._release(response.keep_alive)
+        return response
+
+    async def _acquire(self, key):
+        '''
+        :return: a (connection, whether it was used before) tuple
+        '''
+        try:
+            return await asyncio.wait_for(self._get_connection(key), self.connect_timeout)
+        except asyncio.TimeoutError:
+            raise ClientTimeoutException()
+
+    async def _get_connection(self, key):
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = HostPool(self.max_connections)
+        now = self.clock()
+        while pool.idle:
+            connection = pool.idle.popleft()
+            if connection.usable and now - connection.idle_since < self.idle_timeout:
+                return connection, True
+            self._discard(pool, connection)
+        if pool.count >= pool.max_connections:
+            waiter = asyncio.get_event_loop().create_future()
+            pool.waiters.append(waiter)
+            try:
+                connection = await waiter
+            except BaseException:
+                if waiter.done() and not waiter.cancelled():
+                    self._hand_over(pool, waiter.result())  # got one while being cancelled
+                elif waiter in pool.waiters:
+                    pool.waiters.remove(waiter)
+                raise
+            if connection is not None:
+                return connection, True
+            # handed the slot of a closed connection
+        else:
+            pool.count += 1
+        try:
+            return await self._connect(key), False
+        except BaseException:
+            self._hand_over(pool, None)
+            raise
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        try:
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl=scheme == 'https' or None, limit=READ_SIZE)
+        except OSError as e:
+            raise ClientException('Can not connect to {0}:{1}: {2}'.format(host, port, e))
+        self.connections_opened += 1
+        return ClientConnection(key, reader, writer)
+
+    def release(self, connection, reusable):
+        '''
+        Gives a connection back to its pool once a response was read
+        :param reusable: False to close the connection
+        '''
+        pool = self._pools[connection.key]
+        if reusable and self.keep_alive and connection.usable:
+            connection.idle_since = self.clock()
+            self._hand_over(pool, connection)
+        else:
+            connection.close()
+            self._hand_over(pool, None)
+
+    def _hand_over(self, pool, connection):
+        '''
+        Gives the connection, or the slot of a closed one when None, to the
+        first request waiting, or back to the pool
+        '''
+        while pool.waiters:
+            waiter = pool.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return
+        if connection is None:
+            pool.count -= 1
+        else:
+            pool.idle.appendleft(connection)
+
+    def _discard(self, pool, connection):
+        connection.close()
+        pool.count -= 1
+
+    def close(self):
+        '''
+        Closes the idle connections
+        '''
+        for pool in self._pools.values():
+            while pool.idle:
+                self._discard(pool, pool.idle.popleft())
+
+
+def split_url(url):
+    '''
+    :return: a (scheme, host, port, request target) tuple
+    '''
+    parts = parse.urlsplit(url)
+    if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+        raise ClientException('Unsupported URL: {0}'.format(url))
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    return parts.scheme, parts.hostname, parts.port or DEFAULT_PORTS[parts.scheme], target
+
+
+def build_request(method, target, host, port, scheme, headers, body, keep_alive=True):
+    '''
+    :return: the bytes of the request
+    '''
+    lines = ['{0} {1} HTTP/1.1'.format(method, target)]
+    if port == DEFAULT_PORTS[scheme]:
+        host_header = host
+    else:
+        host_header = '{0}:{1}'.format(host, port)
+    if headers is not None:
+        items = headers.items() if hasattr(headers, 'items') else headers
+        for name, value in items:
+            lower = name.lower()
+            if lower == 'host':
+                host_header = value
+            elif lower not in HOP_BY_HOP:
+                lines.append('{0}: {1}'.format(name, value))
+    lines.insert(1, 'Host: {0}'.format(host_header))
+    if body or method == 'POST':
+        lines.append('Content-Length: {0}'.format(len(body)))
+    if not keep_alive:
+        lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + body
+
+
+class ReverseProxy(object):
+    '''
+    Handler of a route forwarding its requests to an upstream server and
+    streaming the responses back, see Router.add_proxy
+    '''
+
+    def __init__(self, upstream, client=None):
+        '''
+        :param upstream: URL the route's path is appended to, ie.
+            'http://127.0.0.1:8001/api'
+        :param client: the HTTPClient sending the requests, one with the
+            default limits if None
+        '''
+        scheme, host, port, target = split_url(upstream)
+        self.upstream = '{0}://{1}:{2}{3}'.format(scheme, host, port, target.rstrip('/'))
+        self.client = client or HTTPClient()
+
+    async def handler(self, request, path=''):
+        url = self.upstream + '/' + path
+        if request.raw_query:
+            url += '?' + request.raw_query
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name.lower() not in HOP_BY_HOP and name.lower() != 'host']
+        host = request.get_header('host')
+        if host is not None:
+            headers.append(('X-Forwarded-Host', host))
+        try:
+            upstream = await self.client.stream(request.method, url, headers,
+                                                request.body_raw or b'')
+        except ClientException as e:
+            return Response(code=e.code, body=Response.reason_phrases[e.code])
+        dropped = HOP_BY_HOP
+        if not upstream.has_body and upstream.code >= 200 and upstream.code not in (204, 304):
+            # the Content-Length of a HEAD response announces the body of a GET
+            dropped = HOP_BY_HOP - {'content-length'}
+        response_headers = Headers(items=[
+            (name, value) for name, value in upstream.headers.items()
+            if name.lower() not in dropped])
+        if not upstream.has_body:
+            return EmptyResponse(code=upstream.code, headers=response_headers)
+        response = StreamingResponse(code=upstream.code, body=relay(upstream))
+        response.headers = response_headers
+        return response
+
+
+async def relay(response):
+    '''
+    Yields the body of an upstream response, closing it if the client
+    goes away before the end
+    '''
+    try:
+        async for data in response:
+            yield data
+    finally:
+        await response.close()
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/22
+'''
+gzip and deflate compression of the responses, negotiated with the
+Accept-Encoding header of the request. Compression is enabled by giving a
+Compressor to HTTPServer, which passes it every response before writing it.
+
+Compressed copies are kept for the responses sent again and again: a
+FrozenResponse, ie. one stored by the ResponseCache, keeps its own, the
+responses with an ETag, ie. static files, share an LRU keyed by ETag.
+Other responses are compressed for every request.
+'''
+import asyncio
+import collections
+import gzip
+import os
+import zlib
+
+from framework.http_utils import (FileResponse, FrozenResponse, Response,
+                                  StreamingResponse, utf8_bytes)
+
+MIN_SIZE = 1024
+OFFLOAD_SIZE = 64 * 1024
+MAX_FILE_SIZE = 8 * 1024 * 1024
+MAX_BYTES = 16 * 1024 * 1024
+LEVEL = 6
+CONTENT_TYPES = ('text/', 'application/json', 'application/javascript',
+                 'application/xml', 'image/svg+xml')
+# in order of preference when the client accepts both equally
+ENCODINGS = ('gzip', 'deflate')
+UNCOMPRESSED_CODES = (204, 206, 304)
+MAX_NEGOTIATED = 256
+
+
+def gzip_compress(data, level=LEVEL):
+    # mtime=0 makes the output depend on data only
+    return gzip.compress(data, level, mtime=0)
+
+
+def deflate_compress(data, level=LEVEL):
+    # 'deflate' in HTTP is the zlib format, not a raw deflate stream
+    return zlib.compress(data, level)
+
+
+COMPRESSORS = {'gzip': gzip_compress, 'deflate': deflate_compress}
+
+
+class Compressor(object):
+    '''
+    Compresses the responses whose content type matches one of
+    content_types and whose body is at least min_size bytes, with the
+    encoding the client prefers among ENCODINGS. Streaming responses,
+    partial content and responses that already have a Content-Encoding
+    are sent as they are.
+
+    Bodies of offload_size bytes or more are compressed in the loop's
+    default executor, zlib releases the GIL meanwhile. Files are read and
+    compressed there too, up to max_file_size bytes.
+    '''
+
+    def __init__(self, min_size=MIN_SIZE, content_types=CONTENT_TYPES, level=LEVEL,
+                 offload_size=OFFLOAD_SIZE, max_file_size=MAX_FILE_SIZE,
+                 max_bytes=MAX_BYTES):
+        '''
+        :param min_size: smaller bodies are not worth compressing
+        :param content_types: prefixes of the compressed content types, ie.
+            'text/' or 'application/json'
+        :param level: zlib compression level, 1 to 9
+        :param offload_size: bodies at least that large are compressed out
+            of the event loop
+        :param max_file_size: larger files are sent uncompressed
+        :param max_bytes: size of the compressed copies kept by ETag
+        '''
+        self.min_size = min_size
+        self.content_types = tuple(content_types)
+        self.level = level
+        self.offload_size = offload_size
+        self.max_file_size = max_file_size
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.compressed = 0
+        self.hits = 0
+        self._variants = collections.OrderedDict()
+        self._pending = {}
+        self._negotiated = {}
+
+    def __len__(self):
+        return len(self._variants)
+
+    async def compress(self, request, response):
+        '''
+        :param request: the Request response answers
+        :param response: a Response
+        :return: response or a compressed copy of it
+        '''
+        if response.code == 304:
+            return self.not_modified(request, response)
+        # a HEAD gets the headers of the copy a GET would get
+        if (request.method not in ('GET', 'HEAD') or response.code in UNCOMPRESSED_CODES or
+                isinstance(response, StreamingResponse)):
+            return response
+        size = self.body_size(response)
+        if size is None or size < self.min_size:
+            return response
+        headers = response.headers
+        if _get(headers, 'content-encoding') is not None:
+            return response
+        if not _get(headers, 'content-type', '').startswith(self.content_types):
+            return response
+        encoding = self.negotiate(request.get_header('accept-encoding'))
+        if encoding is None:
+            if isinstance(response, FrozenResponse):
+                return _identity(response)
+            response.set_header('Vary', _vary(headers))
+            return response
+
+        # a frozen response keeps its compressed copies, the others are
+        # shared by ETag when they have one
+        if isinstance(response, FrozenResponse):
+            variants, key = response.variants, encoding
+        else:
+            etag = _get(headers, 'etag')
+            if etag is None:
+                return await self._compress(response, encoding, size)
+            variants, key = self._variants, (etag, encoding)
+        variant = variants.get(key)
+        if variant is not None:
+            self.hits += 1
+            if variants is self._variants:
+                variants.move_to_end(key)
+            await _close(response)
+            return variant
+        pending_key = (id(variants), key)
+        pending = self._pending.get(pending_key)
+        if pending is not None:
+            try:
+                variant = await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if pending.cancelled():
+                    # the request compressing it failed or was cancelled
+                    return await self.compress(request, response)
+                await _close(response)
+                raise
+            self.hits += 1
+            await _close(response)
+            return variant
+
+        future = self._pending[pending_key] = asyncio.get_event_loop().create_future()
+        try:
+            variant = await self._compress(response, encoding, size)
+            future.set_result(variant)
+        except BaseException:
+            # the failure or the cancellation belongs to this request only
+            future.cancel()
+            raise
+        finally:
+            del self._pending[pending_key]
+        if variants is self._variants:
+            self._store(key, variant)
+        else:
+            variants[key] = variant
+        return variant
+
+    def not_modified(self, request, response):
+        '''
+        A 304 carries the ETag of the copy the client revalidated, the
+        compressed one when If-None-Match names it
+
+        :param response: a 304 answering request
+        '''
+        etag = _get(response.headers, 'etag')
+        if_none_match = request.get_header('if-none-match')
+        if etag is None or not if_none_match:
+            return response
+        encoding = self.negotiate(request.get_header('accept-encoding'))
+        if encoding is None:
+            return response
+        encoded = encoded_etag(etag, encoding)
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if (tag[2:] if tag.startswith('W/') else tag) == encoded:
+                response.set_header('ETag', encoded)
+                response.set_header('Vary', _vary(response.headers))
+                break
+        return response
+
+    def body_size(self, response):
+        '''
+        :return: the size of the body in bytes, None when it can't be
+            compressed, ie. part of a file or a file over max_file_size
+        '''
+        if isinstance(response, FileResponse):
+            if response.body is None or response.offset or response.count > self.max_file_size:
+                return
+            return response.count
+        if isinstance(response, FrozenResponse):
+            return len(response._body)
+        if isinstance(response.body, (bytes, str)):
+            return len(response.body)
+
+    def negotiate(self, accept_encoding):
+        '''
+        :param accept_encoding: value of the Accept-Encoding header, or None
+        :return: the encoding to use, None to send the body as it is
+        '''
+        if not accept_encoding:
+            return
+        encoding = self._negotiated.get(accept_encoding, False)
+        if encoding is False:
+            encoding = negotiate(accept_encoding)
+            if len(self._negotiated) >= MAX_NEGOTIATED:
+                self._negotiated.clear()
+            self._negotiated[accept_encoding] = encoding
+        return encoding
+
+    async def _compress(self, response, encoding, size):
+        '''
+        :return: a FrozenResponse with the compressed body, a FileResponse
+            is closed
+        '''
+        compress = COMPRESSORS[encoding]
+        if isinstance(response, FileResponse):
+            read_file = _read_file
+            body = (response.body, response.count)
+        else:
+            read_file = None
+            body = response._body if isinstance(response, FrozenResponse) else response.body
+        try:
+            if size >= self.offload_size or read_file is not None:
+                loop = asyncio.get_event_loop()
+                data = await loop.run_in_executor(None, _compress, compress, self.level,
+                                                  read_file, body)
+            else:
+                data = _compress(compress, self.level, None, body)
+        finally:
+            await _close(response)
+        self.compressed += 1
+
+        headers = dict(response.headers)
+        content_type = _pop(headers, 'content-type')
+        _pop(headers, 'content-length')
+        # ranges would be bytes of the uncompressed body
+        _pop(headers, 'accept-ranges')
+        headers['Content-Encoding'] = encoding
+        headers['Vary'] = _vary(headers)
+        etag = _pop(headers, 'etag')
+        if etag is not None:
+            headers['ETag'] = encoded_etag(etag, encoding)
+        return Response(code=response.code, body=data, headers=headers,
+                        content_type=content_type).freeze()
+
+    def _store(self, key, variant):
+        size = len(variant._body)
+        if size > self.max_bytes:
+            return
+        old = self._variants.pop(key, None)
+        if old is not None:
+            self.size -= len(old._body)
+        self._variants[key] = variant
+        self.size += size
+        while self.size > self.max_bytes:
+            self.size -= len(self._variants.popitem(last=False)[1]._body)
+
+    def clear(self):
+        self._variants.clear()
+        self.size = 0
+
+
+def negotiate(accept_encoding):
+    '''
+    :param accept_encoding: value of an Accept-Encoding header
+    :return: the encoding of ENCODINGS with the highest quality value, the
+        first of them on a tie, None when the client accepts none of them
+    '''
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        quality = 1.0
+        params = params.strip()
+        if params.startswith(('q=', 'Q=')):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def encoded_etag(etag, encoding):
+    '''
+    :param etag: ETag of a response, ie. '"5f-1a2b"'
+    :return: ETag of its copy compressed with encoding, ie. '"5f-1a2b-gzip"',
+        a different representation needs a different tag
+    '''
+    return '{0}-{1}"'.format(etag.rstrip('"'), encoding)
+
+
+def identity_etag(etag):
+    '''
+    :param etag: an entity tag without its W/ prefix
+    :return: the tag of the response a compressed copy was made from, etag
+        itself when it isn't the tag of a compressed copy
+    '''
+    for encoding in ENCODINGS:
+        suffix = '-{0}"'.format(encoding)
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+def _compress(compress, level, read_file, body):
+    if read_file is not None:
+        body = read_file(*body)
+    return compress(utf8_bytes(body), level)
+
+
+def _read_file(file, count):
+    # pread doesn't move the file position, other responses may share it
+    return os.pread(file.fileno(), count, 0)
+
+
+def _identity(response):
+    '''
+    :param response: a FrozenResponse
+    :return: its uncompressed copy with a Vary header, kept with the
+        compressed ones
+    '''
+    variant = response.variants.get(None)
+    if variant is None:
+        headers = dict(response.headers)
+        headers['Vary'] = _vary(headers)
+        variant = response.variants[None] = Response(
+            code=response.code, body=response._body, headers=headers).freeze()
+    return variant
+
+
+async def _close(response):
+    if isinstance(response, FileResponse):
+        await response.close()
+
+
+def _get(headers, name, default=None):
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return default
+
+
+def _pop(headers, name):
+    for key in list(headers):
+        if key.lower() == name:
+            return headers.pop(key)
+
+
+def _vary(headers):
+    vary = _get(headers, 'vary')
+    if not vary:
+        return 'Accept-Encoding'
+    if 'accept-encoding' in vary.lower():
+        return vary
+    return vary + ', Accept-Encoding'
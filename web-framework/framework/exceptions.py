@@ -7,17 +7,68 @@ class DiyFrameworkException(Exception):
     pass
 
 
-class BadRequestException(DiyFrameworkException):
+class ProtocolException(DiyFrameworkException):
+    '''
+    A request the server can't read. It is answered with code and its
+    connection is closed, as the next request can't be found after it.
+    '''
     code = 400
 
 
+class BadRequestException(ProtocolException):
+    code = 400
+
+
+class PayloadTooLargeException(BadRequestException):
+    code = 413
+
+
+class NotImplementedException(ProtocolException):
+    '''
+    The request uses a feature of HTTP the server doesn't support
+    '''
+    code = 501
+
+
 class NotFoundException(DiyFrameworkException):
     code = 404
 
 
+class ServiceUnavailableException(DiyFrameworkException):
+    code = 503
+
+    def __init__(self, retry_after=None):
+        '''
+        :param retry_after: seconds the client should wait before retrying,
+            sent as a Retry-After header
+        '''
+        super().__init__()
+        self.retry_after = retry_after
+
+
+class TooManyRequestsException(ServiceUnavailableException):
+    code = 429
+
+
+class ClientException(DiyFrameworkException):
+    '''
+    A request of framework.client failed: the connection to the upstream
+    server or its response
+    '''
+    code = 502
+
+
+class ClientTimeoutException(ClientException):
+    code = 504
+
+
 class DuplicateRoute(DiyFrameworkException):
     pass
 
 
+class InvalidRoute(DiyFrameworkException):
+    pass
+
+
 class TimeoutException(DiyFrameworkException):
     code = 500
@@ -3,57 +3,100 @@
 # Created by igor on 16/9/22
 '''
 Module response for parsing bytes objects into HTTP requests.
-All of the function in here operate on byte buffers and modify them
-instead of working on copies.
-
-The http_parser module is a group of functions inside because the parser does not need to keep track of state.
-Instead, the calling code has to manage a Request object and pass it into the parse_into function along with a
-bytearray containing the raw bytes of a request. To this end, the parser modifies both the request object as well
-as the bytearray buffer passed to it. The request object gets fuller and fuller while the bytearray buffer gets
-emptier and emptier.
+
+The module level parse_into function keeps no state of its own. The calling code has to
+manage a Request object and pass it into parse_into along with a bytearray containing the
+raw bytes of a request. The request object gets fuller and fuller while a copy of the
+buffer gets emptier and emptier. It copies the buffer and searches it from the start on
+every call, which makes parsing a request that arrives in many chunks quadratic.
+
+HTTPParser is the stateful, incremental version used by the connections: one instance per
+connection keeps the part of the request it is in and offsets into the connection's
+bytearray between calls, only scans the bytes that arrived since the last call and removes
+a request from the buffer once, when it is complete. ResponseParser does the same for the
+responses read by framework.client.
+
+Headers are returned as a framework.http_utils.Headers, a case-insensitive multidict
+that only decodes the headers that are accessed. The header block is the one part of a
+request that is copied out of the buffer, once, as the Headers outlive the buffer, which
+is reused by the next request on the connection.
 '''
 import re
 import json
 from urllib import parse
 
-from framework.exceptions import BadRequestException
+from framework.exceptions import BadRequestException, NotImplementedException
+from framework.http_utils import Headers
 
 CRLF = b'\x0d\x0a'
 SEPARATOR = CRLF + CRLF
 HTTP_VERSION = b'1.1'
 SUPPORTED_METHODS = [
     'GET',
+    'HEAD',
     'POST'
 ]
 
-REQUEST_LINE_REGEXP = re.compile(br'[a-z]+ [a-z0-9.?_\[\]=&-\\]+ http/%s' %
+REQUEST_LINE_REGEXP = re.compile(br'[a-z]+ [a-z0-9.?_\[\]=&-\\%%~!$]+ http/%s' %
                                  (HTTP_VERSION), flags=re.IGNORECASE)
+STATUS_LINE_REGEXP = re.compile(br'HTTP/(1\.[01]) ([1-5][0-9]{2})(?: ([^\r\n]*))?$')
+CONTENT_LENGTH_REGEXP = re.compile(r'[0-9]+')
+MAX_HEADER_SIZE = 65536
 
 
 def can_parse_request_line(buffer):
     '''
     Uses a regular expression to determine whether buffer contains
-    somethin that looks like an HTTP request line.
+    somethin that looks like a complete HTTP request line.
     :param buffer: a bytes like object
     '''
-    return REQUEST_LINE_REGEXP.match(buffer) is not None
+    return REQUEST_LINE_REGEXP.match(buffer) is not None and CRLF in buffer
 
 
 def parse_headers(buffer):
     '''
-    Parses the buffer and create a dict of header:value.Collapses
-    duplicate headers into one.
+    Parses the buffer and create a Headers multidict, case-insensitive
+    and keeping duplicate headers.
 
-    :param buffer: a bytes like object
-    :return: Dict of headers.
+    :param buffer: a bytes like object, starting with the CRLF ending the
+        request line
+    :return: Headers
     '''
     headers_end = buffer.index(SEPARATOR)
-    headers_iter = (line for line in buffer[:headers_end].split(CRLF) if line)
-    headers = {}
-    for line in headers_iter:
-        header, value = [i.strip() for i in line.strip().split(b':')[:2]]
-        headers[header.decode('utf-8')] = value.decode('utf-8')
-    return headers
+    block = bytes(buffer[:headers_end]).lstrip(CRLF)
+    if block:
+        check_header_block(block)
+    return Headers(block)
+
+
+def check_header_block(block):
+    '''
+    Checks that every line of a header block looks like 'name: value', so
+    the block can be kept undecoded. Whitespace is not allowed before the
+    colon nor at the start of a line (obsolete line folding).
+
+    :param block: bytes of the header lines separated by CRLF
+    '''
+    for line in block.split(CRLF):
+        colon = line.find(b':')
+        if colon <= 0 or line[colon - 1] in b' \t' or line[0] in b' \t':
+            raise BadRequestException('Invalid header line')
+
+
+def split_path(raw_path):
+    '''
+    Splits a request target without parsing the query string
+
+    :param raw_path: string representation of an HTTP path ie. /path?key=val.
+    :return: path string and the raw query string
+    '''
+    if not raw_path.startswith('/'):
+        url_obj = parse.urlparse(raw_path)  # absolute form, ie. http://host/path
+        return url_obj.path, url_obj.query
+    path, _, query = raw_path.partition('?')
+    if '#' in path:
+        return path.partition('#')[0], ''
+    return path, query.partition('#')[0]
 
 
 def parse_query_params(raw_path):
@@ -106,11 +149,68 @@ def can_parse_headers(buffer):
     return SEPARATOR in buffer
 
 
+def get_header(headers, name):
+    '''
+    :param headers: Headers or a dict-like object
+    :param name: name of the header, in any case
+    :return: the value of the header or None if it is missing
+    '''
+    if isinstance(headers, Headers):
+        return headers.get(name)
+    name = name.lower()
+    for header, value in headers.items():
+        if header.lower() == name:
+            return value
+
+
+def get_content_length(headers):
+    '''
+    Looks up the Content-Length header regardless of the case
+    the client used for its name. A repeated header, or one holding
+    a list of values, is accepted when every value is the same length.
+
+    :param headers: Headers or a dict-like object
+    :return: the content length as an int or None if the header is missing
+    :raises BadRequestException: unless every value is the same
+        non-negative decimal number
+    '''
+    if isinstance(headers, Headers):
+        values = headers.getall('content-length')
+    else:
+        value = get_header(headers, 'content-length')
+        values = () if value is None else (value,)
+    if not values:
+        return None
+    lengths = set()
+    for value in values:
+        for length in value.split(','):
+            length = length.strip()
+            if not CONTENT_LENGTH_REGEXP.fullmatch(length):
+                raise BadRequestException('Invalid Content-Length')
+            lengths.add(int(length))
+    if len(lengths) > 1:
+        raise BadRequestException('Conflicting Content-Length headers')
+    return lengths.pop()
+
+
+def check_transfer_encoding(headers):
+    '''
+    Request bodies are only delimited by Content-Length. A request with
+    a Transfer-Encoding is refused, as reading its body by any other
+    length would take the rest of it for the next request.
+
+    :param headers: Headers or a dict-like object
+    :raises NotImplementedException: if the header is present
+    '''
+    if get_header(headers, 'transfer-encoding') is not None:
+        raise NotImplementedException('Transfer-Encoding not supported')
+
+
 def has_body(headers):
     '''
     :param headers: A dict-like object
     '''
-    return 'content-length' in headers
+    return bool(get_content_length(headers))
 
 
 def remove_intro(buffer):
@@ -130,8 +230,8 @@ def can_parse_body(headers, buffer):
     :param buffer: a bytes object
     :return: Boolean
     '''
-    content_length = int(headers.get('content_length', '0'))
-    return 'content-length' in headers and len(buffer) == content_length
+    content_length = get_content_length(headers)
+    return content_length is not None and len(buffer) >= content_length
 
 
 def get_body_parser(content_type):
@@ -139,12 +239,13 @@ def get_body_parser(content_type):
     Selects the correct parses to use for parsing a request's body.
 
     :param content_type: a string representing the request's content type.
-    :return: function that expects a string input and outputs parsed text.
+    :return: function that expects a bytes input and outputs the parsed body,
+        or None for content types that are left to the handler.
     '''
-    if content_type == 'application/x-wwww-form-urlencoded':
-        return parse.parse_qs
+    if content_type == 'application/x-www-form-urlencoded':
+        return parse_form
     elif content_type == 'application/json':
-        return json.dumps
+        return parse_json
 
 
 def byte_kv_to_utf8(kv):
@@ -155,6 +256,36 @@ def byte_kv_to_utf8(kv):
     return {k.decode('utf8'): [val.decode('utf8') for val in v] for k, v in kv.items()}
 
 
+def parse_form(body_raw):
+    '''
+    :param body_raw: a bytes object
+    :return: a dict of utf-8 keys:[values]
+    '''
+    return byte_kv_to_utf8(parse.parse_qs(body_raw))
+
+
+def parse_json(body_raw):
+    '''
+    :param body_raw: a bytes object
+    :return: the decoded JSON document
+    '''
+    try:
+        return json.loads(body_raw.decode('utf8'))
+    except ValueError:
+        raise BadRequestException('Invalid JSON body')
+
+
+def get_content_type(headers):
+    '''
+    :param headers: Headers or a dict-like object
+    :return: the media type of the Content-Type header, without parameters
+    '''
+    value = get_header(headers, 'content-type')
+    if value is None:
+        return 'application/x-www-form-urlencoded'
+    return value.split(';')[0].strip().lower()
+
+
 def parse_body(headers, buffer):
     '''
     Parses a request body according to the Content-Type header.
@@ -164,12 +295,11 @@ def parse_body(headers, buffer):
     :return: A tuple of the raw_body bytes and a parsed, utf-8-encoded,
         dict re[resenting the body
     '''
-    body_raw = buffer[:]
-    content_type = headers.get('content-type', 'application/x-www-form-urlencoded')
-    parser = get_body_parser(content_type)
-    body = parser(body_raw)
-    utf_8_body = byte_kv_to_utf8(body)
-    return body_raw, utf_8_body
+    body_raw = bytes(buffer[:get_content_length(headers)])
+    parser = get_body_parser(get_content_type(headers))
+    if parser is None:
+        return body_raw, None
+    return body_raw, parser(body_raw)
 
 
 def clear_buffer(buffer):
@@ -181,6 +311,17 @@ def clear_buffer(buffer):
     del buffer[:]
 
 
+def remove_body(headers, buffer):
+    '''
+    Deletes the body from the buffer, leaving any bytes of a pipelined
+    request that follows it.
+
+    :param headers: a dict of header:values pairs
+    :param buffer: a bytes object
+    '''
+    del buffer[:get_content_length(headers)]
+
+
 def parse_into(request, buffer):
     '''
     Main function of the module - it incrementally parses a bytes object
@@ -188,7 +329,8 @@ def parse_into(request, buffer):
     request line and http headers. Base on that, it then attempts to
     parse the body if applicable. This function expected to be called
     with the same request and buffer objects throughout an HTTP request's
-    life cycle
+    life cycle. Bytes past the end of the request (a pipelined request
+    on a keep-alive connection) are left in the returned buffer.
 
     :param request:an object that will store parsed data.Must expose the
         Request interface.
@@ -202,14 +344,178 @@ def parse_into(request, buffer):
          request.query_params) = parse_request_line(_buffer)
         remove_request_line(_buffer)
 
-    if not request.headers and can_parse_headers(_buffer):
+    if request.method and not request.headers and can_parse_headers(_buffer):
         request.headers = parse_headers(_buffer)
+        check_transfer_encoding(request.headers)
         if not has_body(request.headers):
             request.finished = True
         remove_intro(_buffer)
 
     if not request.finished and can_parse_body(request.headers, _buffer):
-        request.body_raw, request.body = parse_body(request.headers, buffer)
-        clear_buffer(_buffer)
+        request.body_raw, request.body = parse_body(request.headers, _buffer)
+        remove_body(request.headers, _buffer)
         request.finished = True
     return _buffer
+
+
+class HTTPParser(object):
+    '''
+    Incremental parser for the requests sent over one connection.
+
+    The caller appends incoming data to a single bytearray and passes it to
+    parse_into after every read. Between calls the parser remembers which
+    part of the request it is in and how far it has scanned, so every byte
+    is searched once. The request line is matched and decoded straight
+    from the buffer, the header block is copied once into the Headers of
+    the request, and the request is deleted from the front of the buffer
+    only once it is complete.
+
+    When on_headers returns True, the body is left to the caller: the
+    request is marked finished as soon as its headers are parsed, and the
+    buffer returned starts with the first bytes of the body.
+    '''
+
+    REQUEST_LINE, HEADERS, BODY = range(3)
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, on_headers=None):
+        '''
+        :param max_header_size: the request line and headers must fit in
+            this many bytes, otherwise the request is rejected
+        :param on_headers: function called with the request and its content
+            length once the headers are parsed. May raise to reject the
+            request, returns whether the caller takes over the body.
+        '''
+        self.max_header_size = max_header_size
+        self.on_headers = on_headers
+        self.reset()
+
+    def reset(self):
+        '''
+        Prepares the parser for the next request on the connection
+        '''
+        self.state = self.REQUEST_LINE
+        self._scan = 0
+        self._headers_start = 0
+        self._body_start = 0
+        self._content_length = 0
+
+    def parse_into(self, request, buffer):
+        '''
+        Parses as much of the buffer as possible into request. Same
+        interface as the module level parse_into function, but the buffer
+        is modified in place instead of being copied.
+
+        :param request: an object that will store parsed data.Must expose the
+            Request interface.
+        :param buffer: the bytearray the connection appends incoming data to
+        :return: buffer, without the request once it is finished. Bytes of a
+            pipelined request are left at its start.
+        '''
+        if self.state == self.REQUEST_LINE:
+            line_end = self._find(buffer, CRLF)
+            if line_end < 0:
+                return buffer
+            self._parse_request_line(request, buffer, line_end)
+            self._headers_start = self._scan = line_end + len(CRLF)
+            self.state = self.HEADERS
+
+        if self.state == self.HEADERS:
+            # the empty line right after the request line ends a request without headers
+            if buffer.startswith(CRLF, self._headers_start):
+                headers_end = self._headers_start - len(CRLF)
+            else:
+                headers_end = self._find(buffer, SEPARATOR)
+                if headers_end < 0:
+                    return buffer
+            request.headers = self._parse_headers(buffer, self._headers_start, headers_end)
+            self._body_start = headers_end + len(SEPARATOR)
+            self._content_length = self._body_length(request.headers)
+            self.state = self.BODY
+            if self.on_headers is not None and self.on_headers(request, self._content_length):
+                request.finished = True
+                del buffer[:self._body_start]
+                self.reset()
+                return buffer
+
+        if len(buffer) - self._body_start < self._content_length:
+            return buffer
+        if self._content_length:
+            with memoryview(buffer) as view:
+                request.body_raw, request.body = parse_body(
+                    request.headers, view[self._body_start:])
+        request.finished = True
+        del buffer[:self._body_start + self._content_length]
+        self.reset()
+        return buffer
+
+    def _body_length(self, headers):
+        '''
+        :return: the length of the body announced by the headers
+        '''
+        check_transfer_encoding(headers)
+        return get_content_length(headers) or 0
+
+    def _find(self, buffer, delimiter):
+        '''
+        Looks for delimiter in the bytes that were not scanned yet. The
+        search starts a little before them in case the delimiter was split
+        between two reads.
+
+        :return: the offset of delimiter or -1
+        '''
+        position = buffer.find(delimiter, max(self._scan - len(delimiter) + 1, 0))
+        if position < 0:
+            self._scan = len(buffer)
+            if self._scan > self.max_header_size:
+                raise BadRequestException('Request headers too large')
+        return position
+
+    def _parse_request_line(self, request, buffer, line_end):
+        if not REQUEST_LINE_REGEXP.match(buffer, 0, line_end):
+            raise BadRequestException('Invalid request line')
+        with memoryview(buffer) as view:
+            request_line = str(view[:line_end], 'utf-8')
+        method, raw_path = request_line.split(' ')[:2]
+        method = method.upper()
+        if method not in SUPPORTED_METHODS:
+            raise BadRequestException('{} method not supported'.format(method))
+        request.method = method
+        # the query string is only parsed if the handler reads query_params
+        request.path, request.raw_query = split_path(raw_path)
+
+    def _parse_headers(self, buffer, start, end):
+        '''
+        Checks the header block and keeps it undecoded in a Headers, the
+        one copy made of the request
+        '''
+        if start >= end:
+            return Headers()
+        with memoryview(buffer) as view:
+            block = bytes(view[start:end])
+        check_header_block(block)
+        return Headers(block)
+
+
+class ResponseParser(HTTPParser):
+    '''
+    Incremental parser for the responses read by framework.client: same
+    as HTTPParser with a status line instead of a request line. The body
+    is always left to the caller, which frames it from the headers, so a
+    response is finished once its headers are parsed.
+    '''
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE):
+        super().__init__(max_header_size, on_headers=lambda response, content_length: True)
+
+    def _body_length(self, headers):
+        # framed by ClientResponse, which also reads chunked bodies
+        return 0
+
+    def _parse_request_line(self, response, buffer, line_end):
+        match = STATUS_LINE_REGEXP.match(buffer, 0, line_end)
+        if match is None:
+            raise BadRequestException('Invalid status line')
+        version, code, reason = match.groups()
+        response.version = version.decode('ascii')
+        response.code = int(code)
+        response.reason = (reason or b'').decode('latin-1')
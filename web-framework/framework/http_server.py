@@ -4,31 +4,143 @@
 
 import logging
 import asyncio
+import math
 
-from framework.http_utils import Request, Response
-from framework.exceptions import BadRequestException, NotFoundException
+from framework.http_utils import (FileResponse, RequestBody, Response,
+                                  StreamingResponse, as_response, LAST_CHUNK)
+from framework.exceptions import (BadRequestException, NotFoundException,
+                                  PayloadTooLargeException, ProtocolException,
+                                  ServiceUnavailableException,
+                                  TooManyRequestsException, TimeoutException)
+from framework.metrics import UNMATCHED
+from framework.pool import BUFFERS, REQUESTS
+from framework.profiling import Profiled
+from framework.sse import EventStream
+from framework.timer_wheel import TimerWheel
 
 TIMEOUT = 5
+HEADER_TIMEOUT = TIMEOUT
+BODY_TIMEOUT = TIMEOUT
+HANDLER_TIMEOUT = 30
+WRITE_TIMEOUT = 30
+READ_SIZE = 65536
+KEEP_ALIVE_TIMEOUT = 15
+MAX_KEEP_ALIVE_REQUESTS = 100
+MAX_BODY_SIZE = 10 * 1024 * 1024
+RETRY_AFTER = 1
+ACCEPT_PAUSE = 0.5
+REJECT_LINGER = 1
+# bytes of a file sent per loop.sendfile call, each gets write_timeout
+SENDFILE_SIZE = 1024 * 1024
 
 
 class HTTPServer(object):
     '''
     Contains objects that are shared by HTTPConnections and schedules async
-    connections
+    connections, either from asyncio.start_server streams (handle_connection)
+    or as asyncio.Protocol instances for loop.create_server (protocol_factory)
 
     Each instance of HTTPServer can listen on one port
     '''
 
-    def __init__(self, router, http_parser, loop):
+    def __init__(self, router, http_parser, loop,
+                 keep_alive=True,
+                 keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+                 max_keep_alive_requests=MAX_KEEP_ALIVE_REQUESTS,
+                 header_timeout=HEADER_TIMEOUT,
+                 body_timeout=BODY_TIMEOUT,
+                 handler_timeout=HANDLER_TIMEOUT,
+                 write_timeout=WRITE_TIMEOUT,
+                 max_body_size=MAX_BODY_SIZE,
+                 metrics=None,
+                 max_connections=None,
+                 max_inflight=None,
+                 rate_limiter=None,
+                 retry_after=RETRY_AFTER,
+                 accept_pause=ACCEPT_PAUSE,
+                 compression=None,
+                 recorder=None,
+                 profiler=None):
         '''
         :param router:An object that must expose the 'get_handler' interface
-        :param http_parser: An object that must expose the 'parse_into' interface,
-        which works with a Request object and a bytearray
+        :param http_parser: An object that must expose 'HTTPParser', a factory of
+        objects implementing the 'parse_into' interface, which works with a
+        Request object and a bytearray
         :param loop: An object that implements the 'asyncio.BaseEventLoop' interface
+        :param keep_alive: whether connections are kept open between requests
+        :param keep_alive_timeout: seconds an idle keep-alive connection is
+            kept open while waiting for the next request
+        :param max_keep_alive_requests: number of requests served on a single
+            connection before it is closed
+        :param header_timeout: seconds a client has to send the request line
+            and headers once it started sending a request
+        :param body_timeout: seconds a client may stay silent while sending
+            the body of a request
+        :param handler_timeout: seconds a handler has to return a response
+        :param write_timeout: seconds a client has to read the response
+        :param max_body_size: requests announcing a larger body get a 413
+            before it is read, None for no limit. Routes can override it.
+        :param metrics: a framework.metrics.Metrics collecting request
+            metrics, None to collect none
+        :param max_connections: open connections at most, the following
+            ones get a 503 and are closed, None for no limit
+        :param max_inflight: requests handled at once at most, the following
+            ones get a 503, None for no limit
+        :param rate_limiter: a framework.admission.TokenBuckets limiting the
+            requests of each client IP, which get a 429 past it
+        :param retry_after: seconds sent in the Retry-After header of a 503
+        :param accept_pause: once a limit is hit, seconds during which new
+            connections get a 503 and are closed whatever the load
+        :param compression: a framework.compression.Compressor compressing
+            the responses the client accepts compressed, None to compress none
+        :param recorder: a framework.recorder.TrafficRecorder logging the
+            bytes received by a sample of the connections, None to log none
+        :param profiler: a framework.profiling.Profiler profiling a sample
+            of the requests, None to profile none
         '''
         self.router = router
         self.http_parser = http_parser
         self.loop = loop
+        self.keep_alive = keep_alive
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_keep_alive_requests = max_keep_alive_requests
+        self.header_timeout = header_timeout
+        self.body_timeout = body_timeout
+        self.handler_timeout = handler_timeout
+        self.write_timeout = write_timeout
+        self.max_body_size = max_body_size
+        self.metrics = metrics
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self.rate_limiter = rate_limiter
+        self.retry_after = retry_after
+        self.accept_pause = accept_pause
+        self.compression = compression
+        self.recorder = recorder
+        self.profiler = profiler
+        self.timer_wheel = TimerWheel(loop)
+        self.connections = set()
+        self.tasks = set()
+        self.requests_served = 0
+        self.inflight = 0
+        self.rejected_connections = 0
+        self.closing = False
+        self._paused_until = 0
+        self._overloaded = Response(
+            code=ServiceUnavailableException.code,
+            body=Response.reason_phrases[ServiceUnavailableException.code],
+            headers={'Retry-After': retry_after}).to_buffers(False)
+        if metrics is not None:
+            metrics.add_gauge('http_connections', 'Open connections',
+                              lambda: len(self.connections))
+            metrics.add_gauge('http_active_connections',
+                              'Connections receiving or processing a request',
+                              lambda: sum(1 for c in self.connections if not c.idle))
+            metrics.add_gauge('http_inflight_requests', 'Requests being handled',
+                              lambda: self.inflight)
+            metrics.add_gauge('http_rejected_connections',
+                              'Connections closed with a 503 since the start',
+                              lambda: self.rejected_connections)
 
     async def handle_connection(self, reader, writer):
         '''
@@ -38,18 +150,597 @@ class HTTPServer(object):
         :param writer: An object that implements the 'asyncio.StreamWriter' interface
         :return:
         '''
+        if not self.admit_connection():
+            self.reject(writer)
+            return
         connection = HTTPConnection(self, reader, writer)
-        asyncio.ensure_future(connection.handle_request(), loop=self.loop)
+        self.connections.add(connection)
+        connection._task = asyncio.ensure_future(connection.handle_request(), loop=self.loop)
+        self.track_task(connection._task)
 
+    def admit_connection(self):
+        '''
+        Decides whether a new connection is served or closed right away
+        with a 503, past max_connections or shortly after a limit was hit.
+        :return: Boolean
+        '''
+        if self.max_connections is not None and len(self.connections) >= self.max_connections:
+            self.pause_accepting()
+        elif self._paused_until == 0 or self.loop.time() >= self._paused_until:
+            self._paused_until = 0
+            return True
+        self.rejected_connections += 1
+        return False
+
+    def reject(self, transport):
+        '''
+        Answers a connection that was not admitted with a 503. Closing it
+        right away would reset it when the request it sent meanwhile is
+        unread, and the client might never see the 503: it's half-closed
+        and closed after REJECT_LINGER, the transport reading and dropping
+        the request in between.
+        :param transport: an asyncio.Transport or StreamWriter
+        '''
+        transport.writelines(self._overloaded)
+        if transport.can_write_eof():
+            transport.write_eof()
+        self.loop.call_later(REJECT_LINGER, transport.close)
+
+    def admit_request(self, client):
+        '''
+        Checks the rate of client and the number of requests in flight
+        before a request is handled
+        :param client: the IP of the client
+        :raise TooManyRequestsException: when client is over its rate
+        :raise ServiceUnavailableException: past max_inflight
+        '''
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.take(client)
+            if wait:
+                raise TooManyRequestsException(retry_after=int(math.ceil(wait)))
+        if self.max_inflight is not None and self.inflight >= self.max_inflight:
+            self.pause_accepting()
+            raise ServiceUnavailableException(retry_after=self.retry_after)
+
+    def pause_accepting(self):
+        '''
+        New connections get a 503 for accept_pause seconds, to let the
+        server catch up instead of taking more work.
+        '''
+        self._paused_until = self.loop.time() + self.accept_pause
+
+    def track_task(self, task):
+        '''
+        Keeps a reference to a task serving a connection until it is done,
+        so drain can wait for it
+        :param task: An asyncio.Task
+        '''
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def protocol_factory(self):
+        '''
+        Passed to loop.create_server, builds the HTTPProtocol handling
+        a new connection
+        :return: An instance of HTTPProtocol
+        '''
+        return HTTPProtocol(self)
+
+    async def drain(self, timeout):
+        '''
+        Closes idle connections and gives the others until timeout to
+        finish the request they are processing. No connection is kept
+        alive afterwards.
+        :param timeout: seconds to wait before closing the remaining connections
+        '''
+        self.closing = True
+        for connection in list(self.connections):
+            if connection.idle:
+                connection.close_connection()
+            else:
+                connection.end_events()
+        deadline = self.loop.time() + timeout
+        while self.connections and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for connection in list(self.connections):
+            connection.close_connection()
+        if self.tasks:
+            # let the tasks of the closed connections notice and finish
+            await asyncio.wait(list(self.tasks), timeout=1)
+        self.timer_wheel.close()
+
+
+class BaseHTTPConnection(object):
+    '''
+    Behaviour shared by the stream and the protocol based connections:
+    keep-alive decisions, replying through 'http_server.router',
+    error responses and the connection deadlines. Subclasses provide
+    write, writelines, drain, close_transport and the transport property.
 
-class HTTPConnection(object):
+    The buffer and the requests come from the free-lists of
+    framework.pool and go back to them once done with.
+    '''
+
+    __slots__ = ('http_server', 'router', 'http_parser', 'loop', 'keep_alive',
+                 'keep_alive_timeout', 'max_keep_alive_requests', 'metrics',
+                 '_buffer', '_parser', '_handler', '_task', '_writing', '_closed',
+                 'deadline', 'timer_slot', 'requests_served', 'peer', 'request',
+                 '_parse_time', '_route_time', '_recording', '_profile', '_subscriber')
+
+    def __init__(self, http_server):
+        '''
+        :param http_server: An instance of HTTPServer
+        '''
+        self.http_server = http_server
+        self.router = http_server.router
+        self.http_parser = http_server.http_parser
+        self.loop = http_server.loop
+        self.keep_alive = http_server.keep_alive
+        self.keep_alive_timeout = http_server.keep_alive_timeout
+        self.max_keep_alive_requests = http_server.max_keep_alive_requests
+        self.metrics = http_server.metrics
+
+        self._buffer = BUFFERS.acquire()
+        self._parser = self.http_parser.HTTPParser(on_headers=self._headers_received)
+        self._handler = None
+        self._task = None
+        self._writing = False
+        self._closed = False
+        self.deadline = None
+        self.timer_slot = None
+        self.requests_served = 0
+        self.peer = None
+        self.request = REQUESTS.acquire()
+        self._parse_time = 0.0
+        self._route_time = 0.0
+        # id of the connection in the traffic log, when it is recorded
+        self._recording = None if http_server.recorder is None else http_server.recorder.start()
+        # the cProfile.Profile of the request, when it is profiled
+        self._profile = None if http_server.profiler is None else http_server.profiler.sample()
+        # the framework.sse.Subscriber of an EventStream being sent
+        self._subscriber = None
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def writelines(self, buffers):
+        raise NotImplementedError
+
+    async def drain(self):
+        raise NotImplementedError
+
+    def close_transport(self):
+        raise NotImplementedError
+
+    @property
+    def transport(self):
+        raise NotImplementedError
+
+    # coroutine function that reads more of a streamed body, if the
+    # connection has to be asked for it
+    _fill_body = None
+
+    def _body_consumed(self):
+        pass
+
+    def should_keep_alive(self):
+        '''
+        Decides whether the connection stays open after the current request,
+        based on the server limits and the request's Connection header.
+        :return: Boolean
+        '''
+        if not self.keep_alive or self.http_server.closing:
+            return False
+        if self.requests_served + 1 >= self.max_keep_alive_requests:
+            return False
+        connection = self.request.get_header('connection', 'keep-alive')
+        return connection.lower() != 'close'
+
+    async def respond(self, keep_alive):
+        '''
+        Replies to the finished self.request once admitted by the server,
+        turning a missing route into a 404 and a rejected request into a 429
+        or 503, none of them closes the connection
+        :param keep_alive: whether the connection stays open afterwards
+        :return: whether the connection stays open afterwards, it can't when
+            the handler left part of a streamed body unread
+        '''
+        stream = self.request.body_stream
+        if stream is not None and not stream.received:
+            self._set_deadline(self.http_server.body_timeout)
+        else:
+            self._set_deadline(self.http_server.handler_timeout)
+        server = self.http_server
+        try:
+            server.admit_request(self.peer)
+            server.inflight += 1
+            try:
+                if self._profile is None:
+                    keep_alive = await self.reply(keep_alive)
+                else:
+                    keep_alive = await Profiled(self.reply(keep_alive), self._profile)
+            finally:
+                server.inflight -= 1
+                if self._profile is not None:
+                    self._end_profile()
+        except NotFoundException as e:
+            self.error_reply(e.code, body=Response.reason_phrases[e.code],
+                             keep_alive=keep_alive)
+        except ServiceUnavailableException as e:
+            headers = {} if e.retry_after is None else {'Retry-After': e.retry_after}
+            if stream is not None and not stream.received:
+                keep_alive = False
+            self.error_reply(e.code, body=Response.reason_phrases[e.code],
+                             keep_alive=keep_alive, headers=headers)
+        self.requests_served += 1
+        self.http_server.requests_served += 1
+        return keep_alive
+
+    async def reply(self, keep_alive=False):
+        '''
+        Obtains and apllies the correct handler from 'self.router'
+        and write the Response back to the client
+        :param keep_alive: whether the connection stays open afterwards
+        :return: keep_alive, False if part of a streamed body is still unread
+        '''
+        request = self.request
+        handler = self._handler or self.router.get_handler(request.path)  # Dependency injection
+        metrics = self.metrics
+        if metrics is not None:
+            started = metrics.clock()
+
+        response = as_response(await handler.handle(request))
+        if self.http_server.compression is not None:
+            response = await self.http_server.compression.compress(request, response)
+
+        if metrics is not None:
+            handled = metrics.clock()
+        if request.body_stream is not None and not request.body_stream.received:
+            keep_alive = False
+
+        buffers = response.to_buffers(keep_alive)
+        head_only = request.method == 'HEAD'
+        # the headers of a HEAD response announce the body of a GET
+        self._write_buffers(buffers[:2] if head_only else buffers)
+        self._writing = True
+        self._set_deadline(self.http_server.write_timeout)
+        if head_only:
+            await self.drain()
+            if isinstance(response, (StreamingResponse, FileResponse)):
+                await response.close()
+        elif isinstance(response, FileResponse):
+            keep_alive = await self.send_file(response, keep_alive)
+        else:
+            await self.drain()
+            if isinstance(response, EventStream):
+                keep_alive = await self.stream_events(response, keep_alive)
+            elif isinstance(response, StreamingResponse):
+                keep_alive = await self.write_chunks(response, keep_alive)
+        self._writing = False
+        if metrics is not None:
+            metrics.observe_request(handler.route, response.code, self._parse_time,
+                                    self._route_time, handled - started,
+                                    metrics.clock() - handled)
+        return keep_alive
+
+    async def write_chunks(self, response, keep_alive):
+        '''
+        Sends the body of a StreamingResponse chunk by chunk, waiting for
+        each chunk to be drained before asking for the next one. Each chunk
+        has handler_timeout to be produced and write_timeout to be sent.
+        The headers are already sent, an error closes the connection.
+        :param response: A StreamingResponse
+        :param keep_alive: whether the connection stays open afterwards
+        :return: keep_alive, False if the body could not be sent entirely
+        '''
+        chunks = response.chunks()
+        try:
+            while not self._closed:
+                self._set_deadline(self.http_server.handler_timeout)
+                try:
+                    buffers = await chunks.__anext__()
+                except StopAsyncIteration:
+                    return keep_alive
+                self._write_buffers(buffers)
+                self._set_deadline(self.http_server.write_timeout)
+                await self.drain()
+        except ConnectionError as e:
+            logging.debug(e)
+        except Exception as e:
+            logging.error(e)
+            logging.error(e.__traceback__)
+        finally:
+            await chunks.aclose()
+            await response.close()
+        self.close_connection()
+        return False
+
+    async def stream_events(self, response, keep_alive):
+        '''
+        Subscribes the connection to the Broadcaster of an EventStream
+        until either of them is closed. The broadcaster writes the events,
+        the connection only flushes those queued while the client wasn't
+        reading. There is no deadline, the heartbeats of the broadcaster
+        find the dead connections.
+        :param response: An EventStream, its headers are sent
+        :param keep_alive: whether the connection stays open afterwards
+        :return: keep_alive, False if the stream didn't end cleanly
+        '''
+        self._clear_deadline()
+        subscriber = self._subscriber = response.subscribe(self)
+        # a subscriber waiting for events doesn't count against max_inflight
+        self.http_server.inflight -= 1
+        try:
+            await subscriber.run()
+        except ConnectionError as e:
+            logging.debug(e)
+            subscriber.close(disconnected=True)
+        finally:
+            self.http_server.inflight += 1
+            self._subscriber = None
+            subscriber.close()
+        if not subscriber.disconnected and not self._closed:
+            self._write_buffers([LAST_CHUNK])
+            self._set_deadline(self.http_server.write_timeout)
+            await self.drain()
+            return keep_alive and not self.http_server.closing
+        self.close_connection()
+        return False
+
+    def end_events(self):
+        '''
+        Ends the EventStream being sent, if any, the browser reconnects
+        '''
+        if self._subscriber is not None:
+            self._subscriber.close()
+
+    async def send_file(self, response, keep_alive):
+        '''
+        Sends the body of a FileResponse with loop.sendfile, SENDFILE_SIZE
+        bytes at a time, each of them has write_timeout to be sent. The
+        headers are already written, an error closes the connection.
+        :param response: A FileResponse
+        :param keep_alive: whether the connection stays open afterwards
+        :return: keep_alive, False if the file could not be sent entirely
+        '''
+        try:
+            await self.drain()
+            if response.body is None:
+                return keep_alive  # the headers only, ie. for a HEAD request
+            offset, end = response.offset, response.offset + response.count
+            while offset < end and not self._closed:
+                self._set_deadline(self.http_server.write_timeout)
+                sent = await self.loop.sendfile(self.transport, response.body, offset,
+                                                min(SENDFILE_SIZE, end - offset))
+                if not sent:
+                    raise EOFError('{0} was truncated'.format(response.body.name))
+                if self.metrics is not None:
+                    self.metrics.bytes_out += sent
+                offset += sent
+            if offset == end:
+                return keep_alive
+        except ConnectionError as e:
+            logging.debug(e)
+        except Exception as e:
+            logging.error(e)
+            logging.error(e.__traceback__)
+        finally:
+            await response.close()
+        self.close_connection()
+        return False
+
+    @property
+    def idle(self):
+        '''
+        True between two requests, when nothing of the next one was received
+        '''
+        return not self._buffer and not self.request.method
+
+    def close_connection(self):
+        '''
+        Takes the connection out of the timer wheel and closes it
+        '''
+        self.http_server.connections.discard(self)
+        self._closed = True
+        self._clear_deadline()
+        self._end_recording()
+        if self._subscriber is not None:
+            self._subscriber.close(disconnected=True)
+        self.close_transport()
+
+    def expire(self):
+        '''
+        Called by the timer wheel once the deadline passed. An idle
+        keep-alive connection is closed without a response, a slow client
+        gets a 408 and a slow handler a 500, unless the response was
+        being written.
+        '''
+        self.deadline = None
+        if self.idle:
+            self.close_connection()
+        elif not self.request.finished:
+            self.error_reply(408, body=Response.reason_phrases[408])
+            self.close_connection()
+        else:
+            if not self._writing:
+                self.error_reply(TimeoutException.code, 'timeout')
+            self.close_connection()
+            if self._task is not None:
+                self._task.cancel()
+
+    def _set_deadline(self, timeout):
+        deadline = self.loop.time() + timeout
+        if self.deadline is not None and deadline < self.deadline:
+            # the slot of the later deadline would come round too late
+            self.http_server.timer_wheel.remove(self)
+        self.deadline = deadline
+        self.http_server.timer_wheel.add(self)
+
+    def _clear_deadline(self):
+        self.deadline = None
+        self.http_server.timer_wheel.remove(self)
+
+    def _data_received(self, data):
+        '''
+        Appends data to the buffer, parses it and moves the deadline: a new
+        request gets header_timeout to send its headers, the body must
+        keep flowing within body_timeout
+        '''
+        if self.idle:
+            self._set_deadline(self.http_server.header_timeout)
+        self._buffer.extend(data)
+        self._parse_buffer()
+        if self._parser.state == self._parser.BODY:
+            self._set_deadline(self.http_server.body_timeout)
+
+    def _parse_buffer(self):
+        profile = self._profile
+        if profile is not None:
+            profile.enable()
+        try:
+            self._parse_into()
+        finally:
+            if profile is not None:
+                profile.disable()
+        self._feed_body()
+
+    def _parse_into(self):
+        if self.metrics is None:
+            self._buffer = self._parser.parse_into(self.request, self._buffer)
+        else:
+            started = self.metrics.clock()
+            route_time = self._route_time
+            self._buffer = self._parser.parse_into(self.request, self._buffer)
+            # the route lookup runs within parse_into, from _headers_received
+            self._parse_time += (self.metrics.clock() - started -
+                                 (self._route_time - route_time))
+
+    def _headers_received(self, request, content_length):
+        '''
+        Called by the parser once the headers are parsed. Routes the request
+        right away, to reject a body over the size limit before reading it,
+        and to hand the body of a stream_body route to its handler as it
+        arrives instead of buffering it.
+
+        :return: True when the body is streamed
+        '''
+        if self._profile is None and self.http_server.profiler is not None:
+            self._profile = self.http_server.profiler.marked(request)
+        try:
+            if self.metrics is None:
+                self._handler = self.router.get_handler(request.path)
+            else:
+                started = self.metrics.clock()
+                try:
+                    self._handler = self.router.get_handler(request.path)
+                finally:
+                    self._route_time = self.metrics.clock() - started
+        except NotFoundException:
+            return False  # answered with a 404 once the request is read
+        max_body_size = getattr(self._handler, 'max_body_size', None)
+        if max_body_size is None:
+            max_body_size = self.http_server.max_body_size
+        if max_body_size is not None and content_length > max_body_size:
+            raise PayloadTooLargeException()
+        if not getattr(self._handler, 'stream_body', False):
+            return False
+        request.body_stream = RequestBody(content_length, self._fill_body,
+                                          self._body_consumed)
+        return True
+
+    def _feed_body(self):
+        '''
+        Moves the bytes of a streamed body from the buffer to the request's
+        body_stream. Bytes of a pipelined request stay in the buffer.
+        '''
+        stream = self.request.body_stream
+        if stream is None or stream.received:
+            return
+        if self._buffer:
+            size = min(len(self._buffer), stream.remaining)
+            with memoryview(self._buffer) as view:
+                stream.feed(view[:size])
+            del self._buffer[:size]
+        if stream.received:
+            self._set_deadline(self.http_server.handler_timeout)
+        else:
+            self._set_deadline(self.http_server.body_timeout)
+
+    def _next_request(self):
+        request, self.request = self.request, REQUESTS.acquire()
+        self._handler = None
+        self._parse_time = 0.0
+        self._route_time = 0.0
+        if self.http_server.profiler is not None:
+            self._profile = self.http_server.profiler.sample()
+        REQUESTS.release(request)
+
+    def _recycle(self):
+        '''
+        Gives the buffer and the request back to their free-list, once the
+        connection is closed and nothing runs for it anymore
+        '''
+        if self.request is None:
+            return
+        request, self.request = self.request, None
+        buffer, self._buffer = self._buffer, b''
+        REQUESTS.release(request)
+        BUFFERS.release(buffer)
+
+    def _write_buffers(self, buffers):
+        if self.metrics is not None:
+            self.metrics.bytes_out += sum(map(len, buffers))
+        self.writelines(buffers)
+
+    def _received(self, data):
+        '''
+        Called with every chunk read from the connection
+        '''
+        if self.metrics is not None:
+            self.metrics.bytes_in += len(data)
+        if self._recording is not None:
+            self.http_server.recorder.write(self._recording, data)
+
+    def _end_profile(self):
+        route = getattr(self._handler, 'route', None) or UNMATCHED
+        profile, self._profile = self._profile, None
+        self.http_server.profiler.add(route, profile)
+
+    def _end_recording(self):
+        if self._recording is not None:
+            self.http_server.recorder.end(self._recording)
+            self._recording = None
+
+    def error_reply(self, code, body='', keep_alive=False, headers=None):
+        '''
+        Generates a simple error response
+        :param code: Integer singifying the HTTP error.
+        :param body: A string that contains an error message.
+        :param keep_alive: whether the connection stays open afterwards
+        :param headers: a dict of additional headers
+        :return:
+        '''
+        if self._closed:
+            return
+        if self.metrics is not None:
+            route = self._handler.route if self._handler is not None else UNMATCHED
+            self.metrics.count(route, code)
+        response = Response(code=code, body=body, headers=headers or {})
+        self._write_buffers(response.to_buffers(keep_alive))
+
+
+class HTTPConnection(BaseHTTPConnection):
     '''
     Takes care of whole life cycle of a single TCP connection with a
     HTTP client. First reads incoming data, parses it with
     'http_server.parser',generates as Response with 'http_server.router'
-    and sends data back to client
+    and sends data back to client. Unless the client or the server asks
+    for the connection to be closed, this is repeated for every request
+    sent over the connection, pipelined requests are answered in order.
     '''
 
+    __slots__ = ('_reader', '_writer')
+
     def __init__(self, http_server, reader, writer):
         '''
 
@@ -57,42 +748,61 @@ class HTTPConnection(object):
         :param reader: An object that implements the 'asyncio.StreamReader' interface
         :param writer: An object that implements the 'asyncio.StreamWriter' interface
         '''
-        self.router = http_server.router
-        self.http_parser = http_server.http_parser
-        self.loop = http_server.loop
-
+        super().__init__(http_server)
         self._reader = reader
         self._writer = writer
-        self._buffer = bytearray()
-        self._conn_timeout = None
-        self.request = Request()
+        peer = writer.get_extra_info('peername')
+        self.peer = peer[0] if isinstance(peer, tuple) else None  # '' on a Unix socket
 
     async def handle_request(self):
         '''
         Reads bytes from a connection and attempts to parse them
-        incrementally until it can issue a Response and close the
-        connection.
+        incrementally until it can issue a Response. Keeps doing so for
+        the following requests until the connection has to be closed.
         Also handles resetting the timeout counter for a connection
         :return:
         '''
+        self.http_server.connections.add(self)
         try:
-            while not self.request.finished and not self._reader.at_eof():  # 循环的接受请求内容
-                data = await self._reader.read(1024)
-                if data:
-                    self._reset_conn_timeout()
-                    await self.process_data(data)
-            if self.request.finished:
-                await self.reply()
-            elif self._reader.at_eof():
-                raise BadRequestException()
-        except (NotFoundException, BadRequestException) as e:
+            self._set_deadline(self.http_server.header_timeout)
+            while not self._closed:
+                await self.read_request()
+                if not self.request.finished:
+                    if not self.idle:
+                        raise BadRequestException()
+                    break  # client went away between two requests
+
+                keep_alive = await self.respond(self.should_keep_alive())
+                if not keep_alive:
+                    break
+                self._next_request()
+                self._set_deadline(self.keep_alive_timeout)
+        except ProtocolException as e:
             self.error_reply(e.code, body=Response.reason_phrases[e.code])
         except Exception as e:
             logging.error(e)
             logging.error(e.__traceback__)
             self.error_reply(500, body=Response.reason_phrases[500])
+        finally:
+            # also when the task is cancelled, ie. by the handler timeout
+            self.close_connection()
+            self._recycle()
 
-        self.close_connection()
+    async def read_request(self):
+        '''
+        Reads from the connection until self.request is complete or
+        the client closes the connection. A pipelined request may already
+        be sitting in the buffer, so it is parsed before reading.
+        :return:
+        '''
+        if self._buffer:
+            self._set_deadline(self.http_server.header_timeout)
+            self._parse_buffer()
+        while not self.request.finished and not self._reader.at_eof():  # 循环的接受请求内容
+            data = await self._reader.read(READ_SIZE)
+            if data:
+                self._received(data)
+                await self.process_data(data)
 
     async def process_data(self, data):
         '''
@@ -101,56 +811,220 @@ class HTTPConnection(object):
         :param data: a bytearray object
         :return:
         '''
+        self._data_received(data)
+
+    async def _fill_body(self):
+        data = await self._reader.read(READ_SIZE)
+        if not data:
+            self.request.body_stream.abort()
+            return
+        self._received(data)
         self._buffer.extend(data)
-        self._buffer = self.http_parser.parse_into(
-            self.request, self._buffer)
+        self._feed_body()
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def writelines(self, buffers):
+        self._writer.writelines(buffers)
+
+    async def drain(self):
+        await self._writer.drain()
+
+    def close_transport(self):
+        self._writer.close()
+
+    @property
+    def transport(self):
+        return self._writer.transport
+
+
+class HTTPProtocol(BaseHTTPConnection, asyncio.Protocol):
+    '''
+    Same life cycle as HTTPConnection, driven by the event loop callbacks
+    of an 'asyncio.Protocol' instead of streams: data_received feeds the
+    parser directly and a task is only created to run the handler of a
+    finished request. Writes go straight to the transport, drain only
+    waits when the transport asked to pause writing.
+    '''
+
+    __slots__ = ('_transport', '_eof', '_reading_paused', '_drain_waiter', '_lost')
 
-    async def reply(self):
+    def __init__(self, http_server):
         '''
-        Obtains and apllies the correct handler from 'self.router'
-        and write the Response back to the client
-        :return:
+        :param http_server: An instance of HTTPServer
         '''
+        super().__init__(http_server)
+        self._transport = None
+        self._eof = False
+        self._reading_paused = False
+        self._drain_waiter = None
+        self._lost = False
 
-        logging.debug("Replying to request")
-        request = self.request
-        handler = self.router.get_handler(request.path)  # Dependency injection
+    def connection_made(self, transport):
+        self._transport = transport
+        if not self.http_server.admit_connection():
+            self._closed = True
+            self.http_server.reject(transport)
+            return
+        peer = transport.get_extra_info('peername')
+        self.peer = peer[0] if isinstance(peer, tuple) else None  # '' on a Unix socket
+        self.http_server.connections.add(self)
+        self._set_deadline(self.http_server.header_timeout)
 
-        response = await handler.handle(request)
+    def data_received(self, data):
+        if self._closed:
+            return
+        self._received(data)
+        if self._task is not None:
+            self._buffer.extend(data)
+            self._feed_body()
+            if self._buffered() > READ_SIZE and not self._reading_paused:
+                # the body or pipelined requests pile up while the handler runs
+                self._reading_paused = True
+                self._transport.pause_reading()
+            return
+        try:
+            self._data_received(data)
+        except ProtocolException as e:
+            self.error_reply(e.code, body=Response.reason_phrases[e.code])
+            self.close_connection()
+            return
+        if self.request.finished:
+            self._start_handler()
 
-        if not isinstance(response, Response):
-            response = Response(code=200, body=response)
+    def eof_received(self):
+        if self._closed:
+            return False
+        self._eof = True
+        stream = self.request.body_stream
+        if stream is not None and not stream.received:
+            stream.abort()
+        if self._task is None:
+            # answers a partial request with a 400 and closes
+            self._parse()
+        # keep the transport open to write the response being prepared
+        return True
 
-        self._writer.write(response.to_bytes())
-        await self._writer.drain()
+    def connection_lost(self, exc):
+        self.http_server.connections.discard(self)
+        self._closed = True
+        self._clear_deadline()
+        self._wake_drain_waiter()
+        self._lost = True
+        self._end_recording()
+        if self._subscriber is not None:
+            self._subscriber.close(disconnected=True)
+        if self.request.body_stream is not None and not self.request.body_stream.received:
+            self.request.body_stream.abort()
+        if self._task is None:
+            self._recycle()
 
-    def close_connection(self):
+    def _buffered(self):
+        stream = self.request.body_stream
+        return len(self._buffer) + (stream.buffered if stream is not None else 0)
+
+    def _body_consumed(self):
+        if self._reading_paused and self._buffered() <= READ_SIZE:
+            self._reading_paused = False
+            self._transport.resume_reading()
+
+    def pause_writing(self):
+        if self._drain_waiter is None:
+            self._drain_waiter = self.loop.create_future()
+
+    def resume_writing(self):
+        self._wake_drain_waiter()
+
+    def _wake_drain_waiter(self):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def _parse(self):
         '''
-        Cancels the timeout timer and closes the connection
+        Parses the buffer into self.request, starts a task running the
+        handler once the request is finished
         '''
-        self._cancel_conn_timeout()
-        self._writer.close()
-
-    def _conn_timeout_close(self):
-        self.error_reply(500, 'timeout')
-        self.close_connection()
+        if self._parse_request():
+            self._start_handler()
 
-    def _cancel_conn_timeout(self):
-        if self._conn_timeout:
-            self._conn_timeout.cancel()
+    def _start_handler(self):
+        self._task = self.loop.create_task(self._handle())
+        self.http_server.track_task(self._task)
 
-    def _reset_conn_timeout(self, timeout=TIMEOUT):
-        self._cancel_conn_timeout()
-        self._conn_timeout = self.loop.call_later(
-            timeout, self._conn_timeout_close)
+    def _parse_request(self):
+        '''
+        :return: True when self.request is finished
+        '''
+        if self._buffer:
+            self._set_deadline(self.http_server.header_timeout)
+        try:
+            self._parse_buffer()
+        except ProtocolException as e:
+            self.error_reply(e.code, body=Response.reason_phrases[e.code])
+            self.close_connection()
+            return False
+        if self.request.finished:
+            return True
+        if self._eof:
+            if not self.idle:
+                self.error_reply(400, body=Response.reason_phrases[400])
+            self.close_connection()
+        return False
 
-    def error_reply(self, code, body=''):
+    async def _handle(self):
         '''
-        Generates a simple error response
-        :param code: Integer singifying the HTTP error.
-        :param body: A string that contains an error message.
-        :return:
+        Replies to the finished request, then to the pipelined requests
+        already received, within the same task
         '''
-        response = Response(code=code, body=body)
-        self._writer.write(response.to_bytes())
-        self._writer.drain()
+        while True:
+            keep_alive = self.should_keep_alive() and not self._eof
+            try:
+                keep_alive = await self.respond(keep_alive)
+            except asyncio.CancelledError:
+                # ie. by the handler timeout, connection_lost recycles
+                # the connection once the task is gone
+                self._task = None
+                self.close_connection()
+                if self._lost:
+                    self._recycle()
+                raise
+            except Exception as e:
+                logging.error(e)
+                logging.error(e.__traceback__)
+                self.error_reply(500, body=Response.reason_phrases[500])
+                keep_alive = False
+            if not keep_alive or self._closed:
+                self._task = None
+                self.close_connection()
+                if self._lost:
+                    self._recycle()
+                return
+            self._next_request()
+            self._set_deadline(self.keep_alive_timeout)
+            if not ((self._buffer or self._eof) and self._parse_request()):
+                break
+        self._task = None
+        if self._reading_paused:
+            self._reading_paused = False
+            self._transport.resume_reading()
+
+    def write(self, data):
+        if not self._closed:
+            self._transport.write(data)
+
+    def writelines(self, buffers):
+        if not self._closed:
+            self._transport.writelines(buffers)
+
+    async def drain(self):
+        if self._drain_waiter is not None:
+            await self._drain_waiter
+
+    def close_transport(self):
+        self._transport.close()
+
+    @property
+    def transport(self):
+        return self._transport
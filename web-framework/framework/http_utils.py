@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 # Project : web-framework
 # Created by igor on 16/9/22
+import asyncio
+import collections
+import os
+import tempfile
+from urllib import parse
+
+from framework.exceptions import BadRequestException
+
+SPOOL_THRESHOLD = 1024 * 1024
+CRLF = b'\r\n'
+
 
 def utf8_bytes(text):
     '''
@@ -14,20 +25,334 @@ def utf8_bytes(text):
     return text
 
 
+class Headers(object):
+    '''
+    Case-insensitive multidict of the headers of a request, built from the
+    raw header block: lines of 'name: value' separated by CRLF.
+
+    Nothing is decoded until a header is accessed. Looking one header up
+    searches a lower-cased copy of the raw block for 'CRLF name:', only
+    iterating, counting or modifying the headers decodes all of them.
+    Repeated headers are kept, headers[name] and get return the first
+    value, getall every value.
+    '''
+
+    __slots__ = ('_raw', '_lower', '_items')
+
+    def __init__(self, raw=b'', items=None):
+        '''
+        :param raw: bytes of the header block
+        :param items: a dict or an iterable of (name, value) pairs, instead of raw
+        '''
+        self._raw = raw
+        self._lower = None
+        self._items = None
+        if items is not None:
+            items = items.items() if hasattr(items, 'items') else items
+            self._items = [(name, str(value)) for name, value in items]
+
+    def _decoded(self):
+        if self._items is None:
+            items = []
+            for line in self._raw.split(b'\r\n'):
+                name, _, value = line.partition(b':')
+                if name:
+                    items.append((_decode(name.strip()), _decode(value.strip())))
+            self._items = items
+        return self._items
+
+    def getall(self, name, default=()):
+        '''
+        :param name: name of the header, in any case
+        :return: a list of the values of every header named name, in the
+            order they were sent, or default
+        '''
+        if self._items is None:
+            values = [_decode(value) for value in self._find(name)]
+        else:
+            name = name.lower()
+            values = [value for key, value in self._items if key.lower() == name]
+        return values or default
+
+    def get(self, name, default=None):
+        if self._items is None:
+            for value in self._find(name):
+                return _decode(value)
+            return default
+        values = self.getall(name)
+        return values[0] if values else default
+
+    def _find(self, name):
+        '''
+        :return: a generator of the raw values of the header name
+        '''
+        if self._lower is None:
+            # the CRLF in front lets the first line match like the others
+            self._lower = CRLF + self._raw.lower()
+        lower = self._lower
+        key = CRLF + name.lower().encode('utf-8') + b':'
+        position = lower.find(key)
+        while position >= 0:
+            start = position + len(key)
+            end = lower.find(CRLF, start)
+            if end < 0:
+                end = len(lower)
+            yield self._raw[start - len(CRLF):end - len(CRLF)].strip()
+            position = lower.find(key, end)
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self._remove(name)
+        self._items.append((name, str(value)))
+
+    def __delitem__(self, name):
+        if not self._remove(name):
+            raise KeyError(name)
+
+    def add(self, name, value):
+        '''
+        Adds a header, keeping the ones with the same name
+        '''
+        self._decoded().append((name, str(value)))
+
+    def _remove(self, name):
+        items = self._decoded()
+        name = name.lower()
+        kept = [item for item in items if item[0].lower() != name]
+        removed = len(items) - len(kept)
+        items[:] = kept
+        return removed
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __bool__(self):
+        return bool(self._raw) if self._items is None else bool(self._items)
+
+    def keys(self):
+        return [name for name, _ in self._decoded()]
+
+    def values(self):
+        return [value for _, value in self._decoded()]
+
+    def items(self):
+        return list(self._decoded())
+
+    def __eq__(self, other):
+        if isinstance(other, Headers):
+            return self.items() == other.items()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __repr__(self):
+        return 'Headers({0!r})'.format(self.items())
+
+    def __getstate__(self):
+        return self._raw, self._items
+
+    def __setstate__(self, state):
+        self._raw, self._items = state
+        self._lower = None
+
+
+def _decode(value):
+    return str(value, 'utf-8', 'replace')
+
+
 class Request(object):
     '''
-    Container for data related to an HTTP request
+    Container for data related to an HTTP request.
+
+    The query string is kept as it was received in raw_query and only
+    parsed when query_params is first read.
     '''
 
+    __slots__ = ('method', 'path', 'raw_query', '_query_params', 'path_params',
+                 'headers', 'body', 'body_raw', 'body_stream', 'finished', 'kept')
+
     def __init__(self):
+        self.reset()
+
+    def reset(self):
+        '''
+        Empties the request, to be reused for the next one
+        '''
         self.method = None
         self.path = None
-        self.query_params = {}
+        self.raw_query = ''
+        self._query_params = None
         self.path_params = {}
-        self.headers = {}
+        self.headers = Headers()
         self.body = None
         self.body_raw = None
+        self.body_stream = None
         self.finished = False
+        self.kept = False
+
+    def keep(self):
+        '''
+        To be called by a handler using the request after its response,
+        ie. in a task it started: a kept request is never reset and
+        reused for another request, see framework.pool
+        :return: self
+        '''
+        self.kept = True
+        return self
+
+    @property
+    def query_params(self):
+        '''
+        A dict of the query params in the form of {key:[val]}
+        '''
+        if self._query_params is None:
+            self._query_params = parse.parse_qs(self.raw_query)
+        return self._query_params
+
+    @query_params.setter
+    def query_params(self, query_params):
+        self._query_params = query_params
+
+    def get_header(self, header, default=None):
+        '''
+        Case-insensitive lookup of a request header.
+
+        :param header: A string with the header name.
+        :param default: returned when the header is missing.
+        :return: A string - value of the header
+        '''
+        if isinstance(self.headers, Headers):
+            return self.headers.get(header, default)
+        header = header.lower()
+        for name, value in self.headers.items():
+            if name.lower() == header:
+                return value
+        return default
+
+    def snapshot(self):
+        '''
+        :return: a copy of the request without its body_stream, which can
+            be pickled to be handled in another process
+        '''
+        request = Request()
+        request.method = self.method
+        request.path = self.path
+        request.raw_query = self.raw_query
+        request._query_params = self._query_params
+        request.path_params = self.path_params
+        request.headers = self.headers
+        request.body = self.body
+        request.body_raw = self.body_raw
+        request.finished = self.finished
+        return request
+
+
+class RequestBody(object):
+    '''
+    Body of a request handed to the handler as it arrives, for routes added
+    with stream_body=True. It is an async iterator of bytes chunks:
+
+        async for chunk in request.body_stream:
+            ...
+
+    The connection pushes chunks with feed. When nothing is buffered, the
+    optional 'fill' coroutine function is awaited to receive more.
+    '''
+
+    __slots__ = ('content_length', 'remaining', 'buffered', '_chunks', '_fill',
+                 '_on_consumed', '_waiter', '_exception')
+
+    def __init__(self, content_length, fill=None, on_consumed=None):
+        '''
+        :param content_length: size of the body in bytes
+        :param fill: coroutine function that feeds more data, if any
+        :param on_consumed: called without arguments every time the handler
+            takes a chunk, to resume reading
+        '''
+        self.content_length = content_length
+        self.remaining = content_length
+        self.buffered = 0
+        self._chunks = collections.deque()
+        self._fill = fill
+        self._on_consumed = on_consumed
+        self._waiter = None
+        self._exception = None
+
+    @property
+    def received(self):
+        '''
+        True once every byte of the body arrived
+        '''
+        return self.remaining == 0
+
+    def feed(self, data):
+        if data:
+            self._chunks.append(bytes(data))
+            self.buffered += len(data)
+            self.remaining -= len(data)
+        self._wake()
+
+    def abort(self, exception=None):
+        '''
+        Makes the handler reading the body fail, ie. when the client went away
+        '''
+        self._exception = exception or BadRequestException('Incomplete body')
+        self._wake()
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._chunks:
+            if self._exception is not None:
+                raise self._exception
+            if self.remaining == 0:
+                raise StopAsyncIteration
+            if self._fill is not None:
+                await self._fill()
+            else:
+                self._waiter = asyncio.get_event_loop().create_future()
+                await self._waiter
+        chunk = self._chunks.popleft()
+        self.buffered -= len(chunk)
+        if self._on_consumed is not None:
+            self._on_consumed()
+        return chunk
+
+    async def read(self):
+        '''
+        :return: the whole body as bytes
+        '''
+        return b''.join([chunk async for chunk in self])
+
+    async def spool(self, threshold=SPOOL_THRESHOLD):
+        '''
+        Writes the body to a file that stays in memory up to threshold bytes
+        and is moved to a temporary file on disk past it.
+
+        :return: a tempfile.SpooledTemporaryFile positioned at its start
+        '''
+        spooled = tempfile.SpooledTemporaryFile(max_size=threshold)
+        async for chunk in self:
+            spooled.write(chunk)
+        spooled.seek(0)
+        return spooled
 
 
 class Response(object):
@@ -36,9 +361,13 @@ class Response(object):
     can translate itself into a series of bytes
     '''
 
+    # __dict__ keeps the attributes handlers set on their responses
+    __slots__ = ('code', 'body', 'headers', '__dict__')
+
     reason_phrases = {
         200: 'OK',
         204: 'No Content',
+        206: 'Partial Content',
         301: 'Moved Permanently',
         302: 'Found',
         304: 'Not Modified',
@@ -46,45 +375,316 @@ class Response(object):
         401: 'Unauthorized',
         403: 'Forbidden',
         404: 'Not Found',
+        405: 'Method Not Allowed',
+        408: 'Request Timeout',
+        413: 'Payload Too Large',
+        416: 'Range Not Satisfiable',
+        429: 'Too Many Requests',
         451: 'Unavailable for Legal Reasons',
         500: 'Internal Server Error',
+        501: 'Not Implemented',
+        502: 'Bad Gateway',
+        503: 'Service Unavailable',
+        504: 'Gateway Timeout',
     }
 
     def __init__(self, code=200, body=b"", **kwargs):
         self.code = code
         self.body = body
-        self.headers = kwargs.get('headers', {})
-        self.headers['content-type'] = kwargs.get('content_type',
-                                                  'text/html')
+        content_type = kwargs.get('content_type', 'text/html')
+        if 'headers' in kwargs:
+            self.headers = dict(kwargs['headers'])
+            # the default type doesn't replace a Content-Type of the headers
+            if 'content_type' in kwargs or not any(
+                    name.lower() == 'content-type' for name in self.headers):
+                self.set_header('Content-Type', content_type)
+        else:
+            self.headers = {'Content-Type': content_type}
 
     def _build_response(self, encoding_fn=utf8_bytes):
         '''
-        Translates self into a series of bytes
+        Translates self into a series of bytes. The body is encoded once
+        and its length in bytes is used for Content-Length.
 
         :param encoding_fn: The function responsible for encoding strings
             into bytes using the *correct charset*.
-        :return: A bytes object representing the HTTP response.
-        '''
-        response_line = 'HTTP/1.1 {0} {1}'.format(
-            self.code, self.reason_phrases[self.code])
-        self.headers = {**self.headers,
-                        **{'Content-Length': len(self.body)}}
-        headers = '\r\n'.join(
-            [': '.join([k, str(v)]) for k, v in self.headers.items()]
-        )
-        headers += '\r\n'
-        return b'\r\n'.join(map(encoding_fn, [response_line, headers, self.body]))
+        :return: A tuple of bytes objects, the status line and headers
+            without the final empty line, and the body.
+        '''
+        body = encoding_fn(self.body)
+        head = [status_line(self.code)]
+        for k, v in self.headers.items():
+            if k.lower() != 'content-length':
+                head.append(header_line(k, v))
+        head.append(b'Content-Length: %d\r\n' % len(body))
+        return b''.join(head), body
 
     def set_header(self, header, value=b''):
         '''
-        Helper method to set a HTTP header.
+        Helper method to set a HTTP header. Replaces a header with the
+        same name whatever its case.
 
         :param header:  A string with the headername.
         :param value: A bytes object - value of header
         :return:
         '''
-
+        lower = header.lower()
+        for name in [name for name in self.headers if name.lower() == lower]:
+            del self.headers[name]
         self.headers[header] = value
 
+    def to_buffers(self, keep_alive=None):
+        '''
+        Serializes self into a list of buffers meant for writelines, so the
+        body is never concatenated to the headers.
+
+        :param keep_alive: adds a 'Connection: keep-alive' header when True,
+            'Connection: close' when False and nothing when None
+        :return: A list of bytes objects
+        '''
+        head, body = self._build_response()
+        return [head, CONNECTION_HEADERS[keep_alive], body]
+
+    def to_bytes(self):
+        return b''.join(self.to_buffers())
+
+    def freeze(self):
+        '''
+        Serializes self once. The returned FrozenResponse can be returned by
+        a handler for every request without being built again.
+
+        :return: A FrozenResponse
+        '''
+        return FrozenResponse(self)
+
+
+class FrozenResponse(Response):
+    '''
+    Immutable, pre-serialized copy of a Response
+    '''
+
+    __slots__ = ('_head', '_body', 'variants')
+
+    def __init__(self, response):
+        self.code = response.code
+        self.body = response.body
+        self.headers = dict(response.headers)
+        self._head, self._body = response._build_response()
+        # compressed copies by encoding, and the uncompressed one with a Vary
+        # header under None, see framework.compression
+        self.variants = {}
+
+    def _build_response(self, encoding_fn=utf8_bytes):
+        return self._head, self._body
+
+    def set_header(self, header, value=b''):
+        raise TypeError('A frozen response can not be modified')
+
+    def freeze(self):
+        return self
+
+
+class EmptyResponse(Response):
+    '''
+    Response without a body whose headers are sent as they are: no
+    Content-Type is added and Content-Length is only sent when the
+    headers have one, ie. a 304, a 204 or the headers of a HEAD response
+    relayed from an upstream server
+    '''
+
+    __slots__ = ()
+
+    def __init__(self, code=204, headers=None):
+        '''
+        :param headers: a dict, or Headers to keep repeated headers
+        '''
+        self.code = code
+        self.body = b''
+        self.headers = {} if headers is None else headers
+
+    def _build_response(self, encoding_fn=utf8_bytes):
+        head = [status_line(self.code)]
+        for k, v in self.headers.items():
+            head.append(header_line(k, v))
+        return b''.join(head), b''
+
+
+class StreamingResponse(Response):
+    '''
+    Response whose body is an async iterable of strings or bytes, such as an
+    async generator. It is sent with 'Transfer-Encoding: chunked', one
+    chunk per item, as the items are produced.
+    '''
+
+    __slots__ = ()
+
+    def _build_response(self, encoding_fn=utf8_bytes):
+        head = [status_line(self.code)]
+        for k, v in self.headers.items():
+            if k.lower() not in ('content-length', 'transfer-encoding'):
+                head.append(header_line(k, v))
+        head.append(b'Transfer-Encoding: chunked\r\n')
+        return b''.join(head), None
+
+    def to_buffers(self, keep_alive=None):
+        '''
+        :return: A list of bytes objects with the status line and the
+            headers only, the chunks are obtained from 'chunks'
+        '''
+        head, _ = self._build_response()
+        return [head, CONNECTION_HEADERS[keep_alive]]
+
     def to_bytes(self):
-        return self._build_response()
+        raise TypeError('A streaming response can not be serialized at once')
+
+    def freeze(self):
+        raise TypeError('A streaming response can not be frozen')
+
+    async def chunks(self, encoding_fn=utf8_bytes):
+        '''
+        Iterates over the body, framing every non empty item as a chunk
+        and ending with the last, empty, chunk.
+
+        :return: An async iterator of lists of bytes objects
+        '''
+        async for data in self.body:
+            data = encoding_fn(data)
+            if data:
+                yield [b'%x\r\n' % len(data), data, b'\r\n']
+        yield [LAST_CHUNK]
+
+    async def close(self):
+        '''
+        Closes the body if it is an async generator that was not exhausted
+        '''
+        aclose = getattr(self.body, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+class FileResponse(Response):
+    '''
+    Response whose body is 'count' bytes of an open binary file, starting at
+    'offset'. The connection sends them with loop.sendfile, which uses the
+    sendfile system call when the transport allows it, so the body never
+    goes through Python memory.
+    '''
+
+    __slots__ = ('offset', 'count', '_on_close')
+
+    def __init__(self, file, offset=0, count=None, code=200, on_close=None, **kwargs):
+        '''
+        :param file: a file opened in binary mode, None to send the headers
+            only, ie. for a HEAD request
+        :param offset: position of the first byte to send
+        :param count: number of bytes to send, defaults to the rest of the file
+        :param on_close: called with the file once it is sent, or couldn't
+            be, defaults to closing it
+        '''
+        super().__init__(code=code, body=file, **kwargs)
+        if count is None:
+            count = os.fstat(file.fileno()).st_size - offset
+        self.offset = offset
+        self.count = count
+        self._on_close = on_close
+
+    def _build_response(self, encoding_fn=utf8_bytes):
+        head = [status_line(self.code)]
+        for k, v in self.headers.items():
+            if k.lower() != 'content-length':
+                head.append(header_line(k, v))
+        head.append(b'Content-Length: %d\r\n' % self.count)
+        return b''.join(head), None
+
+    def to_buffers(self, keep_alive=None):
+        '''
+        :return: A list of bytes objects with the status line and the
+            headers only, the connection sends the file afterwards
+        '''
+        head, _ = self._build_response()
+        return [head, CONNECTION_HEADERS[keep_alive]]
+
+    def to_bytes(self):
+        raise TypeError('A file response can not be serialized at once')
+
+    def freeze(self):
+        raise TypeError('A file response can not be frozen')
+
+    async def close(self):
+        file, self.body = self.body, None
+        if file is None:
+            return
+        if self._on_close is not None:
+            self._on_close(file)
+        else:
+            file.close()
+
+
+def as_response(result):
+    '''
+    Turns the result of a handler into a Response
+
+    :param result: A Response, an async iterable sent as a StreamingResponse,
+        or the body of a 200 response
+    :return: A Response
+    '''
+    if isinstance(result, Response):
+        return result
+    if hasattr(result, '__aiter__'):
+        return StreamingResponse(code=200, body=result)
+    return Response(code=200, body=result)
+
+
+def status_line(code):
+    '''
+    :param code: an HTTP status code, the reason phrase is left empty for
+        a code without one, ie. relayed from an upstream server
+    :return: the encoded status line, built once per code
+    '''
+    try:
+        return STATUS_LINES[code]
+    except KeyError:
+        line = 'HTTP/1.1 {0} {1}\r\n'.format(
+            code, Response.reason_phrases.get(code, '')).encode('utf8')
+        STATUS_LINES[code] = line
+        return line
+
+
+def header_line(header, value):
+    '''
+    :param header: A string with the header name.
+    :param value: the value of the header, bytes or anything str() accepts
+    :return: the encoded header line. Lines are cached, as most responses
+        repeat the same few headers.
+    '''
+    # with the type, values that compare equal but print differently
+    # (True, 1 and 1.0) get lines of their own
+    key = (header, type(value), value)
+    try:
+        return HEADER_LINES[key]
+    except TypeError:
+        return _encode_header_line(header, value)
+    except KeyError:
+        if len(HEADER_LINES) >= HEADER_CACHE_SIZE:
+            HEADER_LINES.clear()
+        line = HEADER_LINES[key] = _encode_header_line(header, value)
+        return line
+
+
+def _encode_header_line(header, value):
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf8')
+    return header.encode('utf8') + b': ' + value + b'\r\n'
+
+
+HEADER_CACHE_SIZE = 1024
+HEADER_LINES = {}
+STATUS_LINES = {}
+for _code in Response.reason_phrases:
+    status_line(_code)
+CONNECTION_HEADERS = {
+    None: b'\r\n',
+    True: b'Connection: keep-alive\r\n\r\n',
+    False: b'Connection: close\r\n\r\n',
+}
+LAST_CHUNK = b'0\r\n\r\n'
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/16
+'''
+Request metrics exposed in the Prometheus text format.
+
+Metrics are only collected when a Metrics instance is given to HTTPServer,
+the connections check for it once per request and do nothing otherwise.
+Each worker process collects its own.
+'''
+import bisect
+import time
+
+from framework.http_utils import Response
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# route label of the requests that matched no route
+UNMATCHED = '<unmatched>'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Histogram(object):
+    '''
+    Counts observations in fixed buckets, observing costs a bisect
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        :return: a list of (upper bound, count of observations lower or
+            equal to it) pairs, ending with '+Inf'
+        '''
+        bounds = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+        total = 0
+        pairs = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class Metrics(object):
+    '''
+    Per route request counters and phase latency histograms, bytes
+    received and sent and gauges read when the metrics are rendered.
+
+    The phases of a request are:
+    parse: parsing the request line, headers and body
+    route: looking up the handler
+    handler: running the handler until it returns a response
+    write: writing the response until it is drained
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS, clock=time.perf_counter):
+        '''
+        :param buckets: upper bounds of the latency histograms, in seconds
+        :param clock: function returning the current time in seconds
+        '''
+        self.buckets = buckets
+        self.clock = clock
+        self.requests = {}
+        self.latencies = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.gauges = {}
+
+    def add_gauge(self, name, help_text, function):
+        '''
+        :param name: name of the metric
+        :param help_text: description of the metric
+        :param function: called without arguments when rendering, returns
+            the current value
+        '''
+        self.gauges[name] = (help_text, function)
+
+    def count(self, route, code):
+        key = (route, code)
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+    def observe(self, phase, route, seconds):
+        key = (phase, route)
+        histogram = self.latencies.get(key)
+        if histogram is None:
+            histogram = self.latencies[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def observe_request(self, route, code, parse, lookup, handler, write):
+        '''
+        Records a request that got a response from its handler
+
+        :param route: the route that matched the request
+        :param code: status code of the response
+        :param parse: parse, lookup, handler, write: seconds spent in each phase
+        '''
+        self.count(route, code)
+        self.observe('parse', route, parse)
+        self.observe('route', route, lookup)
+        self.observe('handler', route, handler)
+        self.observe('write', route, write)
+
+    def render(self):
+        '''
+        :return: the metrics in the Prometheus text exposition format
+        '''
+        lines = [
+            '# HELP http_requests_total Responses sent, by route and status code',
+            '# TYPE http_requests_total counter',
+        ]
+        for (route, code), count in sorted(self.requests.items(), key=_sort_key):
+            lines.append('http_requests_total{{route="{0}",code="{1}"}} {2}'.format(
+                _escape(route), code, count))
+        lines.extend([
+            '# HELP http_request_phase_seconds Time spent in each phase of a request',
+            '# TYPE http_request_phase_seconds histogram',
+        ])
+        for (phase, route), histogram in sorted(self.latencies.items(), key=_sort_key):
+            labels = 'phase="{0}",route="{1}"'.format(phase, _escape(route))
+            for bound, count in histogram.cumulative():
+                lines.append('http_request_phase_seconds_bucket{{{0},le="{1}"}} {2}'.format(
+                    labels, bound, count))
+            lines.append('http_request_phase_seconds_sum{{{0}}} {1!r}'.format(
+                labels, histogram.sum))
+            lines.append('http_request_phase_seconds_count{{{0}}} {1}'.format(
+                labels, histogram.count))
+        for name, help_text, value in (
+                ('http_received_bytes_total', 'Bytes received', self.bytes_in),
+                ('http_sent_bytes_total', 'Bytes sent', self.bytes_out)):
+            lines.extend([
+                '# HELP {0} {1}'.format(name, help_text),
+                '# TYPE {0} counter'.format(name),
+                '{0} {1}'.format(name, value),
+            ])
+        for name, (help_text, function) in sorted(self.gauges.items()):
+            lines.extend([
+                '# HELP {0} {1}'.format(name, help_text),
+                '# TYPE {0} gauge'.format(name),
+                '{0} {1}'.format(name, function()),
+            ])
+        return '\n'.join(lines) + '\n'
+
+    async def handler(self, request):
+        '''
+        Route handler serving the rendered metrics
+        '''
+        return Response(body=self.render(), content_type=CONTENT_TYPE)
+
+
+def _sort_key(item):
+    return tuple(str(part) for part in item[0])
+
+
+def _escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/18
+'''
+Runs synchronous handlers out of the event loop: blocking ones in a thread
+pool, CPU bound ones in a process pool, so they don't stall the other
+connections.
+'''
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+
+from framework.exceptions import ServiceUnavailableException
+
+THREAD = 'thread'
+PROCESS = 'process'
+THREAD_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+PROCESS_WORKERS = os.cpu_count() or 1
+MAX_QUEUE = 64
+RETRY_AFTER = 1
+
+
+class Executors(object):
+    '''
+    The thread and process pools shared by the offloaded routes of a
+    Router. Pools are created on first use, so that pre-forked workers
+    each start their own.
+    '''
+
+    def __init__(self, thread_workers=THREAD_WORKERS, process_workers=PROCESS_WORKERS):
+        '''
+        :param thread_workers: size of the thread pool
+        :param process_workers: size of the process pool
+        '''
+        self.workers = {THREAD: thread_workers, PROCESS: process_workers}
+        self._pools = {}
+
+    def get(self, kind):
+        '''
+        :param kind: THREAD or PROCESS
+        :return: the concurrent.futures.Executor of that kind
+        '''
+        pool = self._pools.get(kind)
+        if pool is None:
+            if kind == THREAD:
+                pool = concurrent.futures.ThreadPoolExecutor(self.workers[THREAD])
+            else:
+                pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers[PROCESS], mp_context=_process_context())
+            self._pools[kind] = pool
+        return pool
+
+    def shutdown(self, wait=True):
+        '''
+        Shuts the pools down, calls that didn't start yet are cancelled
+        :param wait: whether to wait for the running calls to finish
+        '''
+        for pool in self._pools.values():
+            pool.shutdown(wait=wait, cancel_futures=True)
+        self._pools.clear()
+
+
+def _process_context():
+    # forked pool processes would inherit the sockets of the open
+    # connections and keep them open after the server closed them
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+class Offload(object):
+    '''
+    Calls the synchronous handler of one route in an executor. At most
+    'concurrency' calls run at once, up to 'max_queue' more wait for their
+    turn and the following ones are rejected with a 503 right away.
+
+    Process pool handlers must be module level functions. They get a
+    snapshot of the request, which can be pickled, and must return a
+    string or a Response that can be pickled too.
+    '''
+
+    def __init__(self, kind=THREAD, concurrency=None, max_queue=MAX_QUEUE,
+                 retry_after=RETRY_AFTER):
+        '''
+        :param kind: THREAD or PROCESS
+        :param concurrency: calls running at once, defaults to the size of
+            the pool
+        :param max_queue: calls waiting for a free slot, 0 rejects calls as
+            soon as every slot is taken
+        :param retry_after: seconds a rejected client is told to wait
+        '''
+        if kind not in (THREAD, PROCESS):
+            raise ValueError('Unknown executor: {0}'.format(kind))
+        self.kind = kind
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.running = 0
+        self._waiters = collections.deque()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def call(self, executors, handler, request, path_params):
+        '''
+        :param executors: the Executors holding the pool
+        :return: the result of handler(request, **path_params)
+        '''
+        pool = executors.get(self.kind)
+        if self.concurrency is None:
+            self.concurrency = executors.workers[self.kind]
+        await self._acquire()
+        if self.kind == PROCESS:
+            request = request.snapshot()
+        try:
+            future = pool.submit(functools.partial(handler, request, **path_params))
+        except BaseException:
+            self._release()
+            raise
+        # the slot is freed when the call is over, not when the request is,
+        # a timed out request can't cancel a call that is running
+        loop = asyncio.get_event_loop()
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if self.kind == THREAD and not future.cancelled():
+                request.keep()  # the handler goes on in its thread
+            raise
+
+    async def _acquire(self):
+        if self.running < self.concurrency and not self._waiters:
+            self.running += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise ServiceUnavailableException(retry_after=self.retry_after)
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release()  # got the slot while being cancelled
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # the slot goes to the waiter
+                return
+        self.running -= 1
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/20
+'''
+Free-lists of the objects allocated for every request and connection, so
+they are reset and reused instead of being allocated again.
+
+A handler using its request after the response, ie. in a task it
+started, calls request.keep() and the request is never taken back. As a
+safety net for the handlers that don't, an object is also only taken
+back when nothing but the caller of release references it, according to
+CPython reference counts. Elsewhere objects are never taken back.
+'''
+import sys
+
+from framework.http_utils import Request
+
+POOL_SIZE = 256
+
+
+def _refcount(obj):
+    return sys.getrefcount(obj)
+
+
+def _unshared():
+    obj = object()
+    return _refcount(obj)
+
+
+# what _refcount returns for an object only held by a local variable of
+# its caller, None when reference counts are not available
+UNSHARED = _unshared() if hasattr(sys, 'getrefcount') else None
+
+
+class FreeList(object):
+    '''
+    Bounded stack of objects ready to be reused
+    '''
+
+    __slots__ = ('factory', 'reset', 'reusable', 'size', 'created', 'reused', '_free')
+
+    def __init__(self, factory, reset, size=POOL_SIZE, reusable=None):
+        '''
+        :param factory: function creating a new object
+        :param reset: function called with an object given back, to put it
+            back in the state factory returns them
+        :param size: number of objects kept at most, 0 disables the pool
+        :param reusable: function returning False for an object given back
+            that is still in use, None when they all may be
+        '''
+        self.factory = factory
+        self.reset = reset
+        self.reusable = reusable
+        self.size = size
+        self.created = 0
+        self.reused = 0
+        self._free = []
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        '''
+        :return: a reset object from the pool, or a new one
+        '''
+        if self._free:
+            self.reused += 1
+            return self._free.pop()
+        self.created += 1
+        return self.factory()
+
+    def release(self, obj):
+        '''
+        Gives obj back to the pool, unless it is still in use: reusable
+        says so or something else than a local variable of the caller
+        references it.
+
+        :return: whether obj was taken back
+        '''
+        if UNSHARED is None or len(self._free) >= self.size:
+            return False
+        if self.reusable is not None and not self.reusable(obj):
+            return False
+        # one more reference than UNSHARED: the argument of this method
+        if _refcount(obj) > UNSHARED + 1:
+            return False
+        self.reset(obj)
+        self._free.append(obj)
+        return True
+
+    def clear(self):
+        del self._free[:]
+
+
+def _clear_buffer(buffer):
+    del buffer[:]
+
+
+def _not_kept(request):
+    return not request.kept
+
+
+REQUESTS = FreeList(Request, Request.reset, reusable=_not_kept)
+BUFFERS = FreeList(bytearray, _clear_buffer)
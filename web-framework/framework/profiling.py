@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/27
+'''
+Sampled request profiling with cProfile, aggregated per route.
+
+Only the requests picked by the Profiler are profiled: a share of them
+chosen at random when they start, and those carrying a marker header.
+The connection enables the request's profiler while it parses the
+request, which includes the route lookup, and around each step of
+the coroutine replying to it: running the handler, serializing and
+writing the response. The time spent by the event loop on other
+connections while the request awaits is left out. Synchronous handlers
+run in an executor are not seen.
+
+Other requests cost a random number and a header lookup. The profiles
+of the last max_samples requests of each route are kept as they are and
+only turned into pstats.Stats when they are rendered or dumped, which
+costs several times more than profiling the request.
+'''
+import collections
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import random
+import re
+
+from framework.http_utils import Response
+
+SAMPLE_RATE = 0.01
+MAX_SAMPLES = 256
+SORT = 'cumulative'
+LIMIT = 40
+MAX_DEPTH = 64
+FORMATS = ('text', 'pstats', 'collapsed')
+# a path of the call graph taking less than this share of a root is dropped
+MIN_FRACTION = 0.001
+
+
+class Profiled(object):
+    '''
+    Awaitable running a coroutine with a profiler enabled only while the
+    coroutine runs, not while it is suspended
+    '''
+
+    __slots__ = ('coroutine', 'profile')
+
+    def __init__(self, coroutine, profile):
+        self.coroutine = coroutine
+        self.profile = profile
+
+    def __await__(self):
+        coroutine, profile = self.coroutine, self.profile
+        value, error = None, None
+        while True:
+            profile.enable()
+            try:
+                if error is None:
+                    future = coroutine.send(value)
+                else:
+                    future = coroutine.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                profile.disable()
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+class Profiler(object):
+    '''
+    Picks the requests to profile and keeps the profiles of the last
+    max_samples of them for each route, merged into a pstats.Stats per
+    route when they are rendered.
+    '''
+
+    def __init__(self, sample_rate=SAMPLE_RATE, header=None, directory=None,
+                 max_samples=MAX_SAMPLES, random=random.random):
+        '''
+        :param sample_rate: share of the requests profiled, 0 to 1
+        :param header: name of a request header marking a request to
+            profile, ie. 'X-Profile', None to only sample. Anyone able to
+            send requests can then make the server profile them.
+        :param directory: where dump writes the profiles, defaults to the
+            working directory
+        :param max_samples: profiles kept per route, the oldest are dropped
+        :param random: function returning a float in [0, 1)
+        '''
+        self.sample_rate = sample_rate
+        self.header = header
+        self.directory = directory
+        self.max_samples = max_samples
+        self.random = random
+        self.profiles = {}
+        self.requests = collections.Counter()
+
+    def sample(self):
+        '''
+        Called when a request starts
+        :return: a cProfile.Profile when the request is sampled, else None
+        '''
+        if self.random() < self.sample_rate:
+            return cProfile.Profile()
+
+    def marked(self, request):
+        '''
+        Called once the headers of a request that wasn't sampled are parsed
+        :return: a cProfile.Profile when the request asks to be profiled,
+            else None
+        '''
+        if self.header is not None and request.get_header(self.header) is not None:
+            return cProfile.Profile()
+
+    def add(self, route, profile):
+        '''
+        Keeps the profile of a request of route
+        '''
+        profiles = self.profiles.get(route)
+        if profiles is None:
+            profiles = self.profiles[route] = collections.deque(maxlen=self.max_samples)
+        profiles.append(profile)
+        self.requests[route] += 1
+
+    def clear(self, route=None):
+        if route is None:
+            self.profiles.clear()
+            self.requests.clear()
+        else:
+            self.profiles.pop(route, None)
+            self.requests.pop(route, None)
+
+    @property
+    def routes(self):
+        return sorted(self.profiles, key=str)
+
+    def stats(self, route):
+        '''
+        :return: a pstats.Stats merging the profiles kept for route, None
+            when there are none
+        '''
+        merged = None
+        for profile in self.profiles.get(route, ()):
+            try:
+                stats = pstats.Stats(profile)
+            except TypeError:
+                continue  # never enabled, the request was rejected while parsed
+            if merged is None:
+                merged = stats
+            else:
+                merged.add(stats)
+        return merged
+
+    def merged(self, route=None):
+        '''
+        :return: a pstats.Stats of route, or of every route when None.
+            None when no request was profiled.
+        '''
+        if route is not None:
+            return self.stats(route)
+        merged = None
+        for name in self.routes:
+            stats = self.stats(name)
+            if stats is None:
+                continue
+            if merged is None:
+                merged = stats
+            else:
+                merged.add(stats)
+        return merged
+
+    def text(self, route=None, sort=SORT, limit=LIMIT):
+        '''
+        :return: the report of pstats print_stats
+        '''
+        routes = [route] if route is not None else self.routes
+        out = io.StringIO()
+        for name in routes:
+            stats = self.stats(name)
+            if stats is None:
+                continue
+            out.write('route {0}, {1} requests profiled, the last {2} shown\n'.format(
+                name, self.requests[name], len(self.profiles[name])))
+            stats.stream = out
+            stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def marshalled(self, route=None):
+        '''
+        :return: the marshalled stats, as written by pstats.Stats.dump_stats
+        '''
+        stats = self.merged(route)
+        if stats is None:
+            return b''
+        return marshal.dumps(stats.stats)
+
+    def collapsed(self, route=None):
+        '''
+        :return: the stacks in the collapsed format of flamegraph.pl and
+            speedscope, 'route;frame;frame microseconds' per line
+        '''
+        routes = [route] if route is not None else self.routes
+        lines = []
+        for name in routes:
+            stats = self.stats(name)
+            if stats is not None:
+                lines.extend(collapse(stats.stats, name))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def render(self, route=None, format='text', sort=SORT, limit=LIMIT):
+        '''
+        :return: a Response with the profiles in format, one of FORMATS
+        '''
+        if format == 'pstats':
+            return Response(body=self.marshalled(route), content_type='application/octet-stream')
+        if format == 'collapsed':
+            return Response(body=self.collapsed(route), content_type='text/plain')
+        return Response(body=self.text(route, sort, limit), content_type='text/plain')
+
+    async def handler(self, request):
+        '''
+        Admin route serving the profiles. Query parameters: route, the
+        pattern of a route, all by default; format, one of FORMATS; sort
+        and limit of the text format; clear=1 to clear the profiles of
+        the route after they are served.
+        '''
+        params = request.query_params
+        route = params.get('route', [None])[0]
+        format = params.get('format', ['text'])[0]
+        if format not in FORMATS:
+            return Response(code=400, body='format must be one of {0}'.format(
+                ', '.join(FORMATS)), content_type='text/plain')
+        try:
+            limit = int(params.get('limit', [LIMIT])[0])
+        except ValueError:
+            limit = LIMIT
+        try:
+            response = self.render(route, format, params.get('sort', [SORT])[0], limit)
+        except KeyError as e:
+            return Response(code=400, body='Unknown sort key {0}'.format(e),
+                            content_type='text/plain')
+        if params.get('clear', ['0'])[0] == '1':
+            self.clear(route)
+        return response
+
+    def dump(self):
+        '''
+        Writes the stats of every route to '{pid}-{route}.pstats' and all
+        the stacks to '{pid}.collapsed' in directory, each worker writes
+        its own files. Called on SIGUSR2 by the App.
+
+        :return: the paths written
+        '''
+        directory = self.directory or os.getcwd()
+        pid = os.getpid()
+        paths = []
+        for route in self.routes:
+            stats = self.stats(route)
+            if stats is None:
+                continue
+            path = os.path.join(directory, '{0}-{1}.pstats'.format(pid, _file_name(route)))
+            stats.dump_stats(path)
+            paths.append(path)
+        if paths:
+            path = os.path.join(directory, '{0}.collapsed'.format(pid))
+            with open(path, 'w') as f:
+                f.write(self.collapsed())
+            paths.append(path)
+        return paths
+
+
+def collapse(stats, root=None):
+    '''
+    Rebuilds call stacks from the caller/callee edges of cProfile stats.
+    cProfile doesn't record whole stacks, so the time of a function
+    called from several places is split between them in proportion to
+    the time each caller spent in it.
+
+    :param stats: the stats dict of a pstats.Stats
+    :param root: a frame prepended to every stack, ie. the route
+    :return: a list of 'frame;frame;frame microseconds' lines
+    '''
+    callees = collections.defaultdict(list)
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller].append((function, edge[3]))
+    times = collections.Counter()
+    prefix = () if root is None else (root,)
+
+    def walk(function, path, on_path, fraction):
+        total_time = stats[function][2]
+        path = path + (_label(function),)
+        if total_time * fraction > 0:
+            times[path] += total_time * fraction
+        if len(path) >= MAX_DEPTH:
+            return
+        on_path = on_path | {function}
+        for callee, edge_time in callees.get(function, ()):
+            callee_time = stats[callee][3]
+            if callee in on_path or not callee_time:
+                continue
+            share = fraction * min(edge_time / callee_time, 1.0)
+            if share >= MIN_FRACTION:
+                walk(callee, path, on_path, share)
+
+    for function, (_, _, _, _, callers) in stats.items():
+        if not any(caller in stats for caller in callers):
+            walk(function, prefix, frozenset(), 1.0)
+    return ['{0} {1}'.format(';'.join(path), int(round(seconds * 10 ** 6)))
+            for path, seconds in sorted(times.items()) if seconds >= 0.0000005]
+
+
+def _label(function):
+    file_name, line, name = function
+    if file_name == '~':
+        return name  # a builtin, ie. "<method 'send' of 'coroutine' objects>"
+    return '{0}:{1}:{2}'.format(os.path.basename(file_name), name, line)
+
+
+def _file_name(route):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(route)).strip('_') or 'root'
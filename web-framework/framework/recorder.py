@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/24
+'''
+Records a sample of the raw bytes received by the server, chunk by chunk
+as they arrived, so that real traffic can be replayed through the parser
+and the router offline, see benchmarks/replay.py.
+
+The log is a MAGIC header followed by records of a CHUNK header,
+(connection id, seconds since the recording started, length), and that
+many bytes. A record of length 0 ends a connection. The bytes are stored
+as received, headers included: a log may contain cookies and credentials.
+'''
+import os
+import random
+import struct
+import time
+
+MAGIC = b'HTTPREC1'
+CHUNK = struct.Struct('<IdI')
+SAMPLE_RATE = 0.01
+MAX_BYTES = 256 * 1024 * 1024
+BUFFER_SIZE = 64 * 1024
+
+
+class TrafficRecorder(object):
+    '''
+    Appends the chunks received by a sample of the connections to a log
+    file. Connections are sampled as a whole, to keep their pipelining
+    and how their requests were split across reads.
+
+    The file is opened on the first chunk, so each pre-forked worker opens
+    its own: '{pid}' in path is replaced by the pid of the worker.
+    Recording stops once the file reaches max_bytes.
+    '''
+
+    def __init__(self, path, sample_rate=SAMPLE_RATE, max_bytes=MAX_BYTES,
+                 clock=time.monotonic, random=random.random):
+        '''
+        :param path: path of the log file, appended to if it exists
+        :param sample_rate: share of the connections recorded, 0 to 1
+        :param max_bytes: size of the log at which recording stops
+        :param clock: function returning the current time in seconds
+        :param random: function returning a float in [0, 1)
+        '''
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.random = random
+        self.size = 0
+        self.connections = 0
+        self._file = None
+        self._started = None
+        self._next_id = 0
+        self._full = False
+
+    def start(self):
+        '''
+        Called when a connection is accepted
+        :return: the id of the connection in the log if it is recorded,
+            otherwise None
+        '''
+        if self._full or self.random() >= self.sample_rate:
+            return
+        self._next_id = (self._next_id + 1) & 0xffffffff
+        self.connections += 1
+        return self._next_id
+
+    def write(self, connection_id, data):
+        '''
+        Records a chunk received by the connection connection_id
+        '''
+        if self._full:
+            return
+        if self._file is None:
+            self._open()
+        self._file.write(CHUNK.pack(connection_id, self.clock() - self._started, len(data)))
+        self._file.write(data)
+        self.size += CHUNK.size + len(data)
+        if self.size >= self.max_bytes:
+            self.close()
+            self._full = True
+
+    def end(self, connection_id):
+        '''
+        Records the end of the connection connection_id
+        '''
+        if self._file is not None:
+            self._file.write(CHUNK.pack(connection_id, self.clock() - self._started, 0))
+            self.size += CHUNK.size
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        path = self.path.replace('{pid}', str(os.getpid()))
+        self._file = open(path, 'ab', buffering=BUFFER_SIZE)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self.size = self._file.tell()
+        self._started = self.clock()
+
+
+def read_log(path):
+    '''
+    Iterates over the records of a log
+
+    :return: an iterator of (connection id, seconds since the recording
+        started, bytes) tuples, the bytes are empty when the connection
+        ended
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a traffic log'.format(path))
+        while True:
+            header = f.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return  # the end, or a record cut short by a crash
+            connection_id, timestamp, length = CHUNK.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield connection_id, timestamp, data
+
+
+def read_connections(path):
+    '''
+    Groups the chunks of a log by connection. Ids are only unique among
+    the connections open at the same time, a log appended to by a
+    restarted server starts them again.
+
+    :return: a list of lists of chunks, one list per connection in the
+        order the connections started
+    '''
+    connections = []
+    open_connections = {}
+    for connection_id, _, data in read_log(path):
+        if not data:
+            open_connections.pop(connection_id, None)
+            continue
+        chunks = open_connections.get(connection_id)
+        if chunks is None:
+            chunks = open_connections[connection_id] = []
+            connections.append(chunks)
+        chunks.append(data)
+    return connections
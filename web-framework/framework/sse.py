@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/29
+'''
+Server-sent events pushed to many long-lived connections.
+
+A Broadcaster encodes an event once, framed as an HTTP chunk. The events
+published during an iteration of the event loop are joined and that same
+bytes object is written to the transport of every subscribed connection,
+a single write per subscriber, without waking a task per subscriber.
+Only a subscriber whose transport stopped taking writes gets them
+queued, in a bounded queue its connection flushes once the client reads
+again.
+Heartbeats are written by a single timer of the broadcaster, to the
+subscribers that got nothing since the previous one.
+'''
+import collections
+
+from framework.http_utils import StreamingResponse, utf8_bytes
+
+HEARTBEAT_INTERVAL = 15
+MAX_QUEUE = 64
+# policies for a subscriber whose queue is full
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP, DISCONNECT)
+
+
+def encode_event(data, event=None, id=None, retry=None):
+    '''
+    :param data: str or bytes, sent as one 'data:' line per line
+    :param event: the event type, 'message' for the browser when None
+    :param id: the event id, sent back by a reconnecting browser in
+        the Last-Event-ID header
+    :param retry: milliseconds the browser waits before reconnecting
+    :return: the event in the text/event-stream format, as bytes
+    '''
+    lines = []
+    if event is not None:
+        lines.append(b'event: ' + utf8_bytes(event))
+    if id is not None:
+        lines.append(b'id: ' + utf8_bytes(str(id)))
+    if retry is not None:
+        lines.append(b'retry: %d' % retry)
+    lines.extend(b'data: ' + line for line in utf8_bytes(data).splitlines() or [b''])
+    return b'\n'.join(lines) + b'\n\n'
+
+
+def chunk(payload):
+    '''
+    :return: payload framed as a chunk of a 'Transfer-Encoding: chunked' body
+    '''
+    return b'%x\r\n%s\r\n' % (len(payload), payload)
+
+
+HEARTBEAT = chunk(b':\n\n')
+
+
+class EventStream(StreamingResponse):
+    '''
+    Response subscribing its connection to a Broadcaster, sent with
+    'Transfer-Encoding: chunked' until the broadcaster or the connection
+    closes
+    '''
+
+    __slots__ = ('broadcaster', 'events')
+
+    def __init__(self, broadcaster, events=(), code=200, **kwargs):
+        '''
+        :param broadcaster: the Broadcaster of the events
+        :param events: events encoded with encode_event sent first, ie.
+            those missed since the Last-Event-ID of a reconnecting browser
+        '''
+        kwargs.setdefault('content_type', 'text/event-stream')
+        super().__init__(code=code, body=None, **kwargs)
+        self.set_header('Cache-Control', 'no-cache')
+        self.broadcaster = broadcaster
+        self.events = events
+
+    async def chunks(self, encoding_fn=utf8_bytes):
+        raise TypeError('An event stream is written by its broadcaster')
+
+    def subscribe(self, connection):
+        '''
+        Called by the connection once the headers are sent
+        :return: the Subscriber of the connection
+        '''
+        return self.broadcaster.subscribe(connection, [chunk(event) for event in self.events])
+
+
+class Subscriber(object):
+    '''
+    A connection receiving the events of a Broadcaster
+    '''
+
+    __slots__ = ('broadcaster', 'connection', 'transport', 'metrics', 'high_water',
+                 'queue', 'sent', 'dropped', 'closed', 'disconnected', '_waiter')
+
+    def __init__(self, broadcaster, connection):
+        self.broadcaster = broadcaster
+        self.connection = connection
+        self.transport = connection.transport
+        self.metrics = connection.metrics
+        # past this many buffered bytes the transport pauses its writers
+        self.high_water = self.transport.get_write_buffer_limits()[1]
+        self.queue = collections.deque()
+        self.sent = False
+        self.dropped = 0
+        self.closed = False
+        self.disconnected = False
+        self._waiter = None
+
+    def send(self, data):
+        '''
+        Writes an encoded chunk to the transport, or queues it when the
+        transport's buffer is full or older chunks are still queued
+        :return: False when the subscriber has to be disconnected
+        '''
+        self.sent = True
+        if self.queue or self.transport.get_write_buffer_size() >= self.high_water:
+            if len(self.queue) >= self.broadcaster.max_queue:
+                if self.broadcaster.policy == DISCONNECT:
+                    return False
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(data)
+            self._wake()
+            return True
+        self.connection.write(data)
+        if self.metrics is not None:
+            self.metrics.bytes_out += len(data)
+        return True
+
+    async def run(self):
+        '''
+        Flushes the queue whenever the transport takes writes again, until
+        the subscriber is closed
+        '''
+        connection = self.connection
+        while not self.closed:
+            if not self.queue:
+                self._waiter = connection.loop.create_future()
+                await self._waiter
+                continue
+            await connection.drain()
+            if self.closed or self.transport.is_closing():
+                return
+            buffers, self.queue = list(self.queue), collections.deque()
+            connection.writelines(buffers)
+            if self.metrics is not None:
+                self.metrics.bytes_out += sum(map(len, buffers))
+
+    def close(self, disconnected=False):
+        '''
+        Ends run
+        :param disconnected: whether the connection is closed without
+            ending the response, ie. it fell too far behind
+        '''
+        self.disconnected = self.disconnected or disconnected
+        if not self.closed:
+            self.closed = True
+            self.queue.clear()
+            self.broadcaster.subscribers.discard(self)
+            self._wake()
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
+class Broadcaster(object):
+    '''
+    Fans events out to the connections subscribed through its handler.
+    publish and close are called from the event loop of the server, each
+    worker has its own subscribers.
+    '''
+
+    def __init__(self, heartbeat=HEARTBEAT_INTERVAL, max_queue=MAX_QUEUE,
+                 policy=DROP, retry=None):
+        '''
+        :param heartbeat: seconds between two heartbeats, a comment line
+            keeping quiet connections open through proxies and revealing
+            the closed ones
+        :param max_queue: writes queued for a subscriber that isn't
+            reading, each holds the events published during an iteration
+            of the loop
+        :param policy: when its queue is full, DROP the oldest write of
+            the subscriber or DISCONNECT it, the browser reconnects with the
+            id of the last event it got
+        :param retry: milliseconds browsers wait before reconnecting, sent
+            to every new subscriber when set
+        '''
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of {0}'.format(', '.join(POLICIES)))
+        self.heartbeat = heartbeat
+        self.max_queue = max_queue
+        self.policy = policy
+        self.retry = retry
+        self.subscribers = set()
+        self.published = 0
+        self.disconnected = 0
+        self._loop = None
+        self._timer = None
+        self._pending = []
+
+    async def handler(self, request):
+        '''
+        Route subscribing its requests, ie. router.add_route('/events', broadcaster.handler)
+        '''
+        return EventStream(self)
+
+    def subscribe(self, connection, chunks=()):
+        '''
+        :param connection: a connection whose response headers are sent
+        :param chunks: encoded chunks sent to this subscriber first
+        :return: a Subscriber, whose run the connection awaits
+        '''
+        subscriber = Subscriber(self, connection)
+        if self.retry is not None:
+            subscriber.send(chunk(b'retry: %d\n\n' % self.retry))
+        for data in chunks:
+            subscriber.send(data)
+        self.subscribers.add(subscriber)
+        if self._timer is None:
+            self._loop = connection.loop
+            self._timer = self._loop.call_later(self.heartbeat, self._beat)
+        return subscriber
+
+    def publish(self, data, event=None, id=None):
+        '''
+        Encodes an event once and sends it to every subscriber
+        :param data: str or bytes, see encode_event for the others
+        :return: the number of subscribers it is sent to
+        '''
+        self.published += 1
+        return self.send(chunk(encode_event(data, event, id)))
+
+    def send(self, data):
+        '''
+        Sends an encoded chunk to every subscriber once the current
+        iteration of the loop is done, with the others sent during it
+        :param data: an encoded chunk
+        :return: the number of subscribers it is sent to
+        '''
+        if not self.subscribers:
+            return 0
+        self._pending.append(data)
+        if len(self._pending) == 1:
+            self._loop.call_soon(self._flush)
+        return len(self.subscribers)
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return  # flushed by close
+        data = pending[0] if len(pending) == 1 else b''.join(pending)
+        behind = None
+        for subscriber in self.subscribers:
+            if not subscriber.send(data):
+                if behind is None:
+                    behind = []
+                behind.append(subscriber)
+        if behind is not None:
+            self._disconnect(behind)
+
+    def close(self):
+        '''
+        Ends the responses of every subscriber once the events already
+        published are sent, the browsers reconnect
+        '''
+        self._flush()
+        for subscriber in list(self.subscribers):
+            subscriber.close()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _beat(self):
+        '''
+        Sends a heartbeat to the subscribers that got nothing since the
+        last one and drops those whose connection is gone
+        '''
+        behind = []
+        for subscriber in list(self.subscribers):
+            if subscriber.transport.is_closing():
+                subscriber.close(disconnected=True)
+            elif not subscriber.sent and not subscriber.send(HEARTBEAT):
+                behind.append(subscriber)
+            subscriber.sent = False
+        self._disconnect(behind)
+        if self.subscribers:
+            self._timer = self._loop.call_later(self.heartbeat, self._beat)
+        else:
+            self._timer = None
+
+    def _disconnect(self, subscribers):
+        for subscriber in subscribers:
+            self.disconnected += 1
+            subscriber.close(disconnected=True)
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/21
+'''
+Serves the files of a directory: Router.add_static(prefix, directory) adds a
+'{prefix}/{path:path}' route handled by a StaticFiles instance.
+
+Open files and their stat results are cached, so a request for a file
+served recently costs no system call until it is sent. Responses carry an
+ETag and a Last-Modified header, conditional GETs are answered with a 304
+and a single byte range with a 206.
+'''
+import collections
+import email.utils
+import mimetypes
+import os
+import stat
+import time
+from urllib import parse
+
+from framework.compression import identity_etag
+from framework.exceptions import NotFoundException
+from framework.http_utils import EmptyResponse, FileResponse, Response
+
+MAX_FILES = 256
+CHECK_INTERVAL = 1
+DEFAULT_TYPE = 'application/octet-stream'
+TEXT_TYPES = ('application/javascript', 'application/json', 'application/xml',
+              'image/svg+xml')
+
+
+def _mime_types():
+    mimetypes.init()
+    types = {}
+    for extension, content_type in mimetypes.types_map.items():
+        if content_type.startswith('text/') or content_type in TEXT_TYPES:
+            content_type += '; charset=utf-8'
+        types[extension] = content_type
+    return types
+
+
+# Content-Type of each file extension, looked up once per cached file
+MIME_TYPES = _mime_types()
+
+
+class FileEntry(object):
+    '''
+    An open file and what its responses need to know about it
+    '''
+
+    __slots__ = ('path', 'file', 'size', 'mtime', 'key', 'etag', 'last_modified',
+                 'content_type', 'checked', 'users', 'stale')
+
+    def __init__(self, path, file, st, checked):
+        self.path = path
+        self.file = file
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        self.etag = '"{0:x}-{1:x}"'.format(st.st_size, st.st_mtime_ns)
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        extension = os.path.splitext(path)[1].lower()
+        self.content_type = MIME_TYPES.get(extension, DEFAULT_TYPE)
+        self.checked = checked
+        # responses sending the shared file object at the moment
+        self.users = 0
+        self.stale = False
+
+    def close(self):
+        '''
+        Closes the file once no response is sending it anymore
+        '''
+        self.stale = True
+        if not self.users:
+            self.file.close()
+
+
+class StaticFiles(object):
+    '''
+    Route handler serving the files under a directory.
+
+    The cache keeps up to max_files open files in least recently used order
+    and checks a file again at most once every check_interval seconds: a
+    file changed in the meantime is served as it was for that long.
+
+    Concurrent responses for the same file don't share its file object,
+    which sendfile may seek when it has to fall back to reading the file:
+    the first one uses the cached file object, the others open their own.
+    '''
+
+    def __init__(self, directory, max_files=MAX_FILES, check_interval=CHECK_INTERVAL,
+                 max_age=None, index='index.html', clock=time.monotonic):
+        '''
+        :param directory: the directory served, files outside of it are not
+        :param max_files: number of open files kept in the cache
+        :param check_interval: seconds a cached stat result is trusted
+        :param max_age: seconds sent in a 'Cache-Control: max-age' header,
+            None to send none
+        :param index: file served for a directory, None to answer a 404
+        :param clock: function returning the current time in seconds
+        '''
+        self.directory = os.path.realpath(directory)
+        self.max_files = max_files
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.index = index
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def handler(self, request, path):
+        '''
+        Route handler, 'path' is the part of the URL path after the prefix
+        '''
+        if request.method not in ('GET', 'HEAD'):
+            return Response(code=405, body=Response.reason_phrases[405],
+                            headers={'Allow': 'GET, HEAD'})
+        entry = self.lookup(parse.unquote(path))
+        headers = {
+            'ETag': entry.etag,
+            'Last-Modified': entry.last_modified,
+            'Accept-Ranges': 'bytes',
+        }
+        if self.max_age is not None:
+            headers['Cache-Control'] = 'max-age={0}'.format(self.max_age)
+        if not_modified(request, entry):
+            return EmptyResponse(code=304, headers=headers)
+
+        offset, count, code = 0, entry.size, 200
+        byte_range = request.get_header('range')
+        if byte_range is not None and if_range(request, entry):
+            byte_range = parse_range(byte_range, entry.size)
+            if byte_range == ():
+                headers['Content-Range'] = 'bytes */{0}'.format(entry.size)
+                return Response(code=416, body=Response.reason_phrases[416],
+                                headers=headers)
+            if byte_range is not None:
+                offset, end = byte_range
+                count, code = end - offset + 1, 206
+                headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                    offset, end, entry.size)
+
+        # a HEAD gets the file too, compression needs it for the headers
+        if not count:
+            return FileResponse(None, offset, count, code=code, headers=headers,
+                                content_type=entry.content_type)
+        return FileResponse(self.acquire(entry), offset, count, code=code,
+                            headers=headers, content_type=entry.content_type,
+                            on_close=lambda file: self.release(entry, file))
+
+    def resolve(self, path):
+        '''
+        :param path: a decoded path relative to the directory
+        :return: the absolute path of the file, None when it is outside of
+            the directory
+        '''
+        if '\x00' in path:
+            return
+        full_path = os.path.realpath(os.path.join(self.directory, path.lstrip('/')))
+        if os.path.commonpath([self.directory, full_path]) != self.directory:
+            return
+        return full_path
+
+    def lookup(self, path):
+        '''
+        :param path: a decoded path relative to the directory
+        :return: the FileEntry of the file, from the cache when it was
+            checked less than check_interval seconds ago
+        '''
+        now = self.clock()
+        entry = self._entries.get(path)
+        if entry is not None:
+            if now - entry.checked < self.check_interval or self._unchanged(entry, now):
+                self._entries.move_to_end(path)
+                return entry
+            del self._entries[path]
+            entry.close()
+        entry = self._open(path, now)
+        self._entries[path] = entry
+        while len(self._entries) > self.max_files:
+            self._entries.popitem(last=False)[1].close()
+        return entry
+
+    def _unchanged(self, entry, now):
+        try:
+            st = os.stat(entry.path)
+        except OSError:
+            return False
+        if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != entry.key:
+            return False
+        entry.checked = now
+        return True
+
+    def _open(self, path, now):
+        full_path = self.resolve(path)
+        if full_path is None:
+            raise NotFoundException()
+        try:
+            if self.index is not None and os.path.isdir(full_path):
+                full_path = os.path.join(full_path, self.index)
+            file = open(full_path, 'rb')
+        except OSError:
+            raise NotFoundException()
+        st = os.fstat(file.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            file.close()
+            raise NotFoundException()
+        return FileEntry(full_path, file, st, now)
+
+    def acquire(self, entry):
+        '''
+        :return: the file object a response sends, the cached one when no
+            other response is using it
+        '''
+        if not entry.users and not entry.stale:
+            entry.users += 1
+            return entry.file
+        return open(entry.path, 'rb')
+
+    def release(self, entry, file):
+        if file is not entry.file:
+            file.close()
+            return
+        entry.users -= 1
+        if entry.stale and not entry.users:
+            file.close()
+
+    def clear(self):
+        '''
+        Closes the cached files
+        '''
+        for entry in self._entries.values():
+            entry.close()
+        self._entries.clear()
+
+
+def not_modified(request, entry):
+    '''
+    :return: whether the client's copy of the file is current, according
+        to If-None-Match or else If-Modified-Since
+    '''
+    if_none_match = request.get_header('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        # weak comparison, a W/ prefix doesn't matter, and the tag of a
+        # compressed copy validates the file it was made from
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return any(identity_etag(tag[2:] if tag.startswith('W/') else tag) == entry.etag
+                   for tag in tags)
+    since = _parse_date(request.get_header('if-modified-since'))
+    return since is not None and entry.mtime <= since
+
+
+def if_range(request, entry):
+    '''
+    :return: whether a Range header applies, it doesn't when If-Range names
+        another version of the file, or a compressed copy: the range would
+        be bytes of the file, not of the copy the client has part of
+    '''
+    condition = request.get_header('if-range')
+    if condition is None:
+        return True
+    condition = condition.strip()
+    if condition.startswith('"'):
+        return condition == entry.etag
+    since = _parse_date(condition)
+    return since is not None and entry.mtime == since
+
+
+def parse_range(header, size):
+    '''
+    Parses a Range header asking for a single range of bytes
+
+    :param header: value of the Range header
+    :param size: size of the file in bytes
+    :return: a (first, last) tuple of inclusive byte positions, None when
+        the header is invalid or asks for several ranges, which are served
+        as a whole, and () when the range is past the end of the file
+    '''
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return
+    first, dash, last = ranges.strip().partition('-')
+    if not dash:
+        return
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return () if suffix == 0 else None
+            return max(size - suffix, 0), size - 1
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        return
+    if first >= size:
+        return ()
+    if last < first:
+        return
+    return first, min(last, size - 1)
+
+
+def _parse_date(value):
+    if not value:
+        return
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return
+    return int(date.timestamp())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/13
+'''
+Hashed timer wheel used to expire connections.
+
+A connection only updates its 'deadline' attribute when it makes progress,
+which costs a float assignment instead of cancelling and creating a
+TimerHandle on every read. The wheel runs a single loop timer per server,
+ticking every 'resolution' seconds. It looks at the connections of one slot
+per tick, expires those whose deadline passed and moves the others to the
+slot matching their current deadline.
+'''
+import math
+
+RESOLUTION = 0.5
+SLOTS = 64
+
+
+class TimerWheel(object):
+    '''
+    Entries are objects with a 'deadline' attribute (in loop.time() seconds,
+    None for no deadline), a 'timer_slot' attribute initialized to None and
+    an 'expire' method. Entries expire up to one resolution late.
+    '''
+
+    def __init__(self, loop, resolution=RESOLUTION, slots=SLOTS):
+        '''
+        :param loop: An object that implements the 'asyncio.BaseEventLoop' interface
+        :param resolution: seconds between two ticks
+        :param slots: number of slots, deadlines further than
+            resolution * slots are looked at again when their slot comes round
+        '''
+        self.loop = loop
+        self.resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        self._position = 0
+        self._next_tick = None
+        self._handle = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, entry):
+        '''
+        Puts entry in the slot of its deadline. Does nothing if entry is
+        already in the wheel: a deadline moved later is noticed when the
+        slot it is in comes round.
+        '''
+        if entry.timer_slot is not None or entry.deadline is None:
+            return
+        if self._handle is None:
+            self._next_tick = self.loop.time() + self.resolution
+            self._handle = self.loop.call_at(self._next_tick, self._tick)
+        ticks = math.ceil((entry.deadline - self._next_tick) / self.resolution)
+        slot = (self._position + min(max(ticks, 0), len(self._slots) - 1)) % len(self._slots)
+        self._slots[slot].add(entry)
+        entry.timer_slot = slot
+        self._count += 1
+
+    def remove(self, entry):
+        if entry.timer_slot is not None:
+            self._slots[entry.timer_slot].discard(entry)
+            entry.timer_slot = None
+            self._count -= 1
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _tick(self):
+        slot = self._slots[self._position]
+        self._slots[self._position] = set()
+        self._position = (self._position + 1) % len(self._slots)
+        self._next_tick += self.resolution
+        self._count -= len(slot)
+
+        now = self.loop.time()
+        for entry in slot:
+            entry.timer_slot = None
+            if entry.deadline is None:
+                continue
+            if entry.deadline <= now:
+                entry.expire()
+            else:
+                self.add(entry)
+
+        if self._count:
+            self._handle = self.loop.call_at(self._next_tick, self._tick)
+        else:
+            self._handle = None
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/30
+'''
+Coalesced misses of the ResponseCache, when the request building the
+response fails or runs out of time while others wait for it.
+
+    python -m unittest discover tests
+'''
+import asyncio
+import unittest
+
+from framework import http_parser
+from framework.application import Router
+from framework.cache import ResponseCache
+from framework.http_server import HTTPServer
+
+KEY = ('GET', '/slow', (), ())
+
+
+def slow_handler(delays):
+    '''
+    :param delays: seconds each call sleeps, in order
+    :return: a handler answering with the number of its call
+    '''
+    calls = []
+
+    async def handler(request=None):
+        calls.append(None)
+        call = len(calls)
+        await asyncio.sleep(delays[call - 1])
+        return 'call {0}'.format(call)
+
+    return handler, calls
+
+
+class FetchTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_follower_builds_its_own_response_when_leader_times_out(self):
+        cache = ResponseCache()
+        create, calls = slow_handler([1, 0])
+        leader = asyncio.ensure_future(asyncio.wait_for(cache.fetch(KEY, create), 0.1))
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(cache.fetch(KEY, create))
+        with self.assertRaises(asyncio.TimeoutError):
+            await leader
+        response = await asyncio.wait_for(follower, 1)
+        self.assertEqual(response.body, 'call 2')
+        self.assertEqual(len(calls), 2)
+        self.assertIs(cache.get(KEY), response)
+
+    async def test_follower_builds_its_own_response_when_leader_fails(self):
+        cache = ResponseCache()
+        calls = []
+
+        async def create():
+            calls.append(None)
+            await asyncio.sleep(0.05)
+            if len(calls) == 1:
+                raise ValueError('first call fails')
+            return 'ok'
+
+        leader = asyncio.ensure_future(cache.fetch(KEY, create))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.fetch(KEY, create))
+        with self.assertRaises(ValueError):
+            await leader
+        self.assertEqual((await follower).body, 'ok')
+
+    async def test_followers_share_the_response_of_the_leader(self):
+        cache = ResponseCache()
+        create, calls = slow_handler([0.05])
+        responses = await asyncio.gather(*[cache.fetch(KEY, create) for _ in range(3)])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({response.body for response in responses}, {'call 1'})
+
+
+class HandlerTimeoutTest(unittest.IsolatedAsyncioTestCase):
+    '''
+    A cached route whose first call outlasts handler_timeout, with a
+    second request for it arriving meanwhile
+    '''
+
+    async def request(self, port, path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('GET {0} HTTP/1.1\r\nConnection: close\r\n\r\n'.format(path).encode())
+        data = await reader.read()
+        writer.close()
+        return data
+
+    async def serve(self, use_protocol):
+        handler, calls = slow_handler([3, 0])
+        router = Router()
+        router.add_route('/slow', handler, cache=True)
+        loop = asyncio.get_event_loop()
+        server = HTTPServer(router, http_parser, loop, handler_timeout=2)
+        if use_protocol:
+            listener = await loop.create_server(server.protocol_factory, '127.0.0.1', 0)
+        else:
+            listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+        self.addAsyncCleanup(listener.wait_closed)
+        self.addCleanup(listener.close)
+        port = listener.sockets[0].getsockname()[1]
+
+        leader = asyncio.ensure_future(self.request(port, '/slow'))
+        # a slot of the timer wheel later, the follower doesn't expire with the leader
+        await asyncio.sleep(1)
+        follower = await self.request(port, '/slow')
+        self.assertTrue(follower.startswith(b'HTTP/1.1 200 '), follower)
+        self.assertTrue(follower.endswith(b'call 2'), follower)
+        self.assertTrue((await leader).startswith(b'HTTP/1.1 500 '))
+        self.assertEqual(len(calls), 2)
+        await asyncio.sleep(0)
+        self.assertFalse(server.connections)
+
+    async def test_streams(self):
+        await self.serve(False)
+
+    async def test_protocol(self):
+        await self.serve(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/30
+'''
+Compressed copies shared by concurrent requests, when the request
+compressing one is cancelled while others wait for it, and conditional
+requests for the compressed copy of a static file.
+
+    python -m unittest discover tests
+'''
+import asyncio
+import gzip
+import os
+import tempfile
+import unittest
+
+from framework import http_parser
+from framework.application import Router
+from framework.compression import Compressor
+from framework.http_server import HTTPServer
+from framework.http_utils import Headers, Request, Response
+
+BODY = 'compressible text ' * 10000
+
+
+def gzip_request():
+    request = Request()
+    request.method = 'GET'
+    request.headers = Headers(items=[('Accept-Encoding', 'gzip')])
+    return request
+
+
+def tagged_response():
+    return Response(body=BODY, headers={'ETag': '"v1"'}, content_type='text/plain')
+
+
+class SharedCompressionTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_waiter_compresses_when_the_first_request_is_cancelled(self):
+        # compressed in the executor, so the first request can be cancelled meanwhile
+        compressor = Compressor(offload_size=0)
+        first = asyncio.ensure_future(compressor.compress(gzip_request(), tagged_response()))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(compressor.compress(gzip_request(), tagged_response()))
+        await asyncio.sleep(0)
+        first.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        variant = await asyncio.wait_for(second, 5)
+        self.assertEqual(variant.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(variant._body), BODY.encode())
+
+    async def test_waiters_share_one_compression(self):
+        compressor = Compressor(offload_size=0)
+        variants = await asyncio.gather(*[
+            compressor.compress(gzip_request(), tagged_response()) for _ in range(3)])
+        self.assertEqual(compressor.compressed, 1)
+        self.assertEqual(len({id(variant) for variant in variants}), 1)
+
+    async def test_uncompressed_frozen_response_varies(self):
+        compressor = Compressor()
+        response = tagged_response().freeze()
+        request = gzip_request()
+        request.headers = Headers()
+        variant = await compressor.compress(request, response)
+        self.assertEqual(variant.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(variant._body, response._body)
+        self.assertIs(await compressor.compress(request, response), variant)
+
+
+class StaticRevalidationTest(unittest.IsolatedAsyncioTestCase):
+    '''
+    A static file served gzipped, asked with HEAD or revalidated with the
+    ETag of the gzipped copy
+    '''
+
+    async def asyncSetUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with open(os.path.join(directory.name, 'a.txt'), 'w') as file:
+            file.write(BODY)
+        router = Router()
+        router.add_static('/static', directory.name)
+        loop = asyncio.get_event_loop()
+        server = HTTPServer(router, http_parser, loop, compression=Compressor())
+        listener = await asyncio.start_server(server.handle_connection, '127.0.0.1', 0)
+        self.addAsyncCleanup(listener.wait_closed)
+        self.addCleanup(listener.close)
+        self.port = listener.sockets[0].getsockname()[1]
+
+    async def request(self, method, headers):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+        head = ''.join('{0}: {1}\r\n'.format(k, v) for k, v in headers.items())
+        writer.write('{0} /static/a.txt HTTP/1.1\r\nConnection: close\r\n{1}\r\n'.format(
+            method, head).encode())
+        data = await reader.read()
+        writer.close()
+        head, _, body = data.partition(b'\r\n\r\n')
+        lines = head.decode().split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(': ', 1)
+            headers[name.lower()] = value
+        return int(lines[0].split()[1]), headers, body
+
+    async def test_head_announces_the_gzipped_copy(self):
+        _, get_headers, body = await self.request('GET', {'Accept-Encoding': 'gzip'})
+        code, headers, _ = await self.request('HEAD', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(code, 200)
+        self.assertEqual(headers['content-length'], str(len(body)))
+        self.assertEqual(headers, get_headers)
+        self.assertNotIn('accept-ranges', headers)
+
+    async def test_gzip_etag_gets_a_304(self):
+        code, headers, body = await self.request('GET', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(code, 200)
+        self.assertEqual(gzip.decompress(body), BODY.encode())
+        etag = headers['etag']
+        self.assertTrue(etag.endswith('-gzip"'), etag)
+        code, headers, body = await self.request(
+            'GET', {'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(code, 304)
+        self.assertEqual(headers['etag'], etag)
+        self.assertEqual(headers['vary'], 'Accept-Encoding')
+
+    async def test_gzip_etag_does_not_validate_a_range(self):
+        _, headers, _ = await self.request('GET', {'Accept-Encoding': 'gzip'})
+        code, _, body = await self.request('GET', {'Range': 'bytes=0-9',
+                                                   'If-Range': headers['etag']})
+        self.assertEqual(code, 200)
+        self.assertEqual(body, BODY.encode())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Project : web-framework
+# Created by igor on 16/10/30
+'''
+When the free-lists take a request or a buffer back. The reference count
+tests pin what framework.pool assumes of the interpreter running them.
+
+    python -m unittest discover tests
+'''
+import asyncio
+import unittest
+
+from framework import pool
+from framework.http_utils import Request
+from framework.pool import FreeList
+
+
+def requests():
+    return FreeList(Request, Request.reset, reusable=pool._not_kept)
+
+
+@unittest.skipIf(pool.UNSHARED is None, 'no reference counts, nothing is reused')
+class ReleaseTest(unittest.TestCase):
+
+    def test_unshared_request_is_reset_and_reused(self):
+        free_list = requests()
+        request = free_list.acquire()
+        request.path = '/a'
+        self.assertTrue(free_list.release(request))
+        self.assertIsNone(request.path)
+        self.assertIs(free_list.acquire(), request)
+
+    def test_kept_request_is_not_reused(self):
+        free_list = requests()
+        request = free_list.acquire()
+        request.path = '/a'
+        request.keep()
+        self.assertFalse(free_list.release(request))
+        self.assertEqual(request.path, '/a')
+        self.assertEqual(len(free_list), 0)
+
+    def test_request_in_a_container_is_not_reused(self):
+        free_list = requests()
+        request = free_list.acquire()
+        kept = [request]
+        self.assertFalse(free_list.release(request))
+        self.assertIs(kept[0], request)
+
+    def test_request_in_a_closure_cell_is_not_reused(self):
+        free_list = requests()
+
+        def handler(request):
+            def later():
+                return request.path
+            return later
+
+        request = free_list.acquire()
+        request.path = '/a'
+        later = handler(request)
+        self.assertFalse(free_list.release(request))
+        self.assertEqual(later(), '/a')
+
+    def test_request_held_by_a_task_is_not_reused(self):
+        free_list = requests()
+
+        async def background(request):
+            await asyncio.sleep(0)
+            return request.path
+
+        async def main():
+            request = free_list.acquire()
+            request.path = '/a'
+            task = asyncio.ensure_future(background(request))
+            released = free_list.release(request)
+            del request
+            return released, await task
+
+        self.assertEqual(asyncio.run(main()), (False, '/a'))
+
+    def test_buffer_with_a_live_memoryview_is_not_reused(self):
+        free_list = FreeList(bytearray, pool._clear_buffer)
+        buffer = free_list.acquire()
+        buffer += b'data'
+        view = memoryview(buffer)
+        self.assertFalse(free_list.release(buffer))
+        view.release()
+        self.assertTrue(free_list.release(buffer))
+        self.assertEqual(buffer, b'')
+
+    def test_full_pool_drops_objects(self):
+        free_list = FreeList(bytearray, pool._clear_buffer, size=1)
+        first, second = bytearray(), bytearray()
+        self.assertTrue(free_list.release(first))
+        self.assertFalse(free_list.release(second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,3 @@
+# -*- coding: utf-8 -*-
+# Project : web-server
+# Created by igor on 16/10/30
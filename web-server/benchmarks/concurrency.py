@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Project : web-server
+# Created by igor on 16/10/30
+'''
+Concurrent static file throughput of webserver.server in each concurrency
+mode: single threaded, thread pool and pre-forked processes, with and
+without slow clients holding connections open without finishing their
+request.
+
+    python -m benchmarks.concurrency [--duration S] [--clients C] [--slow N]
+        [--size B] [--threads T] [--processes P]
+'''
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from webserver import server
+
+HOST = '127.0.0.1'
+REQUEST = 'GET /file.bin HTTP/1.0\r\nHost: {0}\r\n\r\n'.format(HOST).encode()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Server on {0}:{1} did not start'.format(HOST, port))
+
+
+def serve(port, directory, mode, threads, processes):
+    os.chdir(directory)
+    # every request is logged to stderr, and the clients cut at the deadline
+    sys.stderr = open(os.devnull, 'w')
+    server.run((HOST, port), mode, threads=threads, processes=processes, drain_timeout=1)
+
+
+async def client(port, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(HOST, port), deadline - started)
+            writer.write(REQUEST)
+            response = await asyncio.wait_for(reader.read(), deadline - started)
+            writer.close()
+        except asyncio.TimeoutError:
+            break  # cut by the deadline
+        except OSError as e:
+            errors.append(e)
+            continue
+        if response.startswith(b'HTTP/1.0 200'):
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(response[:12])
+
+
+async def slow_client(port, stop):
+    '''
+    Sends half a request line and waits until stop
+    '''
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(REQUEST[:10])
+    await stop.wait()
+    writer.close()
+
+
+async def load(port, clients, slow, duration):
+    stop = asyncio.Event()
+    slow_clients = [asyncio.ensure_future(slow_client(port, stop)) for _ in range(slow)]
+    await asyncio.sleep(0.1)
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[client(port, deadline, latencies, errors) for _ in range(clients)])
+    stop.set()
+    await asyncio.gather(*slow_clients, return_exceptions=True)
+    return sorted(latencies), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--slow', type=int, default=2, help='slow clients of the second run')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='bytes of the file')
+    parser.add_argument('--threads', type=int, default=server.THREAD_COUNT)
+    parser.add_argument('--processes', type=int, default=server.PROCESS_COUNT)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'file.bin'), 'wb') as f:
+            f.write(os.urandom(args.size))
+        for mode in server.MODES:
+            for slow in (0, args.slow):
+                port = free_port()
+                process = multiprocessing.Process(target=serve, args=(
+                    port, directory, mode, args.threads, args.processes))
+                process.start()
+                try:
+                    wait_for_port(port)
+                    latencies, errors = asyncio.run(load(port, args.clients, slow, args.duration))
+                finally:
+                    os.kill(process.pid, signal.SIGTERM)
+                    process.join()
+                served = len(latencies)
+                p50 = latencies[served // 2] * 1000 if served else 0
+                p99 = latencies[int(served * 0.99)] * 1000 if served else 0
+                print('{0:<8} {1} slow clients  {2:8.1f} req/s  p50 {3:7.2f}ms  '
+                      'p99 {4:7.2f}ms  errors {5}'.format(
+                          mode, slow, served / args.duration, p50, p99, len(errors)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,28 @@
 # Project : web-server
 # Created by igor on 16/8/6
 import os, sys, subprocess
+import argparse, queue, signal, threading, time, traceback
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
+# 并发模式
+SINGLE = 'single'
+THREADS = 'threads'
+PREFORK = 'prefork'
+MODES = (SINGLE, THREADS, PREFORK)
+
+THREAD_COUNT = 16
+QUEUE_SIZE = 64
+PROCESS_COUNT = 4
+DRAIN_TIMEOUT = 10
+POLL_INTERVAL = 0.5
+
+# 队列已满时的响应
+SERVICE_UNAVAILABLE = (b'HTTP/1.0 503 Service Unavailable\r\n'
+                       b'Content-Type: text/html\r\n'
+                       b'Content-Length: 0\r\n'
+                       b'Retry-After: 1\r\n'
+                       b'Connection: close\r\n\r\n')
+
 
 class ServerException(Exception):
     '''
@@ -142,8 +162,14 @@ class RequestHandler(BaseHTTPRequestHandler):
         except Exception as msg:
             self.handle_error(msg)
 
-        page = self.create_page()
-        self.send_content(page)
+    def handle_file(self, full_path):
+        try:
+            with open(full_path, 'rb') as reader:
+                content = reader.read()
+            self.send_content(content)
+        except IOError as msg:
+            msg = "'{0}' cannot be read : {1}".format(self.path, msg)
+            self.handle_error(msg)
 
     def create_page(self):
         values = {
@@ -175,7 +201,175 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_content(data)
 
 
+class ThreadPoolHTTPServer(HTTPServer):
+    '''
+    线程池服务器: the accepted connections wait in a queue for one of the
+    threads, a slow client or CGI script only holds its own thread.
+    Connections past the busy threads and queue_size waiting get a 503.
+    '''
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 threads=THREAD_COUNT, queue_size=QUEUE_SIZE):
+        super().__init__(server_address, RequestHandlerClass)
+        self.requests = queue.Queue()
+        # connections accepted and not finished yet, counted rather than
+        # bounding the queue, a thread may not have taken its connection yet
+        self.pending = 0
+        self.max_pending = threads + queue_size
+        self.pending_lock = threading.Lock()
+        self.rejected = 0
+        self.threads = [threading.Thread(target=self.process_requests, daemon=True)
+                        for _ in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        with self.pending_lock:
+            full = self.pending >= self.max_pending
+            if not full:
+                self.pending += 1
+        if not full:
+            self.requests.put((request, client_address))
+            return
+        self.rejected += 1
+        try:
+            request.sendall(SERVICE_UNAVAILABLE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self.pending_lock:
+                    self.pending -= 1
+                self.shutdown_request(request)
+
+    def drain(self, timeout):
+        '''
+        Lets the threads finish the queued connections within timeout,
+        once serve_forever returned
+        '''
+        deadline = time.time() + timeout
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join(max(deadline - time.time(), 0))
+
+
+class PreforkHTTPServer(HTTPServer):
+    '''
+    多进程服务器: the listening socket is bound before forking and shared
+    by the processes, the kernel hands each connection to one of them.
+    It doesn't block, a process woken for a connection another one
+    accepted goes back to waiting.
+    '''
+
+    def server_activate(self):
+        super().server_activate()
+        self.socket.setblocking(False)
+
+
+def serve(server, drain_timeout=DRAIN_TIMEOUT, signals=(signal.SIGTERM, signal.SIGINT)):
+    '''
+    Serves until one of signals, then stops accepting and gives the
+    requests in flight drain_timeout to finish
+    '''
+    stop = threading.Event()
+    for signum in signals:
+        signal.signal(signum, lambda signum, frame: stop.set())
+    threading.Thread(target=server.serve_forever, args=(POLL_INTERVAL,), daemon=True).start()
+    while not stop.wait(POLL_INTERVAL):
+        pass
+    deadline = time.time() + drain_timeout
+    # shutdown waits for serve_forever, which runs the requests of a single server
+    stopping = threading.Thread(target=server.shutdown, daemon=True)
+    stopping.start()
+    stopping.join(drain_timeout)
+    if isinstance(server, ThreadPoolHTTPServer):
+        server.drain(max(deadline - time.time(), 0))
+    server.server_close()
+
+
+def prefork(server, processes=PROCESS_COUNT, drain_timeout=DRAIN_TIMEOUT):
+    '''
+    Forks processes serving server until SIGTERM or SIGINT, which are
+    forwarded to them as a SIGTERM, and restarts those that die
+    '''
+    children = {}
+    stopping = []
+
+    def spawn():
+        pid = os.fork()
+        if pid:
+            children[pid] = time.time()
+            return
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # Ctrl-C reaches the whole process group, the parent forwards it
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            serve(server, drain_timeout, signals=(signal.SIGTERM,))
+        except BaseException:
+            # the parent respawns the worker, the traceback tells why it died
+            traceback.print_exc()
+            sys.stderr.flush()
+            os._exit(1)
+        os._exit(0)
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(processes):
+        spawn()
+    while children:
+        pid, status = os.wait()
+        started = children.pop(pid)
+        if not stopping:
+            if time.time() - started < 1:
+                time.sleep(1)  # 避免不断重启启动即崩溃的进程
+            spawn()
+    server.server_close()
+
+
+def run(server_address, mode=SINGLE, threads=THREAD_COUNT, queue_size=QUEUE_SIZE,
+        processes=PROCESS_COUNT, drain_timeout=DRAIN_TIMEOUT):
+    '''
+    Serves the current directory in one of MODES until SIGTERM or SIGINT
+    '''
+    if mode == PREFORK:
+        prefork(PreforkHTTPServer(server_address, RequestHandler), processes, drain_timeout)
+    elif mode == THREADS:
+        serve(ThreadPoolHTTPServer(server_address, RequestHandler, threads, queue_size),
+              drain_timeout)
+    else:
+        serve(HTTPServer(server_address, RequestHandler), drain_timeout)
+
+
 if __name__ == "__main__":
-    serverAddress = ("", 8080)
-    server = HTTPServer(serverAddress, RequestHandler)
-    server.serve_forever()
+    parser = argparse.ArgumentParser(description='Serves the current directory')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--mode', choices=MODES, default=SINGLE)
+    parser.add_argument('--threads', type=int, default=THREAD_COUNT)
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE,
+                        help='connections waiting for a thread at most')
+    parser.add_argument('--processes', type=int, default=PROCESS_COUNT)
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT)
+    args = parser.parse_args()
+    serverAddress = ("", args.port)
+    run(serverAddress, args.mode, args.threads, args.queue, args.processes,
+        args.drain_timeout)